@@ -9,22 +9,170 @@ KBJordahl
 
 import ftrack_api
 import os, sys
+import atexit
+import threading
+import time
 import logging, logging.handlers
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 LOG_DIR = os.path.realpath(os.path.join(dir_path,'..','logs','ftrack-google-calendar.log'))
 RESOURCE_DIR = os.path.realpath(os.path.join(dir_path,'..','resource'))
 
-# add the resource directory to the mix
+# add the resource directory to the mix -- google_calendar_tools itself is only
+# imported once the updater is needed, since it pulls in the google api client
 try :
     sys.path.index(RESOURCE_DIR)
 except:
     sys.path.append(RESOURCE_DIR)
-finally:
-    from google_calendar_tools import CalendarUpdater
-    
+
 
 ACTION_IDENTIFIER = 'make-project-events'
+RECONCILE_IDENTIFIER = 'reconcile-project-events'
+
+# the event hub can't match inside the data.entities list, so this can't be narrowed
+# by entity type here -- CalendarUpdater.filter_entities drops the updates we don't
+# want straight from the payload instead, before any ftrack or google I/O
+UPDATE_SUBSCRIPTION = 'topic=ftrack.update'
+
+# create the updater (and connect to google) in the background as soon as we're
+# registered, rather than when the first event comes in
+PREWARM = os.environ.get('FTRACK_CALENDAR_PREWARM', '1') != '0'
+
+def create_updater():
+    from google_calendar_tools import CalendarUpdater
+    return CalendarUpdater()
+
+class LazyUpdater(object):
+    '''
+    Creates the CalendarUpdater on a thread of its own, so registering the plugin
+    never waits on google and neither does the event hub, and hands events to it
+
+    Until it's ready, up to PENDING_LIMIT events are held for it, and past that
+    they're dropped, and made up for by a catch-up once it is. Creating it is
+    tried again, RETRY_DELAY seconds later and doubling up to RETRY_MAX_DELAY,
+    until it works
+    '''
+
+    PENDING_LIMIT = 1000
+    RETRY_DELAY = 5.0
+    RETRY_MAX_DELAY = 300.0
+
+    def __init__(self, factory=create_updater, logger=None):
+        self.factory = factory
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._updater = None
+        # (method, event) for each event that came before the updater was ready
+        self._pending = []
+        self._dropped_at = None
+
+    def get(self, timeout=None):
+        '''
+        returns the updater, waiting for it to be created -- or None if it isn't by the
+        timeout. never call this on the event hub's thread
+        '''
+        self.prewarm()
+        self._ready.wait(timeout)
+        return self._updater
+
+    def prewarm(self):
+        '''
+        starts creating the updater on a daemon thread, unless that's started already
+        '''
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._create, name="CalendarUpdaterPrewarm")
+                self._thread.daemon = True
+                self._thread.start()
+            return self._thread
+
+    def handler(self, method):
+        '''
+        returns an event handler calling the updater's method, or holding the event for
+        it if it isn't ready yet
+        '''
+        def handle(event):
+            with self._lock:
+                updater = self._updater
+                if updater is None:
+                    self._hold(method, event)
+            if updater is None:
+                self.prewarm()
+                return None
+            return getattr(updater, method)(event)
+        return handle
+
+    def _hold(self, method, event):
+        # caller must hold the lock
+        if len(self._pending) < self.PENDING_LIMIT:
+            self._pending.append((method, event))
+            return
+        if self._dropped_at is None:
+            self.logger.warning("Dropping events until the calendar updater is ready, "
+                "they'll be caught up on once it is")
+            self._dropped_at = time.time()
+
+    def _create(self):
+        delay = self.RETRY_DELAY
+        while True:
+            self.logger.info("Creating the calendar updater")
+            try:
+                updater = self.factory()
+                break
+            except Exception:
+                self.logger.error("Couldn't create the calendar updater, trying again in %.0fs", delay,
+                    exc_info=True)
+            time.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX_DELAY)
+
+        # sync whatever is still waiting out the coalescing window before we go
+        atexit.register(updater.shutdown)
+
+        # events keep being held until all those before them have been handed over
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                if not pending:
+                    dropped_at, self._dropped_at = self._dropped_at, None
+                    self._updater = updater
+                    break
+            self.logger.info("Handing %d events held while starting to the calendar updater", len(pending))
+            for method, event in pending:
+                try:
+                    getattr(updater, method)(event)
+                except Exception:
+                    self.logger.error("Couldn't handle an event held while starting", exc_info=True)
+        self._ready.set()
+
+        if dropped_at is not None:
+            updater.project_workers.submit(('catch-up',), updater.catch_up,
+                dropped_at - updater.CATCH_UP_MARGIN)
+
+    def is_leader(self):
+        '''
+        whether this instance answers actions: always without COORDINATION, and with it,
+        if its updater is the leading instance
+
+        until the updater is ready we can't tell if it's coordinated, so actions are
+        offered, and a launch is held for it like any event -- the updater leaves the
+        ones it gets to the leader itself
+        '''
+        updater = self._updater
+        return updater is None or updater.is_leader()
+
+    def leader_only(self, handler):
+        '''
+        wraps an action handler so only the leading instance answers, and the others
+        don't show (or run) every action once more
+        '''
+        def handle(event):
+            if not self.is_leader():
+                self.logger.debug("Leaving %s to the leading instance", event.get('topic'))
+                return None
+            return handler(event)
+        return handle
 
 def setup_logging():
     logger = logging.getLogger("Lucid.GoogleCalendarHook")
@@ -32,6 +180,8 @@ def setup_logging():
 
     # protect file logging for heroku
     if not os.path.isdir("/app/.heroku"):
+        if not os.path.isdir(os.path.dirname(LOG_DIR)):
+            os.makedirs(os.path.dirname(LOG_DIR))
         file_handler = logging.handlers.TimedRotatingFileHandler(LOG_DIR,
                                         when="w0",
                                         interval=1,
@@ -52,6 +202,16 @@ def discover(event):
                 'label': "Make Calendar Events",
                 'actionIdentifier': ACTION_IDENTIFIER,
                 'actionData': {}
+            },
+            {
+                'label': "Reconcile Calendar Events",
+                'actionIdentifier': RECONCILE_IDENTIFIER,
+                'actionData': {}
+            },
+            {
+                'label': "Reconcile Calendar Events (Dry Run)",
+                'actionIdentifier': RECONCILE_IDENTIFIER,
+                'actionData': {'dry_run': True}
             }
         ]
     }
@@ -64,9 +224,12 @@ def action_test(event):
     logger.info("got event action! TEST ONLY")
     return True
 
-def register(session, **kw):
+def register(session, updater_factory=create_updater, **kw):
     '''
     This method is called by the ftrack api so it knows which functions to run when asked for a location
+
+    Only subscribes, so it returns straight away -- the updater is created by updater_factory
+    in the background, straight away with PREWARM or when the first event comes in without
     '''
 
     logger = setup_logging()
@@ -80,17 +243,18 @@ def register(session, **kw):
         logger.warn("Register called without valid ftrack_api.Session")
         return
 
-    cal = CalendarUpdater()
+    cal = LazyUpdater(updater_factory, logger=logger)
 
     session.event_hub.subscribe(
-        'topic=ftrack.update',# and data.entities any (entityType="CalendarEvent" or entityType="MilestoneEvent")',
-        cal.handle_ftrack_event
+        UPDATE_SUBSCRIPTION,
+        cal.handler('handle_ftrack_event')
     )
     logger.info('Subscribed update event')
 
+    # actions are only offered, and run, by the leading instance
     session.event_hub.subscribe(
         'topic=ftrack.action.discover',
-        discover
+        cal.leader_only(discover)
     )    
     logger.info('Subscribed action discover event')
 
@@ -98,8 +262,20 @@ def register(session, **kw):
         'topic=ftrack.action.launch and data.actionIdentifier={}'.format(
             ACTION_IDENTIFIER
         ),
-        cal.handle_whole_project
+        cal.leader_only(cal.handler('handle_whole_project'))
     )
     logger.info('Subscribed %s event', ACTION_IDENTIFIER)
 
-    logger.info("Successfully registered")
\ No newline at end of file
+    session.event_hub.subscribe(
+        'topic=ftrack.action.launch and data.actionIdentifier={}'.format(
+            RECONCILE_IDENTIFIER
+        ),
+        cal.leader_only(cal.handler('handle_reconcile'))
+    )
+    logger.info('Subscribed %s event', RECONCILE_IDENTIFIER)
+
+    if PREWARM:
+        cal.prewarm()
+
+    logger.info("Successfully registered")
+    return cal
\ No newline at end of file
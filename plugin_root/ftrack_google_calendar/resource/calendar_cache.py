@@ -0,0 +1,181 @@
+'''
+
+Calendar Caches
+
+Per-process caches for Google Calendar lookups that almost never change,
+so that resolving them doesn't cost a round-trip for every ftrack entity.
+
+'''
+
+import collections
+import contextlib
+import threading
+import time
+
+
+class CalendarRegistry(object):
+    '''
+    Maps calendar names to Google calendar ids, and remembers which of those
+    calendars have already been shared with the domain.
+
+    Entries expire after ``ttl`` seconds so that sharing gets re-checked now
+    and then, and can be invalidated explicitly when Google tells us that a
+    cached id no longer exists.
+
+    Looking a calendar up (or creating it) is done while ``resolving`` it, so
+    that threads missing the cache at once don't each create the calendar.
+    '''
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calendars = {}
+        self._resolving = {}
+
+    def _entry(self, calendar_name):
+        # caller must hold the lock
+        entry = self._calendars.get(calendar_name)
+        if entry is not None and time.time() - entry['resolved_at'] > self.ttl:
+            del self._calendars[calendar_name]
+            entry = None
+        return entry
+
+    def get(self, calendar_name):
+        '''
+        returns the cached id of the named calendar, or None if it is unknown or stale
+        '''
+        with self._lock:
+            entry = self._entry(calendar_name)
+            return entry['id'] if entry is not None else None
+
+    @contextlib.contextmanager
+    def resolving(self, calendar_name):
+        '''
+        holds the named calendar's lock for the block, so only one thread at a time
+        looks it up or creates it -- the others should check the cache again after
+        '''
+        with self._lock:
+            lock = self._resolving.setdefault(calendar_name, threading.Lock())
+        with lock:
+            yield
+
+    def put(self, calendar_name, calendar_id, shared=False):
+        with self._lock:
+            self._calendars[calendar_name] = {
+                'id': calendar_id,
+                'shared': shared,
+                'resolved_at': time.time()
+            }
+
+    def is_shared(self, calendar_name):
+        with self._lock:
+            entry = self._entry(calendar_name)
+            return entry is not None and entry['shared']
+
+    def mark_shared(self, calendar_name):
+        with self._lock:
+            entry = self._entry(calendar_name)
+            if entry is not None:
+                entry['shared'] = True
+
+    def invalidate(self, calendar_name=None, calendar_id=None):
+        '''
+        drops entries matching the name or id given, or everything if neither is given
+        '''
+        with self._lock:
+            if calendar_name is None and calendar_id is None:
+                self._calendars.clear()
+                return
+
+            for name, entry in list(self._calendars.items()):
+                if name == calendar_name or entry['id'] == calendar_id:
+                    del self._calendars[name]
+
+
+class ColorPalette(object):
+    '''
+    Google's event color palette, loaded once and refreshed after ``ttl`` seconds,
+    along with a memo of ftrack hex colour -> google colorId that holds at most
+    ``size`` colours, dropping the least recently used.
+
+    The memo can be looked at with ``memo()`` and ``cache_info()``, and emptied
+    with ``clear()``.
+    '''
+
+    def __init__(self, ttl=24 * 60 * 60, size=256):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._palette = None
+        self._loaded_at = None
+        self._memo = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def event_colors(self, fetch):
+        '''
+        returns the event colors of the palette, calling fetch() for the full
+        colors resource if it was never loaded or has gone stale
+        '''
+        with self._lock:
+            if self._palette is not None and time.time() - self._loaded_at <= self.ttl:
+                return self._palette
+
+        palette = fetch()['event']
+
+        with self._lock:
+            if palette != self._palette:
+                # color ids may mean something else now
+                self._memo.clear()
+            self._palette = palette
+            self._loaded_at = time.time()
+            return palette
+
+    def get(self, ftrack_color):
+        '''
+        returns the memoized colorId for the ftrack hex colour, or None
+        '''
+        with self._lock:
+            color_id = self._memo.pop(ftrack_color, None)
+            if color_id is None:
+                self._misses += 1
+                return None
+            # re-insert to mark it as the most recently used
+            self._memo[ftrack_color] = color_id
+            self._hits += 1
+            return color_id
+
+    def put(self, ftrack_color, color_id):
+        with self._lock:
+            self._memo.pop(ftrack_color, None)
+            self._memo[ftrack_color] = color_id
+            while len(self._memo) > self.size:
+                self._memo.popitem(last=False)
+
+    def memo(self):
+        '''
+        returns a copy of the memo, least recently used first
+        '''
+        with self._lock:
+            return collections.OrderedDict(self._memo)
+
+    def cache_info(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._memo),
+                'max_size': self.size,
+                'palette_loaded_at': self._loaded_at,
+            }
+
+    def clear(self):
+        '''
+        forgets the memo and the palette, so the next lookup goes back to google
+        '''
+        with self._lock:
+            self._memo.clear()
+            self._palette = None
+            self._loaded_at = None
+            self._hits = 0
+            self._misses = 0
@@ -0,0 +1,242 @@
+'''
+
+Coordination
+
+Lets several calendar updaters on one machine (or sharing one filesystem)
+split the work between them without any outside service: each instance
+holds a lease in a shared SQLite database, renewed by a heartbeat, and the
+live instances share out the entities by rendezvous hashing, so each entity
+has exactly one owner. When an instance stops renewing its lease, only its
+entities move, spread over the rest. A new instance only takes its share
+once it's been around for two heartbeats, by when everyone else has seen it.
+
+The longest-running live instance is the leader, and does the work there
+should only be one of, like launched actions and sweeps. Work that covers
+entities of every instance, like syncing a whole project, is handed off
+through the database too, so each instance does its own share of it.
+
+'''
+
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+
+
+SCHEMA = [
+    '''
+    create table if not exists members (
+        instance_id text primary key,
+        started_at real not null,
+        heartbeat real not null
+    )
+    ''',
+    '''
+    create table if not exists handoffs (
+        id integer primary key autoincrement,
+        instance_id text not null,
+        payload text not null
+    )
+    ''',
+]
+
+
+def default_instance_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def shard_weight(instance_id, key):
+    return hashlib.sha1('{}/{}'.format(instance_id, key).encode('utf-8')).hexdigest()
+
+
+class ShardCoordinator(object):
+    '''
+    Membership of this instance among those sharing the database at ``path``.
+
+    The lease lasts ``lease_seconds`` and is renewed every third of that on a
+    daemon thread once ``start``ed. ``on_change(joined, departed)`` is called on
+    that thread whenever the live instances change, where departed maps each
+    instance that's gone to its last heartbeat.
+
+    Work ``hand_off``ed by another instance is passed to ``on_handoff(work)`` on
+    the same thread, after the heartbeat that finds it. Work handed to an
+    instance that goes before taking it is handed to everyone left instead.
+    '''
+
+    def __init__(self, path, instance_id=None, lease_seconds=30.0, logger=None, on_change=None,
+                 on_handoff=None):
+        self.path = path
+        self.instance_id = instance_id or default_instance_id()
+        self.lease_seconds = lease_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_change = on_change
+        self.on_handoff = on_handoff
+        self.started_at = time.time()
+        self.heartbeat_interval = lease_seconds / 3.0
+
+        # _lock only guards the snapshot of the members, so owns() never waits on the
+        # database, which can take up to lease_seconds while another instance writes
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        # instance id -> (started_at, heartbeat), of the live instances
+        self._members = {}
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # every instance writes here, so wait out the others' transactions
+        self._conn = sqlite3.connect(path, timeout=lease_seconds, check_same_thread=False)
+        self._conn.execute('pragma journal_mode=wal')
+        with self._conn:
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+
+        self.heartbeat()
+
+    @property
+    def members(self):
+        '''
+        the ids of the live instances, longest-running first
+        '''
+        with self._lock:
+            return sorted(self._members, key=lambda member: (self._members[member][0], member))
+
+    @property
+    def is_leader(self):
+        members = self.members
+        return bool(members) and members[0] == self.instance_id
+
+    def owner(self, key):
+        '''
+        returns the id of the instance that owns the key
+        '''
+        now = time.time()
+        with self._lock:
+            settled = [member for member, (started_at, beat) in self._members.items()
+                if now - started_at >= 2 * self.heartbeat_interval]
+            members = settled or list(self._members) or [self.instance_id]
+        return max(members, key=lambda member: shard_weight(member, key))
+
+    def owns(self, key):
+        return self.owner(key) == self.instance_id
+
+    def heartbeat(self):
+        '''
+        renews our lease, drops the ones that ran out, and reads who's left
+        '''
+        now = time.time()
+        with self._db_lock:
+            with self._conn:
+                self._conn.execute(
+                    'insert or replace into members (instance_id, started_at, heartbeat) values (?, ?, ?)',
+                    (self.instance_id, self.started_at, now))
+                self._conn.execute('delete from members where heartbeat < ?', (now - self.lease_seconds,))
+                self._readdress_handoffs()
+                rows = self._conn.execute('select instance_id, started_at, heartbeat from members').fetchall()
+
+            members = dict((instance_id, (started_at, beat)) for instance_id, started_at, beat in rows)
+            with self._lock:
+                previous, self._members = self._members, members
+
+        joined = [member for member in members if member not in previous]
+        departed = dict((member, previous[member][1]) for member in previous if member not in members)
+        if previous and (joined or departed):
+            self.logger.info("Instances changed, now %d: %s joined, %s left",
+                len(members), ", ".join(joined) or "none", ", ".join(departed) or "none")
+            if self.on_change is not None:
+                self.on_change(joined, departed)
+
+    def hand_off(self, work):
+        '''
+        passes work (anything JSON can hold) to every other live instance, and returns
+        the ids of those it was handed to
+        '''
+        payload = json.dumps(work)
+        others = sorted(member for member in self.members if member != self.instance_id)
+        with self._db_lock:
+            with self._conn:
+                self._conn.executemany('insert into handoffs (instance_id, payload) values (?, ?)',
+                    [(member, payload) for member in others])
+        return others
+
+    def take_handoffs(self):
+        '''
+        passes the work handed to us to on_handoff, oldest first, and returns how much there was
+        '''
+        with self._db_lock:
+            with self._conn:
+                rows = self._conn.execute('select id, payload from handoffs where instance_id = ? order by id',
+                    (self.instance_id,)).fetchall()
+                if rows:
+                    self._conn.execute('delete from handoffs where instance_id = ? and id <= ?',
+                        (self.instance_id, rows[-1][0]))
+
+        for handoff_id, payload in rows:
+            try:
+                self.on_handoff(json.loads(payload))
+            except Exception:
+                self.logger.error("Couldn't run the work handed off as %s: %s", handoff_id, payload[:200],
+                    exc_info=True)
+        return len(rows)
+
+    def start(self):
+        '''
+        renews the lease on a daemon thread until release, taking any work handed to us
+        after each heartbeat
+        '''
+        def run():
+            while not self._stopping.wait(self.heartbeat_interval):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    self.logger.error("Couldn't renew the lease of %s", self.instance_id, exc_info=True)
+                    continue
+                if self.on_handoff is not None:
+                    try:
+                        self.take_handoffs()
+                    except Exception:
+                        self.logger.error("Couldn't take the work handed to %s", self.instance_id, exc_info=True)
+
+        self._thread = threading.Thread(target=run, name="ShardCoordinator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def release(self):
+        '''
+        gives up our lease, so the others take over our entities straight away
+        '''
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(self.lease_seconds)
+        with self._db_lock:
+            try:
+                with self._conn:
+                    self._conn.execute('delete from members where instance_id = ?', (self.instance_id,))
+                    self._readdress_handoffs()
+            except Exception:
+                self.logger.warning("Couldn't release the lease of %s", self.instance_id, exc_info=True)
+            self._conn.close()
+
+    def _readdress_handoffs(self):
+        # caller must hold the db lock, in a transaction. the work of instances that are
+        # gone goes to everyone left, since their entities are spread over all of them
+        orphaned = self._conn.execute(
+            'select id, payload from handoffs where instance_id not in (select instance_id from members)'
+        ).fetchall()
+        if not orphaned:
+            return
+        members = [row[0] for row in self._conn.execute('select instance_id from members')]
+        self._conn.executemany('insert into handoffs (instance_id, payload) values (?, ?)',
+            [(member, payload) for _, payload in orphaned for member in members])
+        self._conn.executemany('delete from handoffs where id = ?', [(handoff_id,) for handoff_id, _ in orphaned])
+        self.logger.info("Handed %d pieces of work left by instances that are gone to the %d left",
+            len(orphaned), len(members))
@@ -0,0 +1,299 @@
+'''
+
+Calendar Event Index
+
+Keeps an in-memory map of ftrack entity -> Google event id for a calendar,
+built from one paged listing of the calendar and kept current with Google's
+incremental sync, so that finding an entity's event costs no network call.
+With a sync state store, the map and sync token also outlive the process.
+
+'''
+
+import copy
+import hashlib
+import logging
+import threading
+import time
+
+import simplejson as json
+from apiclient import errors
+
+
+# private extended property holding the hash of the body we last wrote
+HASH_PROPERTY = 'ftrack_hash'
+
+# private extended property holding the id of the entity's project
+PROJECT_PROPERTY = 'ftrack_project_id'
+
+
+def event_hash(event):
+    '''
+    returns a canonical hash of an event body, leaving out the hash property itself
+    '''
+    body = copy.deepcopy(event)
+    body.get('extendedProperties', {}).get('private', {}).pop(HASH_PROPERTY, None)
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def entity_event_id(ftrack_type, ftrack_id):
+    '''
+    the id an entity's event is created with, the same each time, so creating it twice
+    fails with a 409 instead of making a second event -- google event ids may only use
+    the characters a-v and 0-9
+    '''
+    return 'ft' + hashlib.sha1('{}:{}'.format(ftrack_type, ftrack_id).encode('utf-8')).hexdigest()
+
+
+class EventIndex(object):
+    '''
+    Index of the events on a single calendar, keyed by the (ftrack_type, ftrack_id)
+    private extended properties that entity_to_event writes onto every event.
+    The hash of each event's body is kept alongside, so unchanged events can be
+    told apart without fetching them.
+
+    More than one event carrying the same key means the calendar is in a state we
+    can't sort out on our own, so looking that key up raises.
+
+    Given a ``store``, the index starts from what the store has saved and catches
+    up through the saved sync token. Changes are saved in batches of
+    ``FLUSH_SIZE`` or every ``FLUSH_INTERVAL`` seconds, and with every listing.
+    The sync token is only saved together with the listing it came from, so if
+    the process dies before a batch is saved, the next sync hands those changes
+    back again.
+    '''
+
+    # the largest page google will give us
+    PAGE_SIZE = 2500
+
+    # only the parts of each event the index needs
+    LIST_FIELDS = 'items(id,status,extendedProperties),nextPageToken,nextSyncToken'
+
+    # how many changes, or how many seconds of them, are saved to the store at once
+    FLUSH_SIZE = 200
+    FLUSH_INTERVAL = 10.0
+
+    def __init__(self, calendar_service, calendar_id, logger=None, refresh_interval=300,
+                 execute=None, store=None):
+        self.calendar_service = calendar_service
+        self.calendar_id = calendar_id
+        self.logger = logger or logging.getLogger(__name__)
+        self.refresh_interval = refresh_interval
+        self.execute = execute or (lambda request: request.execute())
+        self.store = store
+
+        self.sync_token = None
+        self.synced_at = None
+
+        self._lock = threading.RLock()
+        self._events = {}
+        self._keys = {}
+        self._hashes = {}
+        self._projects = {}
+
+        # changes not yet saved to the store, event id -> entry (None when removed)
+        self._dirty = {}
+        self._replace = False
+        self._flushed_at = time.time()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def lookup(self, ftrack_type, ftrack_id):
+        '''
+        returns the google event id for the entity, or None if it isn't on the calendar yet
+        '''
+        with self._lock:
+            event_ids = self._events.get((ftrack_type, ftrack_id))
+            if not event_ids:
+                return None
+            if len(event_ids) > 1:
+                raise NotImplementedError("Cannot determine which Google Calendar Event to use, too many matches")
+            return next(iter(event_ids))
+
+    def body_hash(self, event_id):
+        '''
+        returns the hash of the body last written to the event, if it's known
+        '''
+        with self._lock:
+            return self._hashes.get(event_id)
+
+    def entries(self, project_ids=None):
+        '''
+        returns (key, event_id) for every indexed event, or only for those of the
+        projects given
+        '''
+        with self._lock:
+            return [
+                (key, event_id) for event_id, key in self._keys.items()
+                if project_ids is None or self._projects.get(event_id) in project_ids
+            ]
+
+    def apply(self, event):
+        '''
+        records an event google sent back, from a write or a listing
+        '''
+        with self._lock:
+            self._apply(event)
+            self._maybe_flush()
+
+    def discard(self, event_id):
+        with self._lock:
+            self._discard(event_id)
+            self._maybe_flush()
+
+    def flush(self, sync_token=None):
+        '''
+        saves the changes made since the last flush to the store, in one transaction
+        '''
+        with self._lock:
+            if self.store is None or not (self._dirty or self._replace or sync_token):
+                return
+            try:
+                self.store.write(self.calendar_id, self._dirty, sync_token=sync_token,
+                    synced_at=self.synced_at, replace=self._replace)
+            except Exception:
+                # the index itself is still right, and the store can be rebuilt
+                self.logger.error("Couldn't save sync state for calendar %s", self.calendar_id, exc_info=True)
+                return
+            self._dirty.clear()
+            self._replace = False
+            self._flushed_at = time.time()
+
+    def _maybe_flush(self):
+        if (len(self._dirty) >= self.FLUSH_SIZE or
+                time.time() - self._flushed_at > self.FLUSH_INTERVAL):
+            self.flush()
+
+    def ensure_current(self):
+        '''
+        builds the index the first time, and catches up with google once it gets stale
+        '''
+        with self._lock:
+            if self.sync_token is None and self.store is not None:
+                self.load()
+            if self.sync_token is None:
+                self.build()
+            elif time.time() - self.synced_at > self.refresh_interval:
+                self.sync()
+
+    def expire(self):
+        '''
+        makes the next ensure_current catch up with google, however recently it did
+        '''
+        with self._lock:
+            if self.synced_at is not None:
+                self.synced_at = 0
+
+    def load(self):
+        '''
+        fills the index from the store, if it has anything saved for the calendar
+        '''
+        with self._lock:
+            try:
+                sync_token, synced_at, entries = self.store.load(self.calendar_id)
+            except Exception:
+                self.logger.error("Couldn't load sync state for calendar %s", self.calendar_id, exc_info=True)
+                return
+            if sync_token is None:
+                return
+
+            self._clear()
+            for event_id, ftrack_type, ftrack_id, project_id, body_hash in entries:
+                self._add(event_id, (ftrack_type, ftrack_id), project_id, body_hash)
+            self._dirty.clear()
+            self.sync_token = sync_token
+            self.synced_at = synced_at
+            self.logger.info("Loaded %d events for calendar %s from the sync state store",
+                len(self._keys), self.calendar_id)
+
+    def build(self):
+        '''
+        (re)builds the index from a full listing of the calendar
+        '''
+        with self._lock:
+            self.logger.info("Building event index for calendar %s", self.calendar_id)
+            self._clear()
+            # the store gets the same fresh start the next time it's flushed
+            self._replace = True
+            self._list_events()
+            self.logger.info("Indexed %d events on calendar %s", len(self._keys), self.calendar_id)
+
+    def sync(self):
+        '''
+        applies whatever changed on the calendar since the last listing
+        '''
+        with self._lock:
+            try:
+                self._list_events(sync_token=self.sync_token)
+            except errors.HttpError as e:
+                if e.resp.status != 410:
+                    raise
+                # google expired our sync token, so start over
+                self.logger.warning("Sync token for calendar %s expired, rebuilding index", self.calendar_id)
+                self.build()
+
+    def _list_events(self, sync_token=None):
+        page_token = None
+        while True:
+            kwargs = {
+                'calendarId': self.calendar_id,
+                'maxResults': self.PAGE_SIZE,
+                'fields': self.LIST_FIELDS,
+                'pageToken': page_token,
+            }
+            if sync_token is not None:
+                kwargs['syncToken'] = sync_token
+
+            response = self.execute(self.calendar_service.events().list(**kwargs))
+            for event in response.get('items', []):
+                self._apply(event)
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        self.sync_token = response.get('nextSyncToken')
+        self.synced_at = time.time()
+        self.flush(sync_token=self.sync_token)
+
+    def _apply(self, event):
+        if event.get('status') == 'cancelled':
+            self._discard(event['id'])
+            return
+
+        properties = event.get('extendedProperties', {}).get('private', {})
+        if 'ftrack_id' not in properties or 'ftrack_type' not in properties:
+            # not one of ours
+            return
+
+        key = (properties['ftrack_type'], properties['ftrack_id'])
+        self._add(event['id'], key, properties.get(PROJECT_PROPERTY), properties.get(HASH_PROPERTY))
+
+    def _add(self, event_id, key, project_id, body_hash):
+        if self._keys.get(event_id) not in (None, key):
+            self._discard(event_id)
+        self._keys[event_id] = key
+        self._hashes[event_id] = body_hash
+        self._projects[event_id] = project_id
+        self._events.setdefault(key, set()).add(event_id)
+        self._dirty[event_id] = key + (project_id, body_hash)
+
+    def _clear(self):
+        self._events.clear()
+        self._keys.clear()
+        self._hashes.clear()
+        self._projects.clear()
+        self._dirty.clear()
+
+    def _discard(self, event_id):
+        self._hashes.pop(event_id, None)
+        self._projects.pop(event_id, None)
+        key = self._keys.pop(event_id, None)
+        if key is None:
+            return
+        self._dirty[event_id] = None
+        event_ids = self._events.get(key, set())
+        event_ids.discard(event_id)
+        if not event_ids:
+            self._events.pop(key, None)
@@ -0,0 +1,221 @@
+'''
+
+Event Journal
+
+An append-only file of the ftrack updates the calendar updater has accepted,
+one JSON line each, with a checkpoint of how far through them it has got.
+Updates that were still queued or being synced when the process stopped are
+replayed from it on the next start, and the checkpoint's time says what the
+catch-up after downtime has to cover.
+
+Entries at or below the checkpoint are dropped from the file whenever enough
+of them have built up, by writing what's left to a new file and swapping it in.
+
+'''
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import simplejson as json
+
+
+def replace_file(source, destination):
+    '''
+    moves source over destination, as atomically as the platform allows
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+        return
+    if os.name == 'nt' and os.path.exists(destination):
+        # rename won't overwrite on windows before python 3.3
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class EventJournal(object):
+    '''
+    Journal of accepted updates, kept at ``path`` with the checkpoint beside it.
+
+    Each update is appended under a sequence number, and marked ``done`` once
+    it's synced. Updates finish out of order, so the checkpoint is the highest
+    sequence number with everything up to it done. Marking an update done also
+    covers the earlier updates to the same entity, since the sync read its
+    latest state anyway.
+
+    The checkpoint is written at most every ``checkpoint_interval`` seconds, and
+    on close. After a crash, updates done past the checkpoint are replayed too,
+    which only costs an ftrack query, since unchanged events aren't written again.
+    '''
+
+    def __init__(self, path, logger=None, compact_size=1000, checkpoint_interval=5.0, fsync=False):
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.logger = logger or logging.getLogger(__name__)
+        self.compact_size = compact_size
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        # seq -> key, of the entries not done yet, in order
+        self._pending = collections.OrderedDict()
+        self._by_key = collections.defaultdict(set)
+        self._saved_at = 0
+        self._written = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.offset, last, self.checkpoint_time = self._read_checkpoint()
+        self._unprocessed = self._read_entries()
+        # numbers are never reused, even for entries compacted away
+        self._last = max([self.offset, last] + [seq for seq, _, _ in self._unprocessed])
+        for seq, received_at, entity in self._unprocessed:
+            self._track(seq, entity['entityId'])
+
+        # start from a file holding only what's left
+        self._file = None
+        self.compact()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def unprocessed(self):
+        '''
+        returns [(seq, received_at, entity)] for the updates that weren't done when the
+        journal was last closed, oldest first -- they're still pending until marked done
+        '''
+        return list(self._unprocessed)
+
+    def append(self, entity, received_at=None):
+        '''
+        journals an update, and returns its sequence number
+        '''
+        received_at = received_at if received_at is not None else time.time()
+        with self._lock:
+            self._last += 1
+            seq = self._last
+            self._file.write(json.dumps({'seq': seq, 'at': received_at, 'entity': entity}) + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._written += 1
+            self._track(seq, entity['entityId'])
+            return seq
+
+    def done(self, seq):
+        '''
+        marks the update done, along with any earlier updates to the same entity
+        '''
+        with self._lock:
+            key = self._pending.get(seq)
+            if key is None:
+                return
+            seqs = self._by_key[key]
+            for finished in [s for s in seqs if s <= seq]:
+                seqs.discard(finished)
+                del self._pending[finished]
+            if not seqs:
+                del self._by_key[key]
+
+            self.offset = next(iter(self._pending)) - 1 if self._pending else self._last
+            due = time.time() - self._saved_at >= self.checkpoint_interval
+            compact = self._written - len(self._pending) >= self.compact_size
+
+        if compact:
+            self.compact()
+        elif due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''
+        saves how far through the journal we are, and when
+        '''
+        with self._lock:
+            self._write_checkpoint()
+
+    def compact(self):
+        '''
+        rewrites the journal with only the entries after the checkpoint
+        '''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+
+            kept = []
+            if os.path.exists(self.path):
+                kept = [line for seq, line in self._lines() if seq in self._pending]
+
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as temp:
+                temp.writelines(kept)
+                temp.flush()
+                os.fsync(temp.fileno())
+            replace_file(temp_path, self.path)
+
+            self._file = open(self.path, 'a')
+            self._written = len(kept)
+            self._write_checkpoint()
+
+    def close(self):
+        '''
+        compacts the journal, so only what's unfinished is replayed, and closes it
+        '''
+        self.compact()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _track(self, seq, key):
+        # caller must hold the lock, or be __init__
+        self._pending[seq] = key
+        self._by_key[key].add(seq)
+
+    def _write_checkpoint(self):
+        # caller must hold the lock
+        now = time.time()
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as temp:
+            json.dump({'offset': self.offset, 'last': self._last, 'at': now}, temp)
+        replace_file(temp_path, self.checkpoint_path)
+        self._saved_at = now
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0, 0, None
+        try:
+            with open(self.checkpoint_path) as checkpoint:
+                data = json.load(checkpoint)
+            return int(data['offset']), int(data.get('last', 0)), data['at']
+        except Exception:
+            self.logger.error("Couldn't read the journal checkpoint, replaying the whole journal", exc_info=True)
+            return 0, 0, None
+
+    def _lines(self):
+        '''
+        yields (seq, line) for the entries in the file, skipping any that can't be read
+        '''
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    seq = json.loads(line)['seq']
+                except Exception:
+                    # most likely the last line, cut short when the process died
+                    self.logger.warning("Skipping unreadable journal entry: %r", line[:200])
+                    continue
+                yield seq, line
+
+    def _read_entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        for seq, line in self._lines():
+            if seq > self.offset:
+                entry = json.loads(line)
+                entries.append((seq, entry['at'], entry['entity']))
+        return entries
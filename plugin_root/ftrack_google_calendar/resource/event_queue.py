@@ -0,0 +1,290 @@
+'''
+
+Event Queues
+
+Queues that sit between the ftrack event hub and the calendar sync, so bursts
+of updates to the same entity turn into a single Google write, and so the
+event hub never waits on Google.
+
+'''
+
+import collections
+import logging
+import sys
+import threading
+import time
+
+import six
+from six.moves import queue
+
+
+class CoalescingQueue(object):
+    '''
+    Collapses items submitted under the same key within ``window`` seconds, so
+    only the latest one is handed to ``handler``.
+
+    The first item for a key sets when the key is due, and later items only
+    replace it -- or with ``merge``, are combined with it through
+    merge(pending, item) -- so a steady stream of updates is still synced at
+    least once per window. At most ``max_pending`` keys are held; past that, submitting waits
+    for the oldest keys to be handled.
+
+    ``handler`` is called on the queue's own thread with the list of items that
+    came due together.
+    '''
+
+    def __init__(self, handler, window=2.0, max_pending=1000, logger=None, merge=None):
+        self.handler = handler
+        self.merge = merge
+        self.window = window
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._closed = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, key, item):
+        '''
+        queues the item, replacing (or merging with) anything still pending under the same key
+        '''
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Queue is closed")
+
+            if key in self._pending:
+                due, pending = self._pending[key]
+                self._pending[key] = (due, self.merge(pending, item) if self.merge is not None else item)
+                return
+
+            while len(self._pending) >= self.max_pending and not self._closed:
+                # hurry the oldest keys along, and wait for room
+                oldest = next(iter(self._pending))
+                self._pending[oldest] = (0, self._pending[oldest][1])
+                self._cond.notify_all()
+                self._cond.wait()
+
+            self._pending[key] = (time.time() + self.window, item)
+            self._start()
+            self._cond.notify_all()
+
+    def flush(self):
+        '''
+        handles everything pending right away, on the calling thread
+        '''
+        with self._cond:
+            items = [item for due, item in self._pending.values()]
+            self._pending.clear()
+            self._cond.notify_all()
+        self._dispatch(items)
+
+    def close(self, timeout=None):
+        '''
+        stops taking items, and waits for everything pending to be handled
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join(timeout)
+        # anything left if the thread never ran, or timed out
+        self.flush()
+
+    def _start(self):
+        # caller must hold the lock
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="CoalescingQueue")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._closed or (self._pending and next(iter(self._pending.values()))[0] <= now):
+                        break
+                    timeout = next(iter(self._pending.values()))[0] - now if self._pending else None
+                    self._cond.wait(timeout)
+
+                if self._closed and not self._pending:
+                    return
+
+                items = []
+                for key, (due, item) in list(self._pending.items()):
+                    if due > now and not self._closed:
+                        break
+                    items.append(item)
+                    del self._pending[key]
+                self._cond.notify_all()
+
+            self._dispatch(items)
+
+    def _dispatch(self, items):
+        if not items:
+            return
+        try:
+            self.handler(items)
+        except Exception:
+            self.logger.error("Error handling %d queued items", len(items), exc_info=True)
+
+
+class KeyedWorkerPool(object):
+    '''
+    A fixed set of worker threads, each with its own queue of at most
+    ``queue_size`` items.
+
+    Work is routed to a worker by hashing its key, so work for the same key
+    always runs in the order it was submitted. Submitting blocks while that
+    worker's queue is full, which pushes back on whoever is submitting.
+
+    Given a metrics registry, how long each item waited and ran is observed
+    under the pool's name.
+    '''
+
+    def __init__(self, size=4, queue_size=100, name="Worker", logger=None, metrics=None):
+        self.size = size
+        self.name = name
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = collections.Counter()
+        self._max_wait = 0.0
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(size)]
+        self._threads = []
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(work_queue,),
+                name="{}-{}".format(name, index)
+            )
+            # closed through close(), since the interpreter joins non-daemon threads before atexit
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, *args, **kwargs):
+        '''
+        queues fn(*args, **kwargs) on the worker that owns the key
+        '''
+        if self._closed:
+            raise RuntimeError("Worker pool is closed")
+
+        work_queue = self._queues[hash(key) % self.size]
+        work_queue.put((time.time(), fn, args, kwargs))
+        with self._lock:
+            self._stats['submitted'] += 1
+
+    def depth(self):
+        '''
+        returns how many items are waiting across all the workers
+        '''
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def stats(self):
+        '''
+        returns queue depth, counts, and the time items spent waiting and running
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['max_wait_seconds'] = self._max_wait
+
+        finished = stats.get('completed', 0) + stats.get('failed', 0)
+        stats['depth'] = self.depth()
+        stats['avg_wait_seconds'] = stats.get('wait_seconds', 0.0) / finished if finished else 0.0
+        stats['avg_run_seconds'] = stats.get('run_seconds', 0.0) / finished if finished else 0.0
+        return stats
+
+    def close(self, timeout=None):
+        '''
+        stops taking work, and waits for the workers to finish what's queued
+        '''
+        self._closed = True
+        for work_queue in self._queues:
+            work_queue.put(None)
+
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+    def _run(self, work_queue):
+        while True:
+            work = work_queue.get()
+            if work is None:
+                return
+
+            queued_at, fn, args, kwargs = work
+            started = time.time()
+            try:
+                fn(*args, **kwargs)
+                outcome = 'completed'
+            except Exception:
+                self.logger.error("Error running queued work", exc_info=True)
+                outcome = 'failed'
+
+            finished = time.time()
+            with self._lock:
+                self._stats[outcome] += 1
+                self._stats['wait_seconds'] += started - queued_at
+                self._stats['run_seconds'] += finished - started
+                self._max_wait = max(self._max_wait, started - queued_at)
+
+            if self.metrics is not None:
+                self.metrics.observe('worker_wait_seconds', started - queued_at, pool=self.name)
+                self.metrics.observe('worker_run_seconds', finished - started, pool=self.name)
+
+
+class WorkGroup(object):
+    '''
+    Keeps track of a known set of work items spread across worker pools, and
+    calls ``on_done(results)`` once every one of them has run.
+
+    ``results`` maps each item's key to (result, exception), so the outcome of
+    the whole group can be reported in one place. on_done is called on the
+    thread that ran the last item.
+    '''
+
+    def __init__(self, keys, on_done, logger=None):
+        self.on_done = on_done
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._remaining = set(keys)
+        self._results = {}
+
+    def run(self, key, fn, *args, **kwargs):
+        '''
+        runs fn(*args, **kwargs) as the item with the key, recording how it went
+        '''
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            self._finish(key, (None, e))
+            six.reraise(*exc_info)
+
+        self._finish(key, (result, None))
+        return result
+
+    def _finish(self, key, outcome):
+        with self._lock:
+            self._results[key] = outcome
+            self._remaining.discard(key)
+            if self._remaining:
+                return
+            results = dict(self._results)
+
+        try:
+            self.on_done(results)
+        except Exception:
+            self.logger.error("Error finishing work group", exc_info=True)
@@ -0,0 +1,114 @@
+'''
+
+Google Batch Requests
+
+Groups Google API calls into batch HTTP requests, so that syncing a whole
+project doesn't cost a separate HTTPS round-trip per call.
+
+'''
+
+import itertools
+import logging
+
+from google_client import is_rate_limited, is_retryable_error
+
+
+def chunked(iterable, size):
+    '''
+    yields lists of up to size items from the iterable
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchExecutor(object):
+    '''
+    Executes a list of keyed Google API requests through batch HTTP requests.
+
+    Items that fail with a retryable error are collected and sent again in a
+    later batch, so a partial failure only re-sends the calls that failed. Every
+    item counts against the request executor's rate limit, and retries wait out
+    its backoff. Batches go out over ``http_pool`` when it's given, instead of
+    the executor's own connections.
+    '''
+
+    # the most calls google accepts in a single calendar batch request
+    MAX_BATCH_SIZE = 50
+
+    def __init__(self, calendar_service, executor, logger=None, batch_size=MAX_BATCH_SIZE,
+                 max_retries=3, http_pool=None):
+        self.calendar_service = calendar_service
+        self.executor = executor
+        self.http_pool = http_pool
+        self.logger = logger or logging.getLogger(__name__)
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+
+    def execute(self, requests, callback=None):
+        '''
+        Executes (key, request) pairs, calling callback(key, response, exception)
+        once for every item as soon as its result is final.
+
+        Returns a dict of key -> response for the items that succeeded.
+        '''
+        results = {}
+        pending = list(requests)
+        attempt = 0
+
+        while pending:
+            retry = []
+            retry_error = None
+            for chunk in chunked(pending, self.batch_size):
+                outcomes = self._execute_batch(chunk)
+
+                for index, (key, request) in enumerate(chunk):
+                    response, exception = outcomes[index]
+                    if is_rate_limited(exception):
+                        self.executor.count('throttled')
+
+                    if (exception is not None and attempt < self.max_retries
+                            and is_retryable_error(exception)):
+                        retry.append((key, request))
+                        retry_error = exception
+                        continue
+
+                    if exception is None:
+                        results[key] = response
+                    if callback is not None:
+                        callback(key, response, exception)
+
+            if retry:
+                self.logger.warning("Retrying %d failed batch items (attempt %d)",
+                    len(retry), attempt + 1)
+                self.executor.back_off(attempt, retry_error, count=len(retry))
+                attempt += 1
+            pending = retry
+
+        return results
+
+    def _execute_batch(self, chunk):
+        '''
+        sends one batch, and returns a list of (response, exception) in chunk order
+        '''
+        outcomes = [(None, None)] * len(chunk)
+
+        def collect(request_id, response, exception):
+            outcomes[int(request_id)] = (response, exception)
+
+        batch = self.calendar_service.new_batch_http_request()
+        for index, (key, request) in enumerate(chunk):
+            batch.add(request, callback=collect, request_id=str(index))
+
+        try:
+            self.executor.acquire(len(chunk))
+            self.executor.send(batch, self.http_pool)
+        except Exception as e:
+            # the batch as a whole didn't make it, so every item in it failed
+            self.logger.warning("Batch request of %d items failed", len(chunk), exc_info=True)
+            outcomes = [(None, e)] * len(chunk)
+
+        return outcomes
@@ -13,13 +13,30 @@ import httplib2
 import simplejson as json
 import os
 import re
+import collections
+import threading
+import time
+import weakref
 import logging, logging.handlers
-from apiclient import discovery, errors
+from apiclient import errors
 from oauth2client.service_account import ServiceAccountCredentials
-import ftrack_api
 import arrow
 import colour
 
+from calendar_cache import CalendarRegistry, ColorPalette
+from google_client import RequestExecutor, TokenBucket, HttpPool, build_calendar_service
+from google_batch import BatchExecutor, chunked
+from event_index import EventIndex, HASH_PROPERTY, PROJECT_PROPERTY, entity_event_id, event_hash
+from session_pool import SessionPool, create_session
+from sync_state import SyncStateStore
+from schema_aliases import SchemaAliasIndex
+from job_progress import JobProgress
+from metrics import MetricsRegistry
+from user_calendars import UserCalendars
+from event_queue import CoalescingQueue, KeyedWorkerPool, WorkGroup
+from event_journal import EventJournal
+from coordination import ShardCoordinator
+
 class CalendarUpdater(object):
     '''
     The calendar updater initializes a connection to a Google Service Account
@@ -34,117 +51,1406 @@ class CalendarUpdater(object):
     This also relies on the standard FTRACK_SERVER_URL, FTRACK_API_KEY and 
     FTRACK_API_USER vars
 
+    Either side can be swapped out instead, by passing in a calendar service to
+    use in place of the service account's, and a factory for the ftrack sessions
+    (and, for DELEGATED_CALENDARS, a factory for the calendar service of each user)
+
     '''
 
     # this is relative to the root of the plugin
     LOG_DIR = "logs"
     LOG_LEVEL = logging.DEBUG
 
-    def __init__(self):
+    # where the google discovery document is cached (or bundled), relative to the
+    # root of the plugin
+    DISCOVERY_CACHE_DIR = "cache"
+
+    # name of the shared calendar that every entity is pushed to
+    TEAM_CALENDAR_NAME = "ftrack"
+
+    # how long a resolved calendar id (and its sharing) is trusted, in seconds
+    CALENDAR_CACHE_TTL = 60 * 60
+
+    # shared by every updater in the process
+    calendar_registry = CalendarRegistry(ttl=CALENDAR_CACHE_TTL)
+
+    # google's color palette hardly ever changes, and a project's colour is the same for all its tasks
+    COLOR_PALETTE_TTL = 24 * 60 * 60
+    COLOR_MEMO_SIZE = 256
+    color_palette = ColorPalette(ttl=COLOR_PALETTE_TTL, size=COLOR_MEMO_SIZE)
+
+    # the calendar api allows around 5 requests a second per user, so stay just under
+    # that, letting short bursts through -- users whose calendars we write to as them,
+    # with DELEGATED_CALENDARS, are each held to the same limit of their own
+    GOOGLE_REQUESTS_PER_SECOND = 5.0
+    GOOGLE_BURST = 10
+    GOOGLE_MAX_RETRIES = 5
+    # shared by every updater in the process, since they share the quota
+    google_rate_limit = TokenBucket(GOOGLE_REQUESTS_PER_SECOND, GOOGLE_BURST)
+
+    # push whole projects through google batch requests instead of one call at a time
+    BATCH_WHOLE_PROJECT = True
+    BATCH_SIZE = BatchExecutor.MAX_BATCH_SIZE
+
+    # what a whole-project sync covers: (category, entity type, criteria for the contexts)
+    SYNC_CATEGORIES = [
+        # if the project is selected, it will match for the calendar event
+        ("CalendarEvents", "CalendarEvent", "project has ({})"),
+        ("Milestones", "Milestone", "ancestors any ({})"),
+        ("Tasks", "Task", "ancestors any ({})"),
+    ]
+
+    # launched syncs show their progress as an ftrack Job, updated at most this often
+    # in seconds -- killing the Job stops the sync
+    JOB_PROGRESS = True
+    JOB_UPDATE_INTERVAL = 5.0
+
+    # whole projects are read from ftrack this many entities at a time, and each page
+    # is dropped from the session once it's synced, so memory stays flat however big
+    # the project is -- 0 reads each category in one go
+    QUERY_PAGE_SIZE = 500
+
+    # also put each event straight onto the primary calendar of everyone assigned to it,
+    # by impersonating them -- needs domain-wide delegation for the service account
+    DELEGATED_CALENDARS = False
+    # how many users' credentials and connections are kept around, and how many
+    # connections each may have open
+    USER_CALENDAR_CACHE_SIZE = 500
+    USER_HTTP_POOL_SIZE = 2
+
+    # how stale the event index may get before it's caught up with google, in seconds
+    EVENT_INDEX_REFRESH = 5 * 60
+
+    # the sqlite database the event indexes are saved to, so restarts start warm --
+    # relative to the root of the plugin, and safe to delete
+    SYNC_STATE_PATH = "state/sync-state.db"
+
+    # every accepted update is journaled here before it's queued, so the ones still
+    # queued or in flight when the process stops are synced on the next start --
+    # None to not keep a journal. entries already synced are dropped once there are
+    # JOURNAL_COMPACT_SIZE of them
+    JOURNAL_PATH = "state/event-journal.jsonl"
+    JOURNAL_COMPACT_SIZE = 1000
+    JOURNAL_CHECKPOINT_INTERVAL = 5.0
+    # updates sent while the process was down never reach the journal, so on start the
+    # entities still ending after the last checkpoint (less the margin, in seconds) are
+    # synced again: (category, entity type, criteria for the date)
+    CATCH_UP_MARGIN = 5 * 60
+    CATCH_UP_CATEGORIES = [
+        ("CalendarEvents", "CalendarEvent", "end >= '{}'"),
+        ("Milestones", "Milestone", "end_date >= '{}'"),
+        ("Tasks", "Task", "end_date >= '{}'"),
+    ]
+
+    # updates to the same entity within this many seconds are synced once, with
+    # the latest state -- 0 syncs every update as it arrives
+    COALESCE_WINDOW = 2.0
+    # the most entities that may be waiting out the window at once
+    COALESCE_MAX_PENDING = 1000
+
+    # threads syncing updates off the event hub's thread, and how much work each may
+    # have waiting before the hub is made to wait
+    WORKER_COUNT = 4
+    WORKER_QUEUE_SIZE = 100
+    # whole-project syncs get their own workers, so they don't hold up updates. with
+    # PARALLEL_SYNC each selected project and category is synced on its own, so this
+    # is also how many of them run at once
+    PROJECT_WORKER_COUNT = 4
+    PARALLEL_SYNC = True
+
+    # how many ftrack sessions, and keep-alive google connections, may be open at
+    # once -- enough for every worker to have its own
+    SESSION_POOL_SIZE = WORKER_COUNT + PROJECT_WORKER_COUNT
+    HTTP_POOL_SIZE = WORKER_COUNT + PROJECT_WORKER_COUNT
+
+    # timings and counts of everything the updater does, shared by every updater in the process
+    metrics = MetricsRegistry()
+    # serve them in the prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+    # (0 to not serve them), and/or write them to METRICS_FILE every METRICS_FILE_INTERVAL
+    # seconds (relative to the root of the plugin, None to not write them)
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PORT = 0
+    METRICS_FILE = None
+    METRICS_FILE_INTERVAL = 60
+
+    # the keys of an ftrack.update that change the calendar event, by entity type.
+    # ftrack names some keys after the old database columns, so both spellings are listed
+    RELEVANT_KEYS = {
+        'task': [
+            'name', 'description', 'startdate', 'enddate', 'start_date', 'end_date',
+            'parent_id', 'parentid'
+        ],
+        'calendarevent': [
+            'name', 'start', 'end', 'leave', 'project_id', 'projectid'
+        ],
+        'typedcontext': [],
+        # the project, whose colour colours every event in it
+        'show': ['color', 'fullname', 'full_name'],
+    }
+    # the keys that mean an entity was moved, so everything under it is synced again
+    MOVE_KEYS = ['parent_id', 'parentid']
+    # the ftrack types an entity removed from ftrack may have been on the calendar as,
+    # since it can't be loaded any more to find out
+    REMOVED_TYPES = {
+        'task': ['Task', 'Milestone'],
+        'typedcontext': ['Task', 'Milestone'],
+        'calendarevent': ['CalendarEvent'],
+    }
+
+    # with COORDINATION, every updater sharing COORDINATION_PATH (on one machine, or a shared
+    # disk) holds a lease there, renewed every third of COORDINATION_LEASE seconds, and the
+    # live ones share out the updates by entity id so each is synced once. the longest
+    # running one also answers actions and sweeps for orphans, and a sync of many entities
+    # is handed to every instance, each syncing only its own share. INSTANCE_ID names this one,
+    # and gives it its own journal -- the default, from the host name and process id, is
+    # different every start, so give each instance a fixed one to have its journal replayed
+    COORDINATION = False
+    COORDINATION_PATH = "state/coordination.db"
+    COORDINATION_LEASE = 30.0
+    INSTANCE_ID = os.environ.get('FTRACK_CALENDAR_INSTANCE_ID')
+
+    # how often, in seconds, every event on the calendar is checked for an entity that's
+    # gone from ftrack without us hearing about it, and deleted if so -- 0 to never.
+    # entities are looked up ORPHAN_SWEEP_BATCH at a time
+    ORPHAN_SWEEP_INTERVAL = 6 * 60 * 60
+    ORPHAN_SWEEP_BATCH = 100
+
+    # everything entity_to_event reads, so it's loaded along with the entity
+    # instead of lazily, one query at a time
+    EVENT_PROJECTIONS = {
+        'Task': [
+            'name', 'start_date', 'end_date', 'description',
+            'project.full_name', 'project.color', 'assignments.resource'
+        ],
+        'Milestone': [
+            'name', 'start_date', 'end_date', 'description',
+            'project.full_name', 'project.color', 'assignments.resource'
+        ],
+        'CalendarEvent': [
+            'name', 'start', 'end', 'leave',
+            'project.full_name', 'project.color', 'calendar_event_resources.resource'
+        ],
+    }
+
+    def __init__(self, calendar_service=None, session_factory=create_session, user_service_factory=None):
 
         self.logger = self.setup_logging(__name__)
-        
+
+        # whatever has started by the time something fails is stopped again by shutdown,
+        # so a failed start doesn't leave threads (or metrics) behind
+        self._stopping = threading.Event()
+        self.sync_state = self.sessions = self.workers = self.project_workers = None
+        self.update_queue = self.coordinator = self.journal = None
+        self.event_indexes = {}
+        self._metrics_server = None
+        self._collecting = False
+        try:
+            self._setup(calendar_service, session_factory, user_service_factory)
+        except Exception:
+            self.logger.error("Couldn't start the calendar updater, stopping what had started", exc_info=True)
+            self.shutdown()
+            raise
+
+    def _setup(self, calendar_service, session_factory, user_service_factory):
         self.logger.info("Initializing Google API Credentials")
 
         # create the calendar api service
         try:
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-                json.loads(os.environ['GOOGLE_SERVICE_AUTH'].replace("'","\"")),
-                scopes = 'https://www.googleapis.com/auth/calendar'
+            http_pool = None
+            user_http_pool_factory = None
+            if calendar_service is None:
+                credentials = ServiceAccountCredentials.from_json_keyfile_dict(
+                    json.loads(os.environ['GOOGLE_SERVICE_AUTH'].replace("'","\"")),
+                    scopes = 'https://www.googleapis.com/auth/calendar'
+                )
+                calendar_service = build_calendar_service(
+                    credentials,
+                    self.plugin_path(self.DISCOVERY_CACHE_DIR),
+                    logger=self.logger
+                )
+                http_pool = HttpPool(credentials, size=self.HTTP_POOL_SIZE)
+
+                # users' own calendars are written as them
+                user_service_factory = user_service_factory or (lambda email: build_calendar_service(
+                    credentials.create_delegated(email),
+                    self.plugin_path(self.DISCOVERY_CACHE_DIR),
+                    logger=self.logger
+                ))
+                user_http_pool_factory = lambda email: HttpPool(
+                    credentials.create_delegated(email), size=self.USER_HTTP_POOL_SIZE)
+            self.calendar_service = calendar_service
+
+            # every google call goes through here, sharing one rate limit and a
+            # pool of connections the workers can use at the same time
+            self.google = RequestExecutor(
+                self.google_rate_limit,
+                logger=self.logger,
+                max_retries=self.GOOGLE_MAX_RETRIES,
+                http_pool=http_pool,
+                metrics=self.metrics
+            )
+            self.batch = BatchExecutor(
+                self.calendar_service,
+                self.google,
+                logger=self.logger,
+                batch_size=self.BATCH_SIZE
             )
-            self.calendar_service = discovery.build('calendar', 'v3', credentials=credentials)
+            self.event_indexes = {}
+            self.sync_state = self.open_sync_state()
+
+            self.user_calendars = None
+            if self.DELEGATED_CALENDARS and user_service_factory is not None:
+                self.user_calendars = UserCalendars(
+                    user_service_factory,
+                    self.google,
+                    http_pool_for=user_http_pool_factory,
+                    store=self.sync_state,
+                    logger=self.logger,
+                    batch_size=self.BATCH_SIZE,
+                    cache_size=self.USER_CALENDAR_CACHE_SIZE,
+                    bucket_for=lambda email: TokenBucket(self.GOOGLE_REQUESTS_PER_SECOND, self.GOOGLE_BURST)
+                )
             self.logger.info("Successfully connected to Google.")
         except Exception as e:
             self.logger.error("Ran into some trouble connecting to Google", exc_info=True)
             raise e
+
+        # long-lived ftrack sessions, so each event reuses schemas and connections
+        self.sessions = SessionPool(size=self.SESSION_POOL_SIZE, factory=session_factory, logger=self.logger)
+        # schema alias lookups, built once for each session's schemas
+        self.schema_aliases = weakref.WeakKeyDictionary()
+        self._schema_lock = threading.Lock()
+
+        # how many calendar writes were made, and how many were skipped as unchanged
+        self.sync_stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+        # syncs updates and whole projects in the background, in order per entity
+        self.workers = KeyedWorkerPool(
+            size=self.WORKER_COUNT,
+            queue_size=self.WORKER_QUEUE_SIZE,
+            name="CalendarWorker",
+            logger=self.logger,
+            metrics=self.metrics
+        )
+        self.project_workers = KeyedWorkerPool(
+            size=self.PROJECT_WORKER_COUNT,
+            queue_size=self.WORKER_QUEUE_SIZE,
+            name="ProjectWorker",
+            logger=self.logger,
+            metrics=self.metrics
+        )
+
+        # collapses bursts of updates to the same entity
+        self.update_queue = CoalescingQueue(
+            self.dispatch_updates,
+            window=self.COALESCE_WINDOW,
+            max_pending=self.COALESCE_MAX_PENDING,
+            logger=self.logger,
+            merge=self.coalesce_updates
+        )
+
+        self.setup_metrics()
+
+        self.coordinator = self.open_coordinator()
+        self.journal = self.open_journal()
+        self.recover()
+
+        if self.ORPHAN_SWEEP_INTERVAL:
+            self.start_orphan_sweeper()
+        if self.coordinator is not None:
+            self.coordinator.start()
+
+    def shutdown(self):
+        '''
+        syncs any updates still waiting in the queue, and closes the ftrack sessions --
+        only the first time it's called, and only what had been started
+        '''
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self.update_queue is not None:
+            self.logger.info("Shutting down, flushing %d queued updates", len(self.update_queue))
+            self.update_queue.close()
+        for pool in (self.workers, self.project_workers, self.sessions):
+            if pool is not None:
+                pool.close()
+
+        if self._collecting:
+            self.metrics.uncollect(self.collect_metrics)
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+
+        if self.journal is not None:
+            self.journal.close()
+        # last, so the others only take over once everything we accepted is synced
+        if self.coordinator is not None:
+            self.coordinator.release()
+
+        for index in list(self.event_indexes.values()):
+            index.flush()
+        if self.sync_state is not None:
+            self.sync_state.close()
+
+    def open_sync_state(self):
+        '''
+        opens the sync state store, or returns None (and runs without one) if it can't be
+        '''
+        try:
+            return SyncStateStore(self.plugin_path(self.SYNC_STATE_PATH), logger=self.logger)
+        except Exception as e:
+            self.logger.error("Couldn't open the sync state store, every start will list the calendar",
+                exc_info=True)
+            return None
+
+    def open_coordinator(self):
+        '''
+        joins the other instances, with COORDINATION -- returns None without it
+        '''
+        if not self.COORDINATION:
+            return None
+        coordinator = ShardCoordinator(
+            self.plugin_path(self.COORDINATION_PATH),
+            instance_id=self.INSTANCE_ID,
+            lease_seconds=self.COORDINATION_LEASE,
+            logger=self.logger,
+            on_change=self.rebalance,
+            on_handoff=self.take_handoff
+        )
+        self.logger.info("Joined as instance %s of %d", coordinator.instance_id, len(coordinator.members))
+        return coordinator
+
+    def rebalance(self, joined, departed):
+        '''
+        called when instances come or go: the others may have written to the calendar, so
+        the indexes catch up with google before they're next used, and the entities of
+        instances that are gone get the same catch-up as after a restart, from their last
+        heartbeat, so updates sent to them before their lease ran out aren't lost
+        '''
+        self.expire_indexes()
+
+        if departed:
+            since = min(departed.values()) - self.CATCH_UP_MARGIN
+            self.project_workers.submit(('catch-up',), self.catch_up, since)
+
+    def owns(self, entity_id):
+        '''
+        whether this instance syncs the entity, which it always does without COORDINATION
+        '''
+        return self.coordinator is None or self.coordinator.owns(entity_id)
+
+    def owned(self, entity):
+        return self.owns(entity['id'])
+
+    def is_leader(self):
+        return self.coordinator is None or self.coordinator.is_leader
+
+    def expire_indexes(self):
+        '''
+        with COORDINATION, makes the event indexes catch up with google before they're next
+        used, since the other instances may have written to the calendars since
+        '''
+        if self.coordinator is None:
+            return
+        for index in list(self.event_indexes.values()):
+            index.expire()
+
+    def share_out(self, work):
+        '''
+        with COORDINATION, hands a sync of many entities (see take_handoff) to the other
+        instances, so each syncs the entities it owns
+        '''
+        if self.coordinator is None:
+            return
+        try:
+            others = self.coordinator.hand_off(work)
+        except Exception as e:
+            self.logger.error("Couldn't hand %s to the other instances", work['kind'], exc_info=True)
+            return
+        if others:
+            self.logger.info("Handed %s to %s", work['kind'], ", ".join(others))
+
+    def take_handoff(self, work):
+        '''
+        runs the share of a sync another instance handed off to us
+        '''
+        self.logger.info("Taking our share of a %s handed off by another instance", work['kind'])
+        if work['kind'] == 'sync':
+            self.sync_selection(work['selection'], share=False)
+        elif work['kind'] == 'reconcile':
+            self.project_workers.submit(tuple(work['context_ids']), self.reconcile_contexts,
+                work['context_ids'], project_ids=work['project_ids'], dry_run=work['dry_run'])
+        else:
+            self.logger.warning("Passing on handed off work of unknown kind %s", work['kind'])
+
+    def open_journal(self):
+        '''
+        opens the event journal, or returns None (and runs without one) if it can't be
+        '''
+        if not self.JOURNAL_PATH:
+            return None
+
+        path = self.plugin_path(self.JOURNAL_PATH)
+        if self.coordinator is not None:
+            # each instance journals only what it accepted
+            root, extension = os.path.splitext(path)
+            path = "{}-{}{}".format(root, self.coordinator.instance_id, extension)
+        try:
+            return EventJournal(
+                path,
+                logger=self.logger,
+                compact_size=self.JOURNAL_COMPACT_SIZE,
+                checkpoint_interval=self.JOURNAL_CHECKPOINT_INTERVAL
+            )
+        except Exception as e:
+            self.logger.error("Couldn't open the event journal, updates in flight on restart will be lost",
+                exc_info=True)
+            return None
+
+    def recover(self):
+        '''
+        syncs the updates the journal says weren't finished when the process last stopped,
+        and catches up on what was missed while it was down
+        '''
+        if self.journal is None:
+            return
+
+        unprocessed = self.journal.unprocessed()
+        if unprocessed:
+            self.logger.info("Replaying %d journaled updates", len(unprocessed))
+            self.dispatch_updates([(received_at, e, seq) for seq, received_at, e in unprocessed])
+
+        if self.journal.checkpoint_time is not None:
+            since = self.journal.checkpoint_time - self.CATCH_UP_MARGIN
+            self.project_workers.submit(('catch-up',), self.catch_up, since)
+
+    def setup_metrics(self):
+        '''
+        describes the metrics, adds the stats kept elsewhere to them, and starts exporting them
+        '''
+        self.metrics.describe('ftrack_query_seconds', 'histogram', "ftrack queries, by entity type")
+        self.metrics.describe('google_request_seconds', 'histogram', "google requests and batches, by api method")
+        self.metrics.describe('color_lookup_seconds', 'histogram', "project colour lookups that missed the memo")
+        self.metrics.describe('color_lookups_total', 'counter', "project colour lookups, by memo hit or miss")
+        self.metrics.describe('worker_wait_seconds', 'histogram', "time work waited for a worker, by pool")
+        self.metrics.describe('worker_run_seconds', 'histogram', "time work ran on a worker, by pool")
+        self.metrics.describe('event_latency_seconds', 'histogram',
+            "time from receiving an ftrack update to it being on the calendar")
+        self.metrics.collect(self.collect_metrics)
+        self._collecting = True
+
+        if self.METRICS_PORT:
+            try:
+                self._metrics_server = self.metrics.serve(self.METRICS_PORT, host=self.METRICS_HOST)
+                self.logger.info("Serving metrics at http://%s:%d/metrics", self.METRICS_HOST, self.METRICS_PORT)
+            except Exception as e:
+                self.logger.error("Couldn't serve metrics on port %d", self.METRICS_PORT, exc_info=True)
+        if self.METRICS_FILE:
+            self.metrics.write_every(self.plugin_path(self.METRICS_FILE), self.METRICS_FILE_INTERVAL,
+                stopping=self._stopping)
+
+    def collect_metrics(self):
+        '''
+        returns the stats kept by the updater and its helpers, as metrics
+        '''
+        for outcome, count in self.get_sync_stats().items():
+            yield 'calendar_writes_total', 'counter', {'outcome': outcome}, count
+        for name, value in self.get_google_stats().items():
+            yield 'google_' + name, 'counter', {}, value
+
+        queues = self.get_queue_stats()
+        yield 'coalescing_pending', 'gauge', {}, queues['coalescing']
+        for pool in ('workers', 'project_workers'):
+            yield 'worker_queue_depth', 'gauge', {'pool': pool}, queues[pool]['depth']
+            for outcome in ('completed', 'failed'):
+                yield 'worker_items_total', 'counter', {'pool': pool, 'outcome': outcome}, queues[pool].get(outcome, 0)
+
+        for calendar, index in list(self.event_indexes.items()):
+            yield 'event_index_size', 'gauge', {'calendar': calendar}, len(index)
+
+        colors = self.color_palette.cache_info()
+        yield 'color_memo_size', 'gauge', {}, colors['size']
+
+    def get_queue_stats(self):
+        '''
+        returns how many updates are waiting to be synced, and how long they've been waiting
+        '''
+        return {
+            'coalescing': len(self.update_queue),
+            'workers': self.workers.stats(),
+            'project_workers': self.project_workers.stats(),
+        }
         
     def handle_ftrack_event(self, event):
         '''
         Handles the processing and routing of an ftrack event
 
+        Relevant updates are queued for COALESCE_WINDOW seconds, so that a burst of
+        updates to one entity is synced once, and then synced on the worker threads
+        so the event hub can move straight on to the next event
         '''
-        self.logger = self.setup_logging(__name__)
         self.logger.info("Received new event with %d entities", len(event['data']['entities']))
-        # an event could contain multiple updates
-        for e in event['data']['entities']:
-            # first, filter out all non-essential events:
-            if e['entityType'] not in ['calendarevent', 'task']:
-                # this is not an event we want
-                self.logger.info("Passing on entity")
-                continue
-            else:
-                self.session = ftrack_api.Session()
+
+        received_at = time.time()
+
+        # first, filter out all non-essential updates, before touching ftrack or google,
+        # and the ones another instance syncs
+        entities = [e for e in self.filter_entities(event) if self.owns(e['entityId'])]
+        if not entities:
+            return
+
+        # journaled first, so they're not lost if we stop before they're synced
+        updates = [(received_at, e, self.journal_update(e, received_at)) for e in entities]
+
+        if self.COALESCE_WINDOW <= 0:
+            self.dispatch_updates(updates)
+            return
+
+        # keyed by id alone, since one entity can come through as more than one type --
+        # a task's own updates as a task, and its assignments as a typedcontext
+        for update in updates:
+            self.update_queue.submit(update[1]['entityId'], update)
+
+    def coalesce_updates(self, pending, update):
+        '''
+        combines an update with the one still queued for the same entity, keeping when
+        the first was received, and the journal entry of the latest, which covers both
+        '''
+        received_at, e, seq = pending
+        return (received_at, self.merge_updates(e, update[1]), update[2] if update[2] is not None else seq)
+
+    def merge_updates(self, earlier, later):
+        '''
+        combines two update payloads for the same entity into one: a removal wins, the
+        keys changed add up, and the type is taken from whichever payload says what the
+        entity really is, rather than the typedcontext assignments come through as
+        '''
+        if later.get('action') == 'remove':
+            return later
+        if earlier.get('action') == 'remove':
+            return earlier
+
+        merged = dict(earlier, **later)
+        if 'objectTypeId' in earlier and 'objectTypeId' not in later:
+            merged['entityType'] = earlier['entityType']
+
+        if earlier.get('keys') is not None or later.get('keys') is not None:
+            keys = list(earlier.get('keys') or [])
+            merged['keys'] = keys + [key for key in later.get('keys') or [] if key not in keys]
+        return merged
+
+    def journal_update(self, entity, received_at):
+        '''
+        appends the update to the journal, and returns its sequence number -- or None
+        if there's no journal, or it couldn't be written
+        '''
+        if self.journal is None:
+            return None
+        try:
+            return self.journal.append(entity, received_at)
+        except Exception as e:
+            self.logger.error("Couldn't journal the update to %s %s", entity['entityType'], entity['entityId'],
+                exc_info=True)
+            return None
+
+    def dispatch_updates(self, updates):
+        '''
+        hands each (received_at, entity, journal seq) update to the worker that owns its entity
+        '''
+        for received_at, e, seq in updates:
+            self.workers.submit(e['entityId'], self.sync_updates, [e],
+                received_at=received_at, journal_seq=seq)
+
+    def sync_updates(self, entities, received_at=None, journal_seq=None):
+        '''
+        Puts the entities of (filtered) ftrack.update payloads on the calendar
+
+        how long they took to get there since received_at is observed as the event latency,
+        and the journal entry they came from is marked done -- even if the sync failed,
+        since syncing it again on the next start won't make it work
+        '''
+        try:
+            self._sync_updates(entities)
+        finally:
+            if received_at is not None:
+                self.metrics.observe('event_latency_seconds', time.time() - received_at)
+            if journal_seq is not None:
+                self.journal.done(journal_seq)
+
+    def _sync_updates(self, entities):
+        # a project colour change recolours every event in the project
+        for e in entities:
+            if e['entityType'] == 'show':
+                self.logger.info("Colour of project %s changed, syncing the whole project", e['entityId'])
+                self.sync_selection([e])
+
+        entities = [e for e in entities if e['entityType'] != 'show']
+
+        # removed entities can't be loaded, so their events are found from the index
+        removed = [e for e in entities if e.get('action') == 'remove']
+        if removed:
+            self.remove_from_calendar(removed)
+
+        entities = [e for e in entities if e.get('action') != 'remove']
+        if not entities:
+            return
+
+        # synced once the session is back in the pool, since queueing them can wait
+        # on project workers that need a session themselves
+        moved = []
+        with self.sessions.session() as session:
+            for e in entities:
                 # transform the data from the event into an api object
-                entity = self.session.get(
-                    self.get_entity_type(e), 
+                entity = self.fetch_entity(
+                    session,
+                    self.get_entity_type(e, session), 
                     e['entityId']
                 )
+                if entity is None:
+                    self.logger.warning("Couldn't find %s %s in ftrack", e['entityType'], e['entityId'])
+                    continue
+
+                if entity.entity_type not in self.EVENT_PROJECTIONS:
+                    # contexts like shots and sequences come through as tasks too, and
+                    # when one is moved, so is everything under it
+                    if set(e.get('keys') or []) & set(self.MOVE_KEYS):
+                        self.logger.info("%s %s moved, syncing everything under it", entity.entity_type, entity['id'])
+                        moved.append(e)
+                    else:
+                        self.logger.info("Passing on %s %s", entity.entity_type, entity['id'])
+                    continue
     
                 # now that we're sure that we have an event we want, do the thing
                 self.logger.debug("Putting %s %s on Calendar", entity.entity_type, entity['name'])
                 self.put_on_calendar(entity)
 
+        if moved:
+            self.sync_selection(moved)
+
+    def filter_entities(self, event):
+        '''
+        Picks out the entities of an ftrack.update event that are worth syncing,
+        using only the event payload, so irrelevant updates cost no I/O at all
+
+        Updates pass when one of the keys they changed is listed in RELEVANT_KEYS
+        for their entity type (or when the event doesn't say which keys changed).
+        Assignment changes are turned into an update of the assigned task, and
+        several updates to one entity are merged into one.
+        '''
+        entities = collections.OrderedDict()
+
+        def keep(e):
+            pending = entities.get(e['entityId'])
+            entities[e['entityId']] = self.merge_updates(pending, e) if pending is not None else e
+
+        for e in event['data']['entities']:
+            entity_type = e.get('entityType')
+            action = e.get('action', 'update')
+
+            if entity_type == 'appointment':
+                e = self.assignment_target(e)
+                if e is None:
+                    continue
+                entity_type, action = e['entityType'], 'update'
+
+            if entity_type not in self.RELEVANT_KEYS:
+                # this is not an event we want
+                self.logger.debug("Passing on %s entity", entity_type)
+                continue
+
+            if action == 'remove':
+                if entity_type not in self.REMOVED_TYPES:
+                    self.logger.info("Passing on removal of %s %s", entity_type, e.get('entityId'))
+                    continue
+                keep(e)
+                continue
+
+            keys = e.get('keys')
+            if action == 'update' and keys is not None:
+                relevant = [key for key in keys if key in self.RELEVANT_KEYS[entity_type]]
+                if not relevant:
+                    self.logger.debug("Passing on %s %s, nothing relevant changed (%s)",
+                        entity_type, e.get('entityId'), ", ".join(keys))
+                    continue
+
+            keep(e)
+
+        return list(entities.values())
+
+    def assignment_target(self, appointment):
+        '''
+        returns a payload for the context an added or removed assignment belongs to,
+        or None for appointments that aren't assignments
+        '''
+        changes = appointment.get('changes') or {}
+
+        appointment_type = changes.get('type', {})
+        if 'assignment' not in (appointment_type.get('new'), appointment_type.get('old')):
+            return None
+
+        context = changes.get('context_id', {})
+        context_id = context.get('new') or context.get('old')
+        if context_id is None:
+            return None
+
+        # the context could be a task or a milestone, which fetching it will sort out
+        return {
+            'entityType': 'typedcontext',
+            'entityId': context_id,
+            'action': 'update',
+        }
+
     def handle_whole_project(self, event):
         '''
         Takes the context it's passed and does all the calendarable children
         '''
         self.logger.info("Received Make Calendar Event action call!")
-        self.session = ftrack_api.Session()
+        if not self.is_leader():
+            self.logger.info("Leaving the action to the leading instance")
+            return None
+
+        user_id = (event.get('source') or {}).get('user', {}).get('id')
+        self.sync_selection(event['data']['selection'], user_id=user_id)
+
+        return {
+            'success': True,
+            'message': "Putting events on the calendar in the background, see Jobs for progress"
+        }
+
+    def handle_reconcile(self, event):
+        '''
+        Reconciles the calendar with the selected contexts in the background, or
+        only reports what it would change when the action asks for a dry run
+        '''
+        self.logger.info("Received Reconcile Calendar Events action call!")
+        if not self.is_leader():
+            self.logger.info("Leaving the action to the leading instance")
+            return None
+
+        selection = event['data']['selection']
+        dry_run = bool((event['data'].get('actionData') or {}).get('dry_run'))
+
+        context_ids = [entity['entityId'] for entity in selection]
+        # events are only deleted for projects that were selected whole, since
+        # anything else can't tell a removed entity from one outside the selection
+        project_ids = [entity['entityId'] for entity in selection if entity.get('entityType') == 'show']
+
+        self.share_out({'kind': 'reconcile', 'context_ids': context_ids, 'project_ids': project_ids,
+            'dry_run': dry_run})
+        self.project_workers.submit(tuple(context_ids), self.reconcile_contexts,
+            context_ids, project_ids=project_ids, dry_run=dry_run)
+
+        return {
+            'success': True,
+            'message': "{} calendar events in the background".format(
+                "Checking" if dry_run else "Reconciling")
+        }
+
+    def sync_selection(self, selection, user_id=None, share=True):
+        '''
+        Syncs the selected contexts on the project workers
+
+        With PARALLEL_SYNC, every selected project and every category is a unit
+        of work of its own, so they're spread across the workers (each with its
+        own pooled session, all sharing the google rate limit), and once they've
+        all run a single report of the whole sync is logged
+
+        Given the user who asked for it, the sync shows up as a Job for them.
+        With COORDINATION, only our own share of the entities is synced here, and
+        unless share is false, the rest is handed to the other instances
+        '''
+        context_ids = [entity['entityId'] for entity in selection]
+        if share:
+            self.share_out({'kind': 'sync', 'selection': [
+                {'entityType': entity.get('entityType'), 'entityId': entity['entityId']} for entity in selection]})
+
+        if not self.PARALLEL_SYNC:
+            units = [(tuple(context_ids), None)]
+        else:
+            # projects can't overlap, but anything else selected is synced together, so
+            # that no entity is written by two workers at once
+            groups = [(entity['entityId'],) for entity in selection if entity.get('entityType') == 'show']
+            others = tuple(entity['entityId'] for entity in selection if entity.get('entityType') != 'show')
+            if others:
+                groups.append(others)
+            units = [(group, category) for group in groups for category, _, _ in self.SYNC_CATEGORIES]
+
+        job = None
+        if self.JOB_PROGRESS and user_id is not None:
+            job = JobProgress(
+                self.sessions.factory,
+                user_id,
+                "Calendar sync of {} {}".format(len(context_ids), "context" if len(context_ids) == 1 else "contexts"),
+                logger=self.logger,
+                update_interval=self.JOB_UPDATE_INTERVAL
+            )
+
+        work = WorkGroup(units, lambda results: self.report_sync(context_ids, results, job), logger=self.logger)
+        for group, category in units:
+            self.project_workers.submit((group, category), work.run, (group, category),
+                self.sync_contexts, list(group),
+                categories=[category] if category is not None else None, job=job)
+
+    def report_sync(self, context_ids, results, job=None):
+        '''
+        logs how a sync of the contexts went, from the results of its units of work,
+        and finishes its Job if it has one
+
+        returns the combined counts, with the units that failed under 'failures'
+        '''
+        report = collections.Counter()
+        failures = []
+        for (group, category), (result, exception) in sorted(results.items()):
+            category = category or "everything"
+            if exception is not None:
+                failures.append("{} of {}: {}".format(category, ", ".join(group), exception))
+                continue
+            report.update(result or {})
+            if result and result.get('failed_queries'):
+                failures.append("{} of {}: query failed".format(category, ", ".join(group)))
+
+        report = dict(report)
+        report['failures'] = failures
+
+        if job is not None:
+            job.finish(
+                failed=bool(failures),
+                summary="{} failed".format(len(failures)) if failures else "finished"
+            )
+
+        self.logger.info("Synced contexts %s in %d units: %s", ", ".join(context_ids), len(results),
+            ", ".join("{} {}".format(count, outcome)
+                for outcome, count in sorted(report.items()) if outcome != 'failures') or "nothing to do")
+        for failure in failures:
+            self.logger.error("Sync of %s failed", failure)
+        return report
 
+    def sync_contexts(self, context_ids, categories=None, job=None):
+        '''
+        Puts every calendarable entity under the contexts on the calendar, or only
+        those of the categories given
+
+        progress is counted on the job, if there is one, and the sync stops at the
+        next chunk once the job is cancelled. with COORDINATION, only the entities
+        this instance owns are synced
+
+        returns counts of what was written, and of chunks and queries that failed
+        '''
+        return self.sync_queries(self.context_queries(context_ids, categories), ", ".join(context_ids), job,
+            keep=self.owned)
+
+    def catch_up(self, since):
+        '''
+        Syncs the entities that end at or after since (a timestamp), to pick up the
+        updates sent while the process was down
+
+        events that had already ended by then are left as they are, until a reconcile.
+        unchanged events cost an ftrack query but no google calls. with COORDINATION, only
+        the entities this instance owns are synced
+
+        returns counts of what was written
+        '''
+        date = arrow.get(since).format('YYYY-MM-DDTHH:mm:ss')
+        self.logger.info("Catching up on entities ending since %s", date)
+
+        report = self.sync_queries([
+            (category, entity_type, criteria.format(date))
+            for category, entity_type, criteria in self.CATCH_UP_CATEGORIES
+        ], "entities ending since {}".format(date), keep=self.owned)
+
+        self.logger.info("Caught up: %s", ", ".join(
+            "{} {}".format(count, outcome) for outcome, count in sorted(report.items())) or "nothing to do")
+        return report
+
+    def sync_queries(self, queries, description, job=None, keep=None):
+        '''
+        Puts the entities matching the (category, entity type, criteria) queries on the calendar,
+        as described by sync_contexts -- or only those keep returns true for, if it's given
+        '''
+        report = collections.Counter()
+        failures = []
+
+        if job is not None:
+            job.start()
+            if job.cancelled:
+                return {'cancelled': 1}
+
+        self.expire_indexes()
+
+        with self.sessions.session() as session:
+            for category, entities in self.query_chunks(session, queries, failures, job):
+                read = len(entities)
+                if keep is not None:
+                    entities = [entity for entity in entities if keep(entity)]
+                # a chunk that fails for good doesn't cost the rest of the category
+                try:
+                    if self.BATCH_WHOLE_PROJECT:
+                        self.logger.debug("Putting %d %s on Calendar", len(entities), category)
+                        self.sync_entities(entities, tally=report)
+                    else:
+                        for entity in entities:
+                            self.logger.debug("Putting %s %s on Calendar:", entity.entity_type, entity['name'])
+                            self.put_on_calendar(entity)
+                except Exception as e:
+                    self.logger.error("Error updating %d %s", len(entities), category, exc_info=True)
+                    report['failed_chunks'] += 1
+
+                if job is not None:
+                    job.advance(read)
+                    if job.cancelled:
+                        self.logger.warning("Stopping sync of %s, it was cancelled", description)
+                        report['cancelled'] += 1
+                        break
+
+        if failures:
+            report['failed_queries'] += len(failures)
+        return dict(report)
+
+    def reconcile_contexts(self, context_ids, project_ids=None, dry_run=False):
+        '''
+        Diffs the calendarable entities under the contexts against the events on
+        the calendar, and applies only the difference: events are inserted for new
+        entities, updated where they no longer match, and deleted where their
+        entity is gone from one of the projects in project_ids
+
+        ftrack is streamed a chunk at a time, and the calendar side comes from the
+        event index, so nothing that's already right costs a google write.
+        With dry_run nothing is written, and the report says what would have been.
+        With COORDINATION, only the entities this instance owns are reconciled
+
+        returns the report, a dict of counts
+        '''
+        report = collections.Counter()
+        seen = set()
+        failures = []
+
+        self.expire_indexes()
+        with self.sessions.session() as session:
+            for category, entities in self.query_chunks(session, self.context_queries(context_ids), failures):
+                seen.update((entity.entity_type, entity['id']) for entity in entities)
+                entities = [entity for entity in entities if self.owned(entity)]
+                try:
+                    self.sync_entities(entities, dry_run=dry_run, tally=report)
+                except Exception as e:
+                    self.logger.error("Error reconciling %d %s", len(entities), category, exc_info=True)
+                    failures.append(category)
+
+        if project_ids and failures:
+            # we can't tell what's gone if we didn't see everything that's still there
+            self.logger.warning("Not deleting any events, since reading %s failed", ", ".join(failures))
+        elif project_ids:
+            self.delete_stale_events(seen, project_ids, dry_run=dry_run, tally=report)
+
+        report = dict(report)
+        self.logger.info("%s contexts %s: %s",
+            "Checked" if dry_run else "Reconciled",
+            ", ".join(context_ids),
+            ", ".join("{} {}".format(count, outcome) for outcome, count in sorted(report.items())) or "nothing to do")
+        return report
+
+    def delete_stale_events(self, seen, project_ids, dry_run=False, tally=None):
+        '''
+        deletes the events of the projects whose entities weren't seen in ftrack
+        '''
+        calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
+        index = self.event_index(calendar)
+
+        stale = [(key, event_id) for key, event_id in index.entries(project_ids)
+            if key not in seen and self.owns(key[1])]
+        if dry_run:
+            if tally is not None and stale:
+                tally['delete'] += len(stale)
+            return
+
+        self.delete_events(calendar, index, stale, tally)
+
+    def remove_from_calendar(self, removals):
+        '''
+        deletes the events of the entities of ftrack.update removals, found in the event index
+        '''
+        calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
+        index = self.event_index(calendar)
+
+        stale = []
+        for e in removals:
+            for ftrack_type in self.REMOVED_TYPES.get(e['entityType'], []):
+                key = (ftrack_type, e['entityId'])
+                event_id = index.lookup(*key)
+                if event_id is not None:
+                    stale.append((key, event_id))
+
+        if not stale:
+            self.logger.debug("None of the %d removed entities were on the calendar", len(removals))
+            return
+        self.delete_events(calendar, index, stale)
+
+    def start_orphan_sweeper(self):
+        '''
+        sweeps the calendar for orphans every ORPHAN_SWEEP_INTERVAL, on the project workers,
+        until shutdown -- only on the leader, with COORDINATION
+        '''
+        def run():
+            while not self._stopping.wait(self.ORPHAN_SWEEP_INTERVAL):
+                if not self.is_leader():
+                    continue
+                try:
+                    self.project_workers.submit(('orphan-sweep',), self.sweep_orphans)
+                except Exception:
+                    self.logger.error("Couldn't start an orphan sweep", exc_info=True)
+
+        thread = threading.Thread(target=run, name="OrphanSweeper")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def sweep_orphans(self, dry_run=False):
+        '''
+        Deletes the events on the calendar whose entities are gone from ftrack
+
+        every indexed entity is looked up, ORPHAN_SWEEP_BATCH at a time by id alone, and
+        a batch whose lookup fails deletes nothing. returns the report, a dict of counts
+        '''
+        calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
+        self.expire_indexes()
+        index = self.event_index(calendar)
+
+        by_type = collections.defaultdict(list)
+        for key, event_id in index.entries():
+            by_type[key[0]].append((key, event_id))
+
+        report = collections.Counter()
+        with self.sessions.session() as session:
+            for entity_type, entries in sorted(by_type.items()):
+                for batch in chunked(entries, self.ORPHAN_SWEEP_BATCH):
+                    try:
+                        with self.metrics.timer('ftrack_query_seconds', entity_type=entity_type):
+                            found = set(entity['id'] for entity in session.query(
+                                "select id from {} where id in ({})".format(
+                                    entity_type, ", ".join("'{}'".format(key[1]) for key, _ in batch))
+                            ).all())
+                        session.reset()
+                    except Exception as e:
+                        self.logger.error("Couldn't look up %d %s, skipping them", len(batch), entity_type,
+                            exc_info=True)
+                        report['failed_queries'] += 1
+                        continue
+
+                    report['checked'] += len(batch)
+                    orphans = [(key, event_id) for key, event_id in batch if key[1] not in found]
+                    if dry_run:
+                        report['delete'] += len(orphans)
+                    elif orphans:
+                        self.delete_events(calendar, index, orphans, report)
+
+        report = dict(report)
+        self.logger.info("Swept calendar for orphans: %s", ", ".join(
+            "{} {}".format(count, outcome) for outcome, count in sorted(report.items())) or "nothing to do")
+        return report
+
+    def delete_events(self, calendar, index, stale, tally=None):
+        '''
+        deletes the (key, event_id) events from the calendar and the index, and the
+        entities' events from the users' calendars
+        '''
+        if not stale:
+            return
+
+        def deleted(event_id, response, exception):
+            if exception is None or (isinstance(exception, errors.HttpError)
+                    and exception.resp.status in (404, 410)):
+                # a 404 or 410 means someone beat us to it
+                index.discard(event_id)
+                self.count_sync('deleted')
+                outcome = 'delete'
+            else:
+                self.logger.error("Failed to delete event %s: %s", event_id, exception)
+                outcome = 'failed'
+            if tally is not None:
+                tally[outcome] += 1
+
+        self.logger.info("Deleting %d events whose entities are gone from ftrack", len(stale))
+        self.batch.execute(
+            [(event_id, self.calendar_service.events().delete(
+                calendarId=calendar,
+                eventId=event_id,
+                sendNotifications=False
+            )) for key, event_id in stale],
+            callback=deleted
+        )
+        index.flush()
+
+        if self.user_calendars is not None:
+            self.user_calendars.remove([key for key, event_id in stale])
+
+    def context_queries(self, context_ids, categories=None):
+        '''
+        returns the (category, entity type, criteria) queries for the calendarable entities
+        under the contexts, for only the categories named in categories if it's given
+        '''
         id_match = " or ".join([
-            "id='{}'".format(entity['entityId']) 
-            for entity in event['data']['selection']])
+            "id='{}'".format(context_id) 
+            for context_id in context_ids])
 
-        # q = self.session.query(
+        # q = session.query(
         #     "TypedContext where link any ({})".format(id_match))
 
         # for entity in q:
         #     self.put_on_calendar(entity)
         
-        # if the project is selected, it will match for the calendar event
-        q_calendar_event = self.session.query(
-            "CalendarEvent where project has ({})".format(id_match))
-        q_milestone = self.session.query(
-            "Milestone where ancestors any ({})".format(id_match))
-        q_task = self.session.query(
-            "Task where ancestors any ({})".format(id_match))
-
         self.logger.debug("Q= Task where link any (%s)",id_match)
-        
-        try:
-            for entity in q_calendar_event:
-                self.logger.debug("Putting CalEvent %s on Calendar:", entity['name'])
-                self.put_on_calendar(entity)
-        except Exception as e:
-            self.logger.error("Error updating CalendarEvents", exc_info=True)
-        
-        try:
-            for entity in q_milestone:
-                self.logger.debug("Putting Milestone %s on Calendar:", entity['name'])
-                self.put_on_calendar(entity)
-        except Exception as e:
-            self.logger.error("Error updating Milestones", exc_info=True)
-        
+
+        return [
+            (category, entity_type, criteria.format(id_match))
+            for category, entity_type, criteria in self.SYNC_CATEGORIES
+            if categories is None or category in categories
+        ]
+
+    def query_chunks(self, session, queries, failures=None, job=None):
+        '''
+        yields (category, entities) for the results of the (category, entity type, criteria)
+        queries, in chunks of up to BATCH_SIZE with their invited users already loaded
+
+        entities are only good until the next page is read, since the session is
+        reset between pages
+
+        the name of any category whose query failed part way is added to failures.
+        each category is counted up front onto the job's total, if there's a job
+        '''
+        for category, entity_type, criteria in queries:
+            count = 0
+            try:
+                if job is not None:
+                    job.add_total(self.count_entities(session, entity_type, criteria))
+                for page_number, page in enumerate(self.query_pages(session, entity_type, criteria), 1):
+                    try:
+                        self.prefetch_resources(session, page)
+                    except Exception as e:
+                        # entity_to_event will just load them one at a time
+                        self.logger.warning("Couldn't prefetch users for %d %s", len(page), category, exc_info=True)
+
+                    for entities in chunked(page, self.BATCH_SIZE):
+                        yield category, entities
+
+                    count += len(page)
+                    self.logger.info("Finished page %d of %s (%d so far)", page_number, category, count)
+            except Exception as e:
+                self.logger.error("Error updating %s", category, exc_info=True)
+                if failures is not None:
+                    failures.append(category)
+
+    def projected_query(self, session, entity_type, criteria):
+        '''
+        queries entities of the type, selecting everything the event mapping needs up front
+        '''
+        projections = self.EVENT_PROJECTIONS.get(entity_type)
+        if projections is None:
+            return session.query("{} where {}".format(entity_type, criteria))
+
+        return session.query("select {} from {} where {}".format(
+            ", ".join(projections), entity_type, criteria))
+
+    def count_entities(self, session, entity_type, criteria):
+        '''
+        counts the entities a query would return, fetching only their ids
+        '''
+        with self.metrics.timer('ftrack_query_seconds', entity_type=entity_type):
+            count = len(session.query("select id from {} where {}".format(entity_type, criteria)).all())
+        # the ids aren't needed again
+        session.reset()
+        return count
+
+    def query_pages(self, session, entity_type, criteria):
+        '''
+        yields the results of a projected query in lists of up to QUERY_PAGE_SIZE,
+        resetting the session before each page after the first so the ones already
+        handled don't pile up in its cache
+        '''
+        if not self.QUERY_PAGE_SIZE:
+            with self.metrics.timer('ftrack_query_seconds', entity_type=entity_type):
+                page = self.projected_query(session, entity_type, criteria).all()
+            yield page
+            return
+
+        offset = 0
+        while True:
+            if offset:
+                session.reset()
+            # ordered, so that pages don't overlap or skip anything
+            with self.metrics.timer('ftrack_query_seconds', entity_type=entity_type):
+                page = self.projected_query(session, entity_type, "{} order by id offset {} limit {}".format(
+                    criteria, offset, self.QUERY_PAGE_SIZE)).all()
+            if page:
+                yield page
+            if len(page) < self.QUERY_PAGE_SIZE:
+                return
+            offset += len(page)
+
+    def fetch_entity(self, session, entity_type, entity_id):
+        '''
+        gets a single entity, along with everything the event mapping needs
+        '''
+        with self.metrics.timer('ftrack_query_seconds', entity_type=entity_type):
+            if entity_type not in self.EVENT_PROJECTIONS:
+                return session.get(entity_type, entity_id)
+
+            entity = self.projected_query(
+                session, entity_type, 'id is "{}"'.format(entity_id)).first()
+        if entity is not None:
+            self.prefetch_resources(session, [entity])
+        return entity
+
+    def prefetch_resources(self, session, entities):
+        '''
+        loads the users invited to the entities' events in a single query, rather than
+        one query per assignee when entity_to_event reads their emails
+        '''
+        resource_ids = set()
+        for entity in entities:
+            if entity.entity_type == "CalendarEvent":
+                links = entity['calendar_event_resources']
+            else:
+                links = entity['assignments']
+            resource_ids.update(link['resource']['id'] for link in links)
+
+        if not resource_ids:
+            return
+
+        with self.metrics.timer('ftrack_query_seconds', entity_type='User'):
+            session.query("select email, first_name from User where id in ({})".format(
+                ", ".join('"{}"'.format(resource_id) for resource_id in resource_ids)
+            )).all()
+
+    def sync_entities(self, entities, callback=None, dry_run=False, tally=None):
+        '''
+        Puts many entities on the team calendar at once, looking up and writing
+        their events through google batch requests
+
+        callback(entity, response, exception) is called once for each entity when
+        its write has finished, or failed for good
+
+        tally, if given, is a Counter of how many events were (or with dry_run, would
+        be) inserted and updated, how many were unchanged, and how many failed
+        '''
+        tally = tally if tally is not None else collections.Counter()
+        calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
+
+        pending = {}
+        for entity in entities:
+            color = self.get_calendar_event_color(entity['project'])
+            try:
+                event = self.entity_to_event(entity, color)
+            except TypeError as e:
+                self.logger.error("Could not generate event from this entity: %s (%s|%s)",
+                    entity['name'],
+                    entity.entity_type,
+                    entity['id'],
+                    exc_info=True)
+                tally['failed'] += 1
+                continue
+            pending[(entity.entity_type, entity['id'])] = (entity, event)
+
+        def report(key, response, exception):
+            entity = pending[key][0]
+            if exception is not None:
+                tally['failed'] += 1
+                self.logger.error("Failed to put %s %s on calendar: %s",
+                    entity.entity_type, entity['id'], exception)
+            if callback is not None:
+                callback(entity, response, exception)
+
+        # determine from the index which events we have already
         try:
-            for entity in q_task:
-                self.logger.debug("Putting Task %s on Calendar:", entity['name'])
-                self.put_on_calendar(entity)
-        except Exception as e:
-            self.logger.error("Error updating Tasks", exc_info=True)
-   
-            
-        
+            index = self.event_index(calendar)
+        except errors.HttpError as e:
+            if e.resp.status == 404:
+                # the next call will resolve the calendar again
+                self.forget_calendar(calendar)
+            raise
+
+        writes = {}
+        for key, (entity, event) in pending.items():
+            try:
+                event_id = index.lookup(*key)
+            except NotImplementedError as e:
+                report(key, None, e)
+                continue
+
+            if (event_id is not None and
+                    index.body_hash(event_id) == event['extendedProperties']['private'][HASH_PROPERTY]):
+                # nothing that maps to the calendar changed
+                self.count_sync('skipped')
+                tally['unchanged'] += 1
+                continue
+            writes[key] = event_id
+
+        if dry_run:
+            for event_id in writes.values():
+                tally['insert' if event_id is None else 'update'] += 1
+            return {}
+
+        # events deleted on google since they were indexed get created again, and
+        # events that turn out to be there already get updated -- once each
+        retried = collections.defaultdict(set)
+        retry = []
+
+        def written(key, response, exception):
+            if exception is None:
+                index.apply(response)
+                self.count_sync('written')
+                tally['insert' if writes[key] is None else 'update'] += 1
+                return
+
+            status = exception.resp.status if isinstance(exception, errors.HttpError) else None
+            if status == 404 and writes[key] is not None and status not in retried[key]:
+                index.discard(writes[key])
+                writes[key] = None
+            elif status == 409 and writes[key] is None and status not in retried[key]:
+                writes[key] = entity_event_id(*key)
+            else:
+                report(key, response, exception)
+                return
+            retried[key].add(status)
+            retry.append(key)
+
+        results = {}
+        keys = list(writes)
+        while keys:
+            del retry[:]
+            results.update(self.batch.execute(
+                [(key, self.upsert_request(calendar, key, writes[key], pending[key][1]))
+                    for key in keys],
+                callback=written
+            ))
+            keys = list(retry)
+
+        index.flush()
+
+        self.sync_user_calendars([(key, event) for key, (entity, event) in pending.items()])
+        return results
+
+    def sync_user_calendars(self, events):
+        '''
+        with DELEGATED_CALENDARS, brings the (key, event)s onto the calendars of the users
+        assigned to them, and off the calendars of the users no longer assigned
+        '''
+        if self.user_calendars is None or not events:
+            return
+
+        tally = self.user_calendars.sync(events)
+        for outcome, count in tally.items():
+            self.count_sync('user_' + outcome, count)
+
     def put_on_calendar(self, entity):
-        self.session = ftrack_api.Session()
         calendar_color = self.get_calendar_event_color(entity['project'])
         self.update_team_calendar(entity, color=calendar_color)
 
-        self.session.commit()
-
     def update_team_calendar(self, entity, color=None):
         '''
         This does the dirty work of adding or updating a calendar item in google based on the ftrack entity
 
+        Nothing is written if the event generated hashes the same as the one last written.
+
         The ftrack entity will get "team_calendar_id" metadata to identify it for future updates
         '''
         try:
@@ -155,49 +1461,137 @@ class CalendarUpdater(object):
                 entity.entity_type,
                 entity['id'],
                 exc_info=True)
+            return False
 
-        calendar = self.ensure_calendar("ftrack")
+        calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
 
-        # determine from google if we have the event already
         try:
-            event_search = self.calendar_service.events().list(
-                calendarId = calendar,
-                privateExtendedProperty= 
-                ["ftrack_id={}".format(entity['id']),
-                "ftrack_type={}".format(entity.entity_type)]
-            ).execute()
-
-            num_results = len(event_search['items'])
-            if num_results > 1:
-                raise NotImplementedError("Cannot determine which Google Calendar Event to use, too many matches")
-            elif num_results == 1:
-                event_id = event_search['items'][0]['id']
-            elif num_results == 0:
-                event_id = None
-        
+            response = self.upsert_event(calendar, entity, event)
+        except errors.HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # the cached calendar was removed from under us, so look it up again
+            self.logger.warning("Calendar %s no longer exists, resolving it again", calendar)
+            self.forget_calendar(calendar)
+            calendar = self.ensure_calendar(self.TEAM_CALENDAR_NAME)
+            response = self.upsert_event(calendar, entity, event)
+
+        self.sync_user_calendars([((entity.entity_type, entity['id']), event)])
+        return response
+
+    def upsert_event(self, calendar, entity, event):
+        '''
+        Inserts the event on the calendar, or updates the one that already exists for the entity
+        '''
+        # determine from the index if we have the event already
+        index = self.event_index(calendar)
+        try:
+            event_id = index.lookup(entity.entity_type, entity['id'])
         except Exception as e:
             self.logger.error("Couldn't disabiguate existing calendar items!", exc_info=True)
             return False
 
+        body_hash = event['extendedProperties']['private'][HASH_PROPERTY]
+        if event_id is not None and index.body_hash(event_id) == body_hash:
+            self.logger.debug("Event for %s %s is unchanged, skipping", entity.entity_type, entity['id'])
+            self.count_sync('skipped')
+            return None
+
+        # if we haven't yet created an event for this, this inserts instead of updating
+        key = (entity.entity_type, entity['id'])
         if event_id is None:
-            # we haven't yet created an event for this
-            event_response = self.calendar_service.events().insert(
-                calendarId=calendar,
-                body = event,
-                sendNotifications = False
-            ).execute()
-            
-            # take this out until ftrack adds metadata to CalendarEvents
-            # entity['metadata']['team_calendar_id'] = event_response['id']
-        
+            event_response = self.insert_event(calendar, key, event)
         else:
-            # we should update, since the event has already been created
-            event_response = self.calendar_service.events().update(
+            try:
+                event_response = self.google.execute(self.upsert_request(calendar, key, event_id, event))
+            except errors.HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # the event was deleted on google since it was indexed
+                index.discard(event_id)
+                event_response = self.insert_event(calendar, key, event)
+
+        index.apply(event_response)
+        self.count_sync('written')
+
+        # take this out until ftrack adds metadata to CalendarEvents
+        # if event_id is None:
+        #     entity['metadata']['team_calendar_id'] = event_response['id']
+
+        return event_response
+
+    def insert_event(self, calendar, key, event):
+        '''
+        inserts the event of the entity with the (ftrack_type, ftrack_id) key, or updates
+        it if it's there already: put there by another worker, by an earlier try at this
+        insert that did get through, or deleted, which google still remembers
+        '''
+        try:
+            return self.google.execute(self.upsert_request(calendar, key, None, event))
+        except errors.HttpError as e:
+            if e.resp.status != 409:
+                raise
+            return self.google.execute(self.upsert_request(calendar, key, entity_event_id(*key), event))
+
+    def forget_calendar(self, calendar):
+        '''
+        drops what we know of a calendar that's gone from google: its cached id, its
+        index, and the index saved in the sync state, which would otherwise be loaded
+        again on the next start
+        '''
+        self.calendar_registry.invalidate(calendar_id=calendar)
+        self.event_indexes.pop(calendar, None)
+        if self.sync_state is None:
+            return
+        try:
+            self.sync_state.forget(calendar)
+        except Exception as e:
+            self.logger.error("Couldn't forget the saved index of calendar %s", calendar, exc_info=True)
+
+    def event_index(self, calendar):
+        '''
+        returns the index of the events on the calendar, bringing it up to date if it's stale
+        '''
+        index = self.event_indexes.get(calendar)
+        if index is None:
+            index = self.event_indexes.setdefault(calendar, EventIndex(
+                self.calendar_service,
+                calendar,
+                logger=self.logger,
+                refresh_interval=self.EVENT_INDEX_REFRESH,
+                execute=self.google.execute,
+                store=self.sync_state
+            ))
+        index.ensure_current()
+        return index
+
+    def upsert_request(self, calendar, key, event_id, event):
+        '''
+        builds the request that inserts the event of the entity with the
+        (ftrack_type, ftrack_id) key, or updates it if it has an event_id
+
+        new events get an id made from the key, so that inserting one twice can't
+        make a duplicate
+
+        with DELEGATED_CALENDARS, assignees get a copy of their own, so the team event
+        doesn't invite them as well
+        '''
+        if self.user_calendars is not None:
+            event = dict(event, attendees=[])
+
+        if event_id is None:
+            return self.calendar_service.events().insert(
                 calendarId=calendar,
-                eventId=event_id,
-                body = event,
+                body = dict(event, id=entity_event_id(*key)),
                 sendNotifications = False
-            ).execute()
+            )
+
+        return self.calendar_service.events().update(
+            calendarId=calendar,
+            eventId=event_id,
+            body = event,
+            sendNotifications = False
+        )
         
         
     def entity_to_event(self, entity, color):
@@ -215,7 +1609,7 @@ class CalendarUpdater(object):
                 )  
 
         # set up some things if its a task        
-        if entity.entity_type == "Task":
+        if entity.entity_type in ("Task", "Milestone"):
             #if it also doesn't have an end date, then bail on this
             if entity['start_date'] is None and entity['end_date'] is None:
                 raise TypeError("Must have a start or end date!")
@@ -291,10 +1685,19 @@ class CalendarUpdater(object):
             }
         }
 
+        if entity['project'] is not None:
+            # lets reconciling find the events of a project without asking ftrack
+            event['extendedProperties']['private'][PROJECT_PROPERTY] = entity['project']['id']
+
         if color is not None:
             event['colorId'] = color
 
-        self.logger.debug("Finished constructing event for entity: \n%s", json.dumps(event))
+        # lets later updates tell if anything changed without fetching the event
+        event['extendedProperties']['private'][HASH_PROPERTY] = event_hash(event)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # dumping the whole body isn't free, so only when it'll be seen
+            self.logger.debug("Finished constructing event for entity: \n%s", json.dumps(event))
 
         return event
 
@@ -302,18 +1705,40 @@ class CalendarUpdater(object):
     def ensure_calendar(self, calendar_name):
         '''
         ensures that the named calendar exists, and is shared with the domain
-        '''
 
+        resolved ids are kept in the calendar registry, so this only talks to google
+        the first time a calendar is seen (and again once the registry entry expires)
+        '''
+        calendar_id = self.calendar_registry.get(calendar_name)
+        if calendar_id is not None:
+            self.ensure_shared(calendar_name, calendar_id)
+            return calendar_id
+
+        # one thread at a time, or parallel syncs would each create the calendar
+        with self.calendar_registry.resolving(calendar_name):
+            calendar_id = self.calendar_registry.get(calendar_name)
+            if calendar_id is not None:
+                self.ensure_shared(calendar_name, calendar_id)
+                return calendar_id
+            return self.resolve_calendar(calendar_name)
+
+    def resolve_calendar(self, calendar_name):
+        '''
+        finds the named calendar in the service account's calendar list, or creates it,
+        and returns its id -- see ensure_calendar
+        '''
         self.logger.info("Ensuring that calendar'%s' exists", calendar_name)
         #iterate through all the calendars
         page_token = None
         while True:
-            calendar_list = self.calendar_service.calendarList().list(pageToken=page_token).execute()
+            calendar_list = self.google.execute(
+                self.calendar_service.calendarList().list(pageToken=page_token))
             for calendar in calendar_list['items']:
                 if calendar['summary'] == calendar_name:
                     self.logger.info("Found existing calendar %s (%s)", calendar['summary'], calendar['id'])
+                    self.calendar_registry.put(calendar_name, calendar['id'])
                     # ensure we've shared the calendar
-                    self.share_calendar(calendar['id'])
+                    self.ensure_shared(calendar_name, calendar['id'])
                     return calendar['id']
             page_token = calendar_list.get('nextPageToken')
             if not page_token:
@@ -324,12 +1749,12 @@ class CalendarUpdater(object):
         self.logger.warning("Couldn't find calendar '%s', creating instead", calendar_name)
 
         try:    
-            created_calendar = self.calendar_service.calendars().insert(
+            created_calendar = self.google.execute(self.calendar_service.calendars().insert(
                 body={
                     'summary': calendar_name,
                     'timeZone': 'America/Los_Angeles'
                     }
-            ).execute()
+            ), idempotent=False)
             self.logger.info("Creation successful! id: %s", created_calendar['id'],)
         except Exception as e:
             self.logger.error("Failed to create calendar", exc_info=True)
@@ -337,24 +1762,38 @@ class CalendarUpdater(object):
         else:
             try:
                 # add the calendar to the list of the service account so we can find it later
-                updated_calendar_list = self.calendar_service.calendarList().insert(
+                updated_calendar_list = self.google.execute(self.calendar_service.calendarList().insert(
                     body={
                         'id':created_calendar['id']
                     }
-                ).execute()
+                ))
                 self.logger.info("Added to service account calendar list")
 
-                self.share_calendar(created_calendar['id'])
+                self.calendar_registry.put(calendar_name, created_calendar['id'])
+                self.ensure_shared(calendar_name, created_calendar['id'])
             except Exception as e:
                 self.logger.error("Failed to configure calendar (id: %s) -- it may be in a bad state!!!",
                     exc_info=True)
 
         return created_calendar['id']
 
+    def ensure_shared(self, calendar_name, calendar_id):
+        '''
+        shares the calendar unless the registry already knows it is shared
+        '''
+        if self.calendar_registry.is_shared(calendar_name):
+            return True
+
+        if self.share_calendar(calendar_id):
+            self.calendar_registry.mark_shared(calendar_name)
+            return True
+
+        return False
+
     def share_calendar(self, calendar_id):
         # share with lucid's calendar share group
         try:
-            acl = self.calendar_service.acl().insert(
+            acl = self.google.execute(self.calendar_service.acl().insert(
                 calendarId=calendar_id,
                 body={
                     'scope': {
@@ -363,23 +1802,57 @@ class CalendarUpdater(object):
                     },
                     'role': 'owner'
                 }
-            ).execute()
+            ))
 
             return True
         except Exception as e:
             self.logger.error("Couldn't Share calendar id %s", calendar_id, exc_info=True)
     
+    def count_sync(self, outcome, count=1):
+        with self._stats_lock:
+            self.sync_stats[outcome] += count
+
+    def get_sync_stats(self):
+        '''
+        returns how many calendar writes were made, and how many were skipped as unchanged
+        '''
+        with self._stats_lock:
+            return dict(self.sync_stats)
+
+    def get_google_stats(self):
+        '''
+        returns how many google requests were made, throttled and retried
+        '''
+        return self.google.stats()
+
     def get_calendar_event_color(self, project):
         '''
         ensures that the color for the project is in google, and returns the color instance
+
+        the palette and the colour each project maps to are memoized on color_palette
         '''
         try:
             ftrack_colour = colour.Color(project['color'])
         except Exception as e:
             self.logger.error("Can't get project color -- maybe a non-project event?", exc_info=True)
             return None
+
+        best_color = self.color_palette.get(ftrack_colour.hex_l)
+        if best_color is not None:
+            self.metrics.inc('color_lookups_total', result='hit')
+            return best_color
+
+        self.metrics.inc('color_lookups_total', result='miss')
+        with self.metrics.timer('color_lookup_seconds'):
+            return self.match_calendar_event_color(ftrack_colour)
+
+    def match_calendar_event_color(self, ftrack_colour):
+        '''
+        picks the google event colour closest to the ftrack colour, and memoizes it
+        '''
         try:
-            google_colors = self.calendar_service.colors().get().execute()
+            google_colors = self.color_palette.event_colors(
+                lambda: self.google.execute(self.calendar_service.colors().get()))
         except Exception as e:
             self.logger.error("Couldn't get colors list. Bailing on color.", exc_info=True)
             return None
@@ -389,7 +1862,7 @@ class CalendarUpdater(object):
         best_color = None
 
         try:
-            for color_id, color in google_colors['event'].items():
+            for color_id, color in google_colors.items():
                 google_colour = colour.Color(color['background'])
 
                 r = abs(google_colour.red - ftrack_colour.red)
@@ -405,32 +1878,41 @@ class CalendarUpdater(object):
                 
             self.logger.info("Determined best color to be id: %s (%s)", 
                 best_color, 
-                google_colors['event'][color_id])
+                google_colors[best_color])
 
+            self.color_palette.put(ftrack_colour.hex_l, best_color)
             return best_color
 
         except Exception as e:
             self.logger.error("Issue with picking color, skipping on.", exc_info=True)
 
+    def plugin_path(self, path):
+        '''
+        resolves a path relative to the root of the plugin
+        '''
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        return os.path.realpath(os.path.join(dir_path, "..", os.path.normpath(path)))
+
     def setup_logging(self, name):
         logger = logging.getLogger(name)
 
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        log_file = os.path.join(
-            dir_path,
-            "..",
-            os.path.normpath(self.LOG_DIR),
-            'ftrack-google-calendar.log'
-        )
+        log_dir = self.plugin_path(self.LOG_DIR)
+        log_file = os.path.join(log_dir, 'ftrack-google-calendar.log')
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
             # protect file logging for heroku
         if not os.path.isdir("/app/.heroku"):
-            file_handler = logging.handlers.TimedRotatingFileHandler(LOG_DIR,
-                                            when="w0",
-                                            interval=1,
-                                            backupCount=5)
-            file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            # every updater logs to the same file, so only add the handler once
+            if not any(getattr(handler, 'baseFilename', None) == os.path.abspath(log_file)
+                    for handler in logger.handlers):
+                file_handler = logging.handlers.TimedRotatingFileHandler(log_file,
+                                                when="w0",
+                                                interval=1,
+                                                backupCount=5)
+                file_handler.setFormatter(formatter)
+                logger.addHandler(file_handler)
 
         else:
             logging.basicConfig(level=self.LOG_LEVEL)
@@ -438,36 +1920,23 @@ class CalendarUpdater(object):
         logger.setLevel(self.LOG_LEVEL)
         return logger
 
-    def get_entity_type(self, entity):
+    def get_entity_type(self, entity, session):
         '''Return translated entity type tht can be used with API.'''
         entity_type = entity.get('entityType')
-        entity_id = entity.get('entityId')
         object_typeid = entity.get('objectTypeId')
 
-        for schema in self.session.schemas:
-            alias_for = schema.get('alias_for')
-
-            if (
-                alias_for and isinstance(alias_for, dict) and
-                alias_for['id'].lower() == entity_type and
-                object_typeid == alias_for.get('classifiers', {}).get('object_typeid')
-            ):
-                return schema['id']
-
-        for schema in self.session.schemas:
-            alias_for = schema.get('alias_for')
+        schema_id = self.schema_alias_index(session).resolve(entity_type, object_typeid)
+        if schema_id is None:
+            raise ValueError('Unable to translate entity type.')
+        return schema_id
 
-            if (
-                alias_for and isinstance(alias_for, basestring) and
-                alias_for.lower() == entity_type
-            ):
-                return schema['id']
-
-        for schema in self.session.schemas:
-            alias_for = schema.get('alias_for')
-
-            if schema['id'].lower() == entity_type:
-                    return schema['id']
-
-        raise ValueError('Unable to translate entity type.')
+    def schema_alias_index(self, session):
+        '''
+        returns the alias lookup for the session's schemas, building it the first time
+        '''
+        with self._schema_lock:
+            aliases = self.schema_aliases.get(session)
+            if aliases is None:
+                aliases = self.schema_aliases[session] = SchemaAliasIndex(session.schemas)
+            return aliases
 
@@ -0,0 +1,324 @@
+'''
+
+Google Request Execution
+
+The one place Google API requests get executed, so every call shares the
+same client-side rate limit and the same retry behaviour when Google asks
+us to slow down or has a hiccup, and goes out over a pool of keep-alive
+connections that several threads can use at once.
+
+'''
+
+import collections
+import contextlib
+import copy
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import httplib2
+import simplejson as json
+from apiclient import discovery, errors
+from six.moves import queue
+
+
+# reasons google gives on a 403 when it wants us to slow down
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# seconds to wait on google for a discovery document that isn't cached yet
+DISCOVERY_TIMEOUT = 30
+
+
+def error_reason(error):
+    '''
+    returns the reason google gave for an HttpError, if there is one
+    '''
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except Exception:
+        return None
+
+
+def is_rate_limited(error):
+    '''
+    whether google refused the call because we're over quota
+    '''
+    if not isinstance(error, errors.HttpError):
+        return False
+
+    status = error.resp.status
+    return status == 429 or (status == 403 and error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable_error(error):
+    '''
+    whether a failed call is worth trying again: rate limits, server errors,
+    and connections that dropped
+    '''
+    if isinstance(error, (socket.error, httplib2.HttpLib2Error)):
+        return True
+
+    if not isinstance(error, errors.HttpError):
+        return False
+
+    return is_rate_limited(error) or error.resp.status >= 500
+
+
+def request_method(request):
+    '''
+    returns the api method a request calls, like calendar.events.insert, or batch
+    '''
+    return getattr(request, 'methodId', None) or 'batch'
+
+
+def load_discovery_document(api, version, cache_dir, logger=None, timeout=DISCOVERY_TIMEOUT):
+    '''
+    returns the discovery document for the api as a string, from the cache directory if
+    it's there (or bundled there), and otherwise fetched from google and cached for next time
+    '''
+    logger = logger or logging.getLogger(__name__)
+    cache_path = os.path.join(cache_dir, '{}-{}.json'.format(api, version))
+
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as fp:
+            return fp.read().decode('utf-8')
+
+    logger.info("No cached discovery document for %s %s, fetching it", api, version)
+    url = discovery.DISCOVERY_URI.replace('{api}', api).replace('{apiVersion}', version)
+    resp, content = httplib2.Http(timeout=timeout).request(url)
+    if resp.status >= 400:
+        raise errors.HttpError(resp, content, uri=url)
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write then rename, so a concurrent start never reads half a document
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(temp_path, 'wb') as fp:
+            fp.write(content)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        logger.warning("Couldn't cache discovery document at %s", cache_path, exc_info=True)
+
+    return content.decode('utf-8')
+
+
+def build_calendar_service(credentials, cache_dir, logger=None):
+    '''
+    builds the calendar v3 service from the cached discovery document, so starting up
+    doesn't need a round-trip to google
+    '''
+    document = load_discovery_document('calendar', 'v3', cache_dir, logger)
+    return discovery.build_from_document(document, credentials=credentials)
+
+
+class HttpPool(object):
+    '''
+    A pool of up to ``size`` authorized httplib2 connections.
+
+    httplib2.Http objects aren't safe to share between threads, but they do keep
+    their connections alive, so each request borrows one for as long as it runs.
+    '''
+
+    def __init__(self, credentials, size=4, timeout=60):
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        http = self._acquire()
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if not create:
+            return self._idle.get()
+        return self.credentials.authorize(httplib2.Http(timeout=self.timeout))
+
+
+class TokenBucket(object):
+    '''
+    Client-side rate limit: ``rate`` tokens a second, holding at most ``capacity``
+    so short bursts go through straight away.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.time()
+
+    def acquire(self, tokens=1):
+        '''
+        takes tokens from the bucket, waiting for them if need be
+
+        more than the bucket holds are taken once it's full, leaving it in debt,
+        so a big batch still costs its whole size and later callers wait it off
+
+        returns how long it waited, in seconds
+        '''
+        tokens = float(tokens)
+        needed = min(tokens, self.capacity)
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return waited
+
+                delay = (needed - self._tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestExecutor(object):
+    '''
+    Executes Google API requests through a shared token bucket, retrying the
+    ones that fail with a retryable error after a jittered exponential backoff,
+    or after as long as google's Retry-After header says.
+
+    Requests go out over a connection borrowed from ``http_pool`` when there is
+    one, or over the service's own connection otherwise. Given a metrics registry,
+    how long each one took is observed by api method.
+    '''
+
+    def __init__(self, bucket, logger=None, max_retries=5, base_delay=1.0, max_delay=64.0,
+                 http_pool=None, metrics=None):
+        self.bucket = bucket
+        self.http_pool = http_pool
+        self.metrics = metrics
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def execute(self, request, http_pool=None, idempotent=True):
+        '''
+        executes the request, retrying it if google asks us to back off
+
+        requests that aren't idempotent, like creating a calendar, are only retried
+        when google refused them outright -- after a server error or a dropped
+        connection they may well have gone through, and sending them again would
+        make a second one
+        '''
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return self.send(request, http_pool)
+            except Exception as e:
+                if is_rate_limited(e):
+                    self.count('throttled')
+                retryable = is_retryable_error(e) if idempotent else is_rate_limited(e)
+                if not retryable or attempt >= self.max_retries:
+                    self.count('failures')
+                    raise
+                self.back_off(attempt, e)
+                attempt += 1
+
+    def limited_by(self, bucket):
+        '''
+        returns an executor like this one, sharing its stats, but held to another rate
+        limit -- for requests made as someone with a quota of their own
+        '''
+        executor = copy.copy(self)
+        executor.bucket = bucket
+        return executor
+
+    def send(self, request, http_pool=None):
+        '''
+        sends a request or batch once, with no rate limiting or retries, over a
+        connection from http_pool if it's given (for requests made as someone else)
+        '''
+        http_pool = http_pool or self.http_pool
+        started = time.time()
+        try:
+            if http_pool is None:
+                return request.execute()
+
+            with http_pool.connection() as http:
+                return request.execute(http=http)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('google_request_seconds', time.time() - started,
+                    method=request_method(request))
+
+    def acquire(self, count=1):
+        '''
+        waits until the rate limit allows count more requests
+        '''
+        waited = self.bucket.acquire(count)
+        with self._lock:
+            self._stats['requests'] += count
+            if waited:
+                self._stats['limited'] += 1
+                self._stats['limited_seconds'] += waited
+
+    def back_off(self, attempt, error=None, count=1):
+        '''
+        sleeps before retry number attempt (counting from 0) of count requests
+        '''
+        delay = self.backoff_delay(attempt, error)
+        self.count('retries', count)
+
+        self.logger.warning("Google call failed (%s), retrying in %.1fs", error, delay)
+        time.sleep(delay)
+
+    def backoff_delay(self, attempt, error=None):
+        '''
+        how long to wait before retry number attempt, honouring Retry-After
+        '''
+        retry_after = None
+        if isinstance(error, errors.HttpError):
+            retry_after = error.resp.get('retry-after')
+
+        try:
+            return min(self.max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay + random.uniform(0, self.base_delay)
+
+    def count(self, name, count=1):
+        with self._lock:
+            self._stats[name] += count
+
+    def stats(self):
+        '''
+        returns how many requests were made, throttled by google, held back by the
+        rate limit, and retried
+        '''
+        with self._lock:
+            return dict(self._stats)
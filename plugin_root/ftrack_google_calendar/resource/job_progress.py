@@ -0,0 +1,176 @@
+'''
+
+ftrack Job Progress
+
+Shows the progress of a long-running sync as an ftrack Job, with how many
+entities are done, how fast they're going and when it should finish, and
+notices when the user kills the Job so the sync can stop.
+
+'''
+
+import contextlib
+import logging
+import threading
+import time
+
+import simplejson as json
+
+
+def format_duration(seconds):
+    '''
+    formats seconds as something like 1h 4m, 3m 20s or 12s
+    '''
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "{}h {}m".format(hours, minutes)
+    if minutes:
+        return "{}m {}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+class JobProgress(object):
+    '''
+    An ftrack Job for the user who launched a sync, kept up to date at most every
+    ``update_interval`` seconds as entities are done.
+
+    The Job is created the first time ``start()`` is called, so the caller can
+    hand one JobProgress to several units of work, and each update reads the
+    Job's status back, so killing it in ftrack sets ``cancelled``.
+
+    The Job is kept up to date through a session of its own, made by
+    ``session_factory`` and closed when the Job finishes. The workers syncing
+    already hold pooled sessions, so borrowing another from the pool could wait
+    on them forever.
+    '''
+
+    def __init__(self, session_factory, user_id, label, logger=None, update_interval=5.0):
+        self.session_factory = session_factory
+        self.user_id = user_id
+        self.label = label
+        self.logger = logger or logging.getLogger(__name__)
+        self.update_interval = update_interval
+
+        self.job_id = None
+        self.cancelled = False
+        self.total = 0
+        self.done = 0
+
+        self._lock = threading.Lock()
+        self._session_lock = threading.Lock()
+        self._session = None
+        self._started_at = None
+        self._updated_at = 0
+        self._updating = False
+
+    def start(self):
+        '''
+        creates the Job, unless it has been already
+        '''
+        with self._lock:
+            if self._started_at is not None:
+                return
+            self._started_at = time.time()
+
+        try:
+            with self.session() as session:
+                job = session.create('Job', {
+                    'user_id': self.user_id,
+                    'status': 'running',
+                    'data': json.dumps({'description': "{}: starting".format(self.label)}),
+                })
+                session.commit()
+                self.job_id = job['id']
+        except Exception:
+            # the sync can run without a Job, it just won't show
+            self.logger.error("Couldn't create a Job for %s", self.label, exc_info=True)
+
+    def add_total(self, count):
+        with self._lock:
+            self.total += count
+
+    def advance(self, count):
+        '''
+        counts entities as done, and updates the Job if it's been long enough
+        '''
+        with self._lock:
+            self.done += count
+            if self._updating or time.time() - self._updated_at < self.update_interval:
+                return
+            self._updating = True
+
+        try:
+            self._update('running')
+        finally:
+            with self._lock:
+                self._updating = False
+                self._updated_at = time.time()
+
+    def finish(self, failed=False, summary=None):
+        '''
+        marks the Job done (or failed), unless the user killed it
+        '''
+        self._update('killed' if self.cancelled else ('failed' if failed else 'done'), summary)
+        with self._session_lock:
+            self._close_session()
+
+    def describe(self, summary=None):
+        '''
+        returns the progress as a line of text: counts, throughput and ETA
+        '''
+        with self._lock:
+            done, total = self.done, self.total
+            elapsed = time.time() - (self._started_at or time.time())
+
+        rate = done / elapsed if elapsed > 0 else 0.0
+        description = "{}: {}/{} entities, {:.1f}/s".format(self.label, done, total, rate)
+        if summary:
+            description += ", {}".format(summary)
+        elif rate and total > done:
+            description += ", about {} left".format(format_duration((total - done) / rate))
+        return description
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        context manager lending out the Job's session, made the first time it's needed,
+        and made again after an error
+        '''
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.session_factory()
+            try:
+                yield self._session
+            except Exception:
+                self._close_session()
+                raise
+
+    def _close_session(self):
+        # caller must hold the session lock
+        if self._session is None:
+            return
+        try:
+            self._session.close()
+        except Exception:
+            self.logger.warning("Couldn't close the session of Job %s", self.job_id, exc_info=True)
+        self._session = None
+
+    def _update(self, status, summary=None):
+        if self.job_id is None:
+            return
+
+        try:
+            with self.session() as session:
+                job = session.query('select status, data from Job where id is "{}"'.format(self.job_id)).one()
+                if job['status'] == 'killed':
+                    if not self.cancelled:
+                        self.logger.warning("%s was cancelled from ftrack", self.label)
+                    self.cancelled = True
+                    status = 'killed'
+
+                job['data'] = json.dumps({'description': self.describe(summary)})
+                job['status'] = status
+                session.commit()
+        except Exception:
+            self.logger.warning("Couldn't update Job %s", self.job_id, exc_info=True)
@@ -0,0 +1,234 @@
+'''
+
+Metrics
+
+Counters and timing histograms for where the calendar sync spends its time
+(ftrack queries, Google calls, colour lookups, queues, end-to-end latency),
+exported in the Prometheus text format over a local HTTP endpoint, or to a
+file.
+
+'''
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+# seconds, from a cached lookup up to a whole project
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    '''
+    Counts observations into cumulative buckets, Prometheus style
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        returns (upper bound, count of observations at or under it) for every bucket
+        '''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry(object):
+    '''
+    A thread-safe set of counters and histograms, each kept per set of labels.
+
+    Stats that are already kept elsewhere get in through collectors: callables
+    returning (name, type, labels, value) tuples, which are called on every
+    export.
+    '''
+
+    def __init__(self, prefix='ftrack_calendar_', logger=None):
+        self.prefix = prefix
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def describe(self, name, metric_type, help_text):
+        with self._lock:
+            self._help[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+        observes how long the block took into the named histogram
+        '''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def collect(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def uncollect(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self):
+        '''
+        returns every metric in the Prometheus text format
+        '''
+        with self._lock:
+            help_texts = dict(self._help)
+            counters = dict((name, dict(series)) for name, series in self._counters.items())
+            histograms = dict(
+                (name, dict((key, (h.cumulative(), h.sum, h.count)) for key, h in series.items()))
+                for name, series in self._histograms.items()
+            )
+            collectors = list(self._collectors)
+
+        gauges = {}
+        for collector in collectors:
+            try:
+                for name, metric_type, labels, value in collector():
+                    help_texts.setdefault(name, (metric_type, ''))
+                    gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            except Exception:
+                self.logger.warning("Metrics collector failed", exc_info=True)
+
+        lines = []
+
+        def header(name, default_type):
+            metric_type, help_text = help_texts.get(name, (default_type, ''))
+            if help_text:
+                lines.append('# HELP {}{} {}'.format(self.prefix, name, help_text))
+            lines.append('# TYPE {}{} {}'.format(self.prefix, name, metric_type))
+
+        for name in sorted(set(counters) | set(gauges)):
+            header(name, 'counter' if name in counters else 'gauge')
+            series = dict(gauges.get(name, {}))
+            series.update(counters.get(name, {}))
+            for key, value in sorted(series.items()):
+                lines.append('{}{}{} {}'.format(self.prefix, name, format_labels(key), format_value(value)))
+
+        for name in sorted(histograms):
+            header(name, 'histogram')
+            for key, (buckets, total, count) in sorted(histograms[name].items()):
+                for bound, cumulative in buckets:
+                    lines.append('{}{}_bucket{} {}'.format(self.prefix, name,
+                        format_labels(key + (('le', format_value(bound)),)), cumulative))
+                lines.append('{}{}_sum{} {}'.format(self.prefix, name, format_labels(key), format_value(total)))
+                lines.append('{}{}_count{} {}'.format(self.prefix, name, format_labels(key), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''
+        writes the metrics to a file, replacing it in one go so readers never see half of it
+        '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as fp:
+            fp.write(self.render())
+        os.rename(temp_path, path)
+
+    def write_every(self, path, interval, stopping=None):
+        '''
+        writes the metrics to the file every interval seconds, on a daemon thread, until
+        the stopping event (if there is one) is set
+        '''
+        stopping = stopping or threading.Event()
+
+        def run():
+            while not stopping.wait(interval):
+                try:
+                    self.write(path)
+                except Exception:
+                    self.logger.warning("Couldn't write metrics to %s", path, exc_info=True)
+
+        thread = threading.Thread(target=run, name="MetricsWriter")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+        serves the metrics at http://host:port/metrics on a daemon thread, and returns the server
+        '''
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                registry.logger.debug("metrics: " + format, *args)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="MetricsServer")
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,49 @@
+'''
+
+ftrack Schema Aliases
+
+Translates the entity types ftrack.update events talk about (like "task",
+with an object type id) into the schema ids the API queries with (like
+"Milestone"), from a lookup table built once per set of schemas.
+
+'''
+
+import six
+
+
+class SchemaAliasIndex(object):
+    '''
+    Lookup tables over a session's schemas, resolving an event's entity type in
+    the same order a scan of the schemas would:
+
+    - schemas aliasing the entity type for a specific object type id
+    - schemas aliasing the entity type by name
+    - the schema whose own id is the entity type
+    '''
+
+    def __init__(self, schemas):
+        self._typed = {}
+        self._named = {}
+        self._ids = {}
+
+        for schema in schemas:
+            alias_for = schema.get('alias_for')
+
+            if alias_for and isinstance(alias_for, dict):
+                object_typeid = alias_for.get('classifiers', {}).get('object_typeid')
+                self._typed.setdefault((alias_for['id'].lower(), object_typeid), schema['id'])
+            elif alias_for and isinstance(alias_for, six.string_types):
+                self._named.setdefault(alias_for.lower(), schema['id'])
+
+            self._ids.setdefault(schema['id'].lower(), schema['id'])
+
+    def resolve(self, entity_type, object_typeid=None):
+        '''
+        returns the schema id for the entity type, or None if no schema matches it
+        '''
+        schema_id = self._typed.get((entity_type, object_typeid))
+        if schema_id is None:
+            schema_id = self._named.get(entity_type)
+        if schema_id is None:
+            schema_id = self._ids.get(entity_type)
+        return schema_id
@@ -0,0 +1,114 @@
+'''
+
+ftrack Session Pool
+
+Keeps a few long-lived ftrack_api sessions around, so handling an event
+reuses their schemas and connections instead of building a new session
+(and fetching the schemas again) every time.
+
+'''
+
+import contextlib
+import logging
+import threading
+
+from six.moves import queue
+
+
+def create_session():
+    '''
+    the default session factory: no event hub, since pooled sessions only ever query,
+    and no plugins -- FTRACK_EVENT_PLUGIN_PATH points at this plugin, which would
+    otherwise be registered (and start another updater) for every session
+    '''
+    # only imported here, so the pool (and the updater) can be used with other sessions
+    import ftrack_api
+    return ftrack_api.Session(auto_connect_event_hub=False, plugin_paths=[])
+
+
+class SessionPool(object):
+    '''
+    A bounded pool of ftrack sessions.
+
+    Sessions are created lazily up to ``size``, and each one is reset when it's
+    handed back so nothing fetched for one event leaks into the next.
+    '''
+
+    def __init__(self, size=1, factory=create_session, logger=None):
+        self.size = size
+        self.factory = factory
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        context manager lending out a session for the duration of the block
+        '''
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def acquire(self):
+        '''
+        returns an idle session, creating one if the pool isn't full yet,
+        or waits for one to be released
+        '''
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if not create:
+            return self._idle.get()
+
+        self.logger.info("Creating pooled ftrack session (%d of %d)", self._created, self.size)
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, session):
+        '''
+        clears the session's cache and puts it back in the pool
+        '''
+        try:
+            # forget the entities fetched, but keep the schemas and connections
+            session.reset()
+        except Exception:
+            self.logger.warning("Couldn't reset ftrack session, dropping it from the pool", exc_info=True)
+            self._discard(session)
+            return
+
+        self._idle.put(session)
+
+    def close(self):
+        '''
+        closes every idle session
+        '''
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(session)
+
+    def _discard(self, session):
+        with self._lock:
+            self._created -= 1
+        try:
+            session.close()
+        except Exception:
+            self.logger.debug("Error closing ftrack session", exc_info=True)
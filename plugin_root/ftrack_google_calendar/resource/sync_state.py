@@ -0,0 +1,176 @@
+'''
+
+Sync State Store
+
+A small SQLite database on local disk holding the ftrack entity -> Google
+event mapping of each calendar, with the body hash last written to every
+event and the calendar's sync token, so a restart picks up where the last
+process left off instead of listing the whole calendar again. It also
+remembers which users' own calendars carry a copy of each event.
+
+Everything in it can be rebuilt from a scan of the calendars, so losing it
+only costs one slow start.
+
+'''
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = [
+    '''
+    create table if not exists calendars (
+        calendar_id text primary key,
+        sync_token text,
+        synced_at real
+    )
+    ''',
+    '''
+    create table if not exists events (
+        calendar_id text not null,
+        event_id text not null,
+        ftrack_type text not null,
+        ftrack_id text not null,
+        project_id text,
+        body_hash text,
+        synced_at real,
+        primary key (calendar_id, event_id)
+    )
+    ''',
+    '''
+    create index if not exists events_by_entity on events (calendar_id, ftrack_type, ftrack_id)
+    ''',
+    '''
+    create table if not exists user_events (
+        ftrack_type text not null,
+        ftrack_id text not null,
+        email text not null,
+        body_hash text,
+        synced_at real,
+        primary key (ftrack_type, ftrack_id, email)
+    )
+    ''',
+]
+
+
+class SyncStateStore(object):
+    '''
+    SQLite-backed record of what's on each calendar.
+
+    The database runs in WAL mode, so reading it never waits on a write, and
+    changes are written in batches, each in a single transaction. A single
+    connection is shared between threads behind a lock.
+    '''
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('pragma journal_mode=wal')
+        # with WAL, normal is still safe against corruption, and much faster than full
+        self._conn.execute('pragma synchronous=normal')
+        with self._conn:
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+
+    def load(self, calendar_id):
+        '''
+        returns (sync_token, synced_at, events) for the calendar, where events is a list
+        of (event_id, ftrack_type, ftrack_id, project_id, body_hash) -- or (None, None, [])
+        if nothing was stored for it
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'select sync_token, synced_at from calendars where calendar_id = ?',
+                (calendar_id,)
+            ).fetchone()
+            if row is None or row[0] is None:
+                return None, None, []
+
+            events = self._conn.execute(
+                'select event_id, ftrack_type, ftrack_id, project_id, body_hash '
+                'from events where calendar_id = ?',
+                (calendar_id,)
+            ).fetchall()
+            return row[0], row[1], events
+
+    def write(self, calendar_id, changes, sync_token=None, synced_at=None, replace=False):
+        '''
+        writes a batch of changes in one transaction
+
+        changes maps event_id to (ftrack_type, ftrack_id, project_id, body_hash), or to
+        None for events that are gone. The sync token is saved too when it's given, and
+        with replace everything stored for the calendar is dropped first
+        '''
+        now = time.time()
+        upserts = []
+        deletes = []
+        for event_id, entry in changes.items():
+            if entry is None:
+                deletes.append((calendar_id, event_id))
+            else:
+                upserts.append((calendar_id, event_id) + tuple(entry) + (now,))
+
+        with self._lock:
+            with self._conn:
+                if replace:
+                    self._conn.execute('delete from events where calendar_id = ?', (calendar_id,))
+                    self._conn.execute('delete from calendars where calendar_id = ?', (calendar_id,))
+                if deletes:
+                    self._conn.executemany(
+                        'delete from events where calendar_id = ? and event_id = ?', deletes)
+                if upserts:
+                    self._conn.executemany(
+                        'insert or replace into events (calendar_id, event_id, ftrack_type, '
+                        'ftrack_id, project_id, body_hash, synced_at) values (?, ?, ?, ?, ?, ?, ?)',
+                        upserts)
+                if sync_token is not None:
+                    self._conn.execute(
+                        'insert or replace into calendars (calendar_id, sync_token, synced_at) '
+                        'values (?, ?, ?)',
+                        (calendar_id, sync_token, synced_at if synced_at is not None else now))
+
+    def user_events(self, ftrack_type, ftrack_id):
+        '''
+        returns {email: body_hash} for the users whose own calendars have the entity's event
+        '''
+        with self._lock:
+            return dict(self._conn.execute(
+                'select email, body_hash from user_events where ftrack_type = ? and ftrack_id = ?',
+                (ftrack_type, ftrack_id)
+            ).fetchall())
+
+    def write_user_events(self, changes):
+        '''
+        writes a batch of (ftrack_type, ftrack_id, email, body_hash) in one transaction,
+        where a body_hash of None means the event was taken off that user's calendar
+        '''
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    'delete from user_events where ftrack_type = ? and ftrack_id = ? and email = ?',
+                    [change[:3] for change in changes if change[3] is None])
+                self._conn.executemany(
+                    'insert or replace into user_events (ftrack_type, ftrack_id, email, body_hash, '
+                    'synced_at) values (?, ?, ?, ?, ?)',
+                    [tuple(change) + (now,) for change in changes if change[3] is not None])
+
+    def forget(self, calendar_id):
+        '''
+        drops everything stored for the calendar
+        '''
+        self.write(calendar_id, {}, replace=True)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,223 @@
+'''
+
+User Calendars
+
+Puts a copy of each event straight onto the primary calendar of every user
+it's assigned to, by impersonating them through the service account's
+domain-wide delegation, and keeps those copies in step as assignments change.
+
+'''
+
+import collections
+import copy
+import logging
+import threading
+
+from apiclient import errors
+
+from event_index import HASH_PROPERTY, entity_event_id, event_hash
+from google_batch import BatchExecutor
+
+
+def user_event_id(ftrack_type, ftrack_id):
+    '''
+    the id of an entity's event on every user calendar, so it never has to be looked up
+    '''
+    return entity_event_id(ftrack_type, ftrack_id)
+
+
+def user_event_body(event):
+    '''
+    the event as it goes on a user's own calendar: without attendees, since it's
+    already on their calendar and shouldn't invite anyone else
+    '''
+    body = copy.deepcopy(event)
+    body.pop('attendees', None)
+    body['status'] = 'confirmed'
+    body['extendedProperties']['private'][HASH_PROPERTY] = event_hash(body)
+    return body
+
+
+class UserCalendars(object):
+    '''
+    Writes events to users' primary calendars.
+
+    ``service_for(email)`` returns a calendar service acting as that user, and
+    ``http_pool_for(email)``, if given, a pool of connections authorized as them.
+    Google's quota is per user, so ``bucket_for(email)``, if given, returns the
+    rate limit their writes are held to, rather than the executor's own. All of
+    them are kept for the ``cache_size`` most recently used users.
+
+    Which users have a copy of each event, and the hash of the copy, is kept in
+    ``store`` (or only in memory without one), so a sync only touches the users
+    who were assigned or unassigned, or whose copy is out of date. Writes are
+    grouped into one batch per user.
+    '''
+
+    CALENDAR_ID = 'primary'
+
+    def __init__(self, service_for, executor, http_pool_for=None, store=None, logger=None,
+                 batch_size=BatchExecutor.MAX_BATCH_SIZE, cache_size=500, bucket_for=None):
+        self.service_for = service_for
+        self.http_pool_for = http_pool_for
+        self.bucket_for = bucket_for
+        self.executor = executor
+        self.store = store
+        self.logger = logger or logging.getLogger(__name__)
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._users = collections.OrderedDict()
+        self._ledger = {}
+
+    def sync(self, events, tally=None):
+        '''
+        brings the user calendars in line with the events, a list of (key, event)
+        where key is (ftrack_type, ftrack_id)
+
+        tally, if given, is a Counter of the user events inserted, updated, deleted,
+        unchanged and failed
+        '''
+        tally = tally if tally is not None else collections.Counter()
+        writes = collections.defaultdict(list)
+
+        for key, event in events:
+            body = user_event_body(event)
+            body_hash = body['extendedProperties']['private'][HASH_PROPERTY]
+            emails = set(attendee['email'] for attendee in event.get('attendees', []))
+            previous = self.user_events(key)
+
+            for email in emails:
+                if previous.get(email) == body_hash:
+                    tally['unchanged'] += 1
+                    continue
+                writes[email].append((key, 'update' if email in previous else 'insert', body))
+
+            for email in set(previous) - emails:
+                writes[email].append((key, 'delete', None))
+
+        return self._write_all(writes, tally)
+
+    def remove(self, keys, tally=None):
+        '''
+        takes the events of the entities with the keys off every user calendar they're on
+        '''
+        tally = tally if tally is not None else collections.Counter()
+        writes = collections.defaultdict(list)
+        for key in keys:
+            for email in self.user_events(key):
+                writes[email].append((key, 'delete', None))
+        return self._write_all(writes, tally)
+
+    def _write_all(self, writes, tally):
+        for email, user_writes in writes.items():
+            try:
+                self._write(email, user_writes, tally)
+            except Exception as e:
+                self.logger.error("Couldn't update the calendar of %s", email, exc_info=True)
+                tally['failed'] += len(user_writes)
+
+        return tally
+
+    def user_events(self, key):
+        '''
+        returns {email: body_hash} for the users who have a copy of the entity's event
+        '''
+        with self._lock:
+            if key in self._ledger:
+                return dict(self._ledger[key])
+
+        users = self.store.user_events(*key) if self.store is not None else {}
+        with self._lock:
+            return dict(self._ledger.setdefault(key, users))
+
+    def _write(self, email, user_writes, tally):
+        service, http_pool, executor = self._user(email)
+        batch = BatchExecutor(service, executor, logger=self.logger,
+            batch_size=self.batch_size, http_pool=http_pool)
+        events = service.events()
+        changes = []
+        retry = []
+
+        def request(key, action, body):
+            event_id = user_event_id(*key)
+            if action == 'insert':
+                return events.insert(calendarId=self.CALENDAR_ID, body=dict(body, id=event_id),
+                    sendNotifications=False)
+            if action == 'update':
+                return events.update(calendarId=self.CALENDAR_ID, eventId=event_id, body=body,
+                    sendNotifications=False)
+            return events.delete(calendarId=self.CALENDAR_ID, eventId=event_id, sendNotifications=False)
+
+        def done(write, exception, retry):
+            key, action, body = write
+            status = exception.resp.status if isinstance(exception, errors.HttpError) else None
+
+            if exception is not None and action == 'delete' and status in (404, 410):
+                # already gone
+                exception = None
+            elif (exception is not None and retry is not None
+                    and (action, status) in (('insert', 409), ('update', 404))):
+                # our record was out of date: the event is already there, or never was
+                retry.append((key, 'update' if action == 'insert' else 'insert', body))
+                return
+
+            if exception is not None:
+                self.logger.error("Failed to %s the event of %s %s on the calendar of %s: %s",
+                    action, key[0], key[1], email, exception)
+                tally['failed'] += 1
+                return
+
+            changes.append((key, body['extendedProperties']['private'][HASH_PROPERTY] if body else None))
+            tally[action] += 1
+
+        def run(writes, retry=None):
+            batch.execute(
+                [(index, request(*write)) for index, write in enumerate(writes)],
+                callback=lambda index, response, exception: done(writes[index], exception, retry)
+            )
+
+        run(user_writes, retry)
+        if retry:
+            run(retry)
+
+        self._record(email, changes)
+
+    def _record(self, email, changes):
+        with self._lock:
+            for key, body_hash in changes:
+                users = self._ledger.setdefault(key, {})
+                if body_hash is None:
+                    users.pop(email, None)
+                else:
+                    users[email] = body_hash
+
+        if self.store is not None and changes:
+            try:
+                self.store.write_user_events(
+                    [key + (email, body_hash) for key, body_hash in changes])
+            except Exception:
+                self.logger.error("Couldn't save the events on the calendar of %s", email, exc_info=True)
+
+    def _user(self, email):
+        '''
+        returns (service, http pool, executor) acting as the user, creating them if need be
+        '''
+        with self._lock:
+            user = self._users.pop(email, None)
+            if user is not None:
+                self._users[email] = user
+                return user
+
+        user = (
+            self.service_for(email),
+            self.http_pool_for(email) if self.http_pool_for else None,
+            self.executor.limited_by(self.bucket_for(email)) if self.bucket_for else self.executor
+        )
+
+        with self._lock:
+            self._users[email] = user
+            while len(self._users) > self.cache_size:
+                self._users.popitem(last=False)
+        return user
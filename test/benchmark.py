@@ -0,0 +1,329 @@
+'''
+Offline benchmark of the calendar updater, against the fake Google Calendar
+and a synthetic ftrack studio, so performance work can be measured the same
+way every time without credentials or a network.
+
+Reports how long the plugin takes to import and register, and to create its
+updater in the background, and then wall time, google calls (the writes
+among them, and round trips) per entity, ftrack queries and peak memory for
+a cold whole-project sync,
+the same sync again with nothing changed, a parallel whole-project sync,
+single-entity updates (by one updater, and by two coordinated ones both
+hearing every update), removals (half of them sent as updates, half only
+found by the orphan sweep) and a restart that catches up from the event
+journal.
+
+    python test/benchmark.py --projects 2 --tasks 500 --latency 0.05
+
+Lucid
+
+'''
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import arrow
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+resource_dir = os.path.join(dir_path, '..', 'plugin_root', 'ftrack_google_calendar', 'resource')
+hook_dir = os.path.join(dir_path, '..', 'plugin_root', 'ftrack_google_calendar', 'hook')
+sys.path.append(dir_path)
+sys.path.append(resource_dir)
+sys.path.append(hook_dir)
+
+from fake_google import FakeCalendarService
+from fake_ftrack import FakeData, FakeSession, TASK_TYPE_ID
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+def make_updater(service, data, args, state_dir, sessions=None, user_service_factory=None, **settings):
+    '''
+    returns a CalendarUpdater wired to the fakes, with nothing shared with other runs
+    but the sessions list, that every session it opens is added to -- and with
+    DELEGATED_CALENDARS, the user services user_service_factory makes
+
+    any other settings are set on its class
+    '''
+    from google_calendar_tools import CalendarUpdater
+    from calendar_cache import CalendarRegistry, ColorPalette
+    from google_client import TokenBucket
+    from metrics import MetricsRegistry
+
+    sessions = sessions if sessions is not None else []
+
+    def session_factory():
+        session = FakeSession(data)
+        sessions.append(session)
+        return session
+
+    updater_class = type('BenchmarkUpdater', (CalendarUpdater,), dict({
+        'LOG_LEVEL': logging.WARNING,
+        'SYNC_STATE_PATH': os.path.join(state_dir, 'sync-state.db'),
+        'JOURNAL_PATH': os.path.join(state_dir, 'event-journal.jsonl'),
+        'COALESCE_WINDOW': 0,
+        'ORPHAN_SWEEP_INTERVAL': 0,
+        'JOB_PROGRESS': False,
+        'QUERY_PAGE_SIZE': args.page_size,
+        'PROJECT_WORKER_COUNT': args.workers,
+        'SESSION_POOL_SIZE': CalendarUpdater.WORKER_COUNT + args.workers,
+        'calendar_registry': CalendarRegistry(),
+        'color_palette': ColorPalette(),
+        'google_rate_limit': TokenBucket(args.client_rate, args.client_burst),
+        'metrics': MetricsRegistry(),
+    }, **settings))
+    updater = updater_class(calendar_service=service, session_factory=session_factory,
+        user_service_factory=user_service_factory)
+    updater.fake_sessions = sessions
+    return updater
+
+
+class FakeEventHub(object):
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, subscription, callback):
+        self.subscriptions.append((subscription, callback))
+
+
+def hub_session():
+    '''
+    returns an ftrack_api.Session, as the hook wants, that only has a fake event hub
+    '''
+    import ftrack_api
+
+    class HubSession(ftrack_api.Session):
+        def __init__(self):
+            self._event_hub = FakeEventHub()
+
+    return HubSession()
+
+
+def import_seconds(module):
+    '''
+    returns how long importing the module takes in a fresh interpreter, that already
+    has ftrack_api loaded, like the plugin host does
+    '''
+    script = ("import sys, time, ftrack_api; sys.path[:0] = {!r}; "
+        "started = time.time(); import {}; print(time.time() - started)")
+    output = subprocess.check_output([sys.executable, '-c', script.format([hook_dir, resource_dir], module)])
+    return float(output.decode('utf-8').split()[-1])
+
+
+def startup_row(name, seconds):
+    return dict(measure(name, 0, FakeCalendarService(), None, lambda: None), wall_seconds=seconds)
+
+
+def wait_idle(pool):
+    while True:
+        stats = pool.stats()
+        if stats.get('submitted', 0) == stats.get('completed', 0) + stats.get('failed', 0):
+            return
+        time.sleep(0.01)
+
+
+def measure(name, entities, service, updater, fn):
+    '''
+    runs fn, and returns a row of what it cost
+    '''
+    service.reset_counts()
+    sessions = updater.fake_sessions if updater is not None else []
+    queries_before = sum(sum(s.queries.values()) for s in sessions)
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    started = time.time()
+    fn()
+    wall = time.time() - started
+
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+        tracemalloc.stop()
+    else:
+        # the peak of the whole process so far, in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    calls = service.total_calls()
+    return {
+        'scenario': name,
+        'entities': entities,
+        'wall_seconds': wall,
+        'google_calls': calls,
+        'google_writes': sum(count for method, count in service.calls.items()
+            if method.startswith('calendar.events.') and not method.endswith('.list')),
+        'round_trips': sum(service.round_trips.values()),
+        'calls_per_entity': calls / float(entities) if entities else 0.0,
+        'rate_limited': service.calls.get('rate_limited', 0),
+        'ftrack_queries': sum(sum(s.queries.values()) for s in sessions) - queries_before,
+        'peak_mb': peak,
+    }
+
+
+def run(args):
+    '''
+    runs every scenario, and returns a list of result rows
+    '''
+    data = FakeData(
+        projects=args.projects,
+        tasks=args.tasks,
+        calendar_events=args.calendar_events,
+        users=args.users,
+        assignees=args.assignees,
+        # so some of the work is still to come, for the catch-up on restart
+        seed_date=arrow.utcnow().shift(days=-15).format('YYYY-MM-DD')
+    )
+    service = FakeCalendarService(latency=args.latency, rate_limit=args.google_rate)
+    state_dir = tempfile.mkdtemp(prefix='calendar-benchmark-')
+
+    try:
+        import google_calendar_hook
+
+        rows = [
+            startup_row("plugin import", import_seconds('google_calendar_hook')),
+            startup_row("updater import", import_seconds('google_calendar_tools')),
+        ]
+
+        # registering only subscribes, and the updater is created on a thread
+        sessions = []
+        lazy = []
+        rows.append(measure("plugin register", 0, service, None, lambda: lazy.append(
+            google_calendar_hook.register(hub_session(),
+                updater_factory=lambda: make_updater(service, data, args, state_dir, sessions)))))
+        rows.append(measure("updater warm-up", 0, service, None, lambda: lazy[0].get()))
+
+        updater = lazy[0].get()
+        project_ids = [project['id'] for project in data.projects()]
+        total = data.calendarable()
+
+        rows.append(measure("whole project, cold", total, service, updater,
+            lambda: updater.sync_contexts(project_ids)))
+        rows.append(measure("whole project, unchanged", total, service, updater,
+            lambda: updater.sync_contexts(project_ids)))
+
+        for task in data.entities['Task'].values():
+            task['name'] += ' (renamed)'
+
+        def parallel():
+            updater.sync_selection([{'entityId': project_id, 'entityType': 'show'} for project_id in project_ids])
+            wait_idle(updater.project_workers)
+        rows.append(measure("whole project, tasks renamed, parallel", total, service, updater, parallel))
+
+        tasks = list(data.entities['Task'].values())[:args.single_events]
+
+        def single_events():
+            for task in tasks:
+                task['description'] = 'changed'
+                updater.sync_updates([{
+                    'entityType': 'task',
+                    'entityId': task['id'],
+                    'objectTypeId': TASK_TYPE_ID,
+                    'action': 'update',
+                    'keys': ['description'],
+                }])
+        rows.append(measure("single entity updates", len(tasks), service, updater, single_events))
+
+        # two instances that both hear every update, like two plugin hosts would
+        instances = [make_updater(service, data, args, state_dir, updater.fake_sessions,
+            COORDINATION=True,
+            COORDINATION_PATH=os.path.join(state_dir, 'coordination.db'),
+            COORDINATION_LEASE=0.3,
+            INSTANCE_ID='instance{}'.format(number)
+        ) for number in range(2)]
+        # until they've both taken their share
+        time.sleep(0.3)
+
+        def coordinated_events():
+            for task in tasks:
+                task['description'] = 'changed again'
+                for instance in instances:
+                    instance.handle_ftrack_event({'data': {'entities': [{
+                        'entityType': 'task',
+                        'entityId': task['id'],
+                        'objectTypeId': TASK_TYPE_ID,
+                        'action': 'update',
+                        'keys': ['description'],
+                    }]}})
+            for instance in instances:
+                wait_idle(instance.workers)
+        rows.append(measure("single entity updates, 2 instances", len(tasks), service, updater,
+            coordinated_events))
+        for instance in instances:
+            instance.shutdown()
+
+        def removals():
+            for index, task in enumerate(tasks):
+                with data.lock:
+                    del data.entities['Task'][task['id']]
+                if index % 2 == 0:
+                    updater.sync_updates([{'entityType': 'task', 'entityId': task['id'], 'action': 'remove'}])
+            updater.sweep_orphans()
+        rows.append(measure("removals and orphan sweep", len(tasks), service, updater, removals))
+
+        updater.shutdown()
+
+        # a new process, catching up on whatever still ends after the last checkpoint
+        now = arrow.utcnow().shift(seconds=-updater.CATCH_UP_MARGIN)
+        ending = sum(1 for entity_type, field in (('Task', 'end_date'), ('Milestone', 'end_date'), ('CalendarEvent', 'end'))
+            for entity in data.entities[entity_type].values() if entity[field] >= now)
+        restarted = []
+
+        def restart():
+            restarted.append(make_updater(service, data, args, state_dir, updater.fake_sessions))
+            wait_idle(restarted[0].project_workers)
+        rows.append(measure("restart, catch up", ending, service, updater, restart))
+
+        restarted[0].shutdown()
+        return rows
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def report(rows):
+    columns = [
+        ('scenario', 40, '{:<40}'),
+        ('entities', 8, '{:>8}'),
+        ('wall_seconds', 12, '{:>12.2f}'),
+        ('google_calls', 12, '{:>12}'),
+        ('google_writes', 13, '{:>13}'),
+        ('round_trips', 11, '{:>11}'),
+        ('calls_per_entity', 16, '{:>16.3f}'),
+        ('rate_limited', 12, '{:>12}'),
+        ('ftrack_queries', 14, '{:>14}'),
+        ('peak_mb', 9, '{:>9.1f}'),
+    ]
+    lines = [' '.join(name.ljust(width) if name == 'scenario' else name.rjust(width)
+        for name, width, fmt in columns)]
+    for row in rows:
+        lines.append(' '.join(fmt.format(row[name]) for name, width, fmt in columns))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--projects', type=int, default=1)
+    parser.add_argument('--tasks', type=int, default=200, help="tasks per project")
+    parser.add_argument('--calendar-events', type=int, default=20, help="calendar events per project")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--assignees', type=int, default=2, help="users assigned to each task")
+    parser.add_argument('--single-events', type=int, default=20, help="single updates to time")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per google round trip")
+    parser.add_argument('--google-rate', type=float, default=None, help="google's quota, calls a second")
+    parser.add_argument('--client-rate', type=float, default=1000.0, help="the updater's own rate limit")
+    parser.add_argument('--client-burst', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=500, help="ftrack query page size")
+    parser.add_argument('--workers', type=int, default=4, help="project workers")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    print(report(run(parse_args())))
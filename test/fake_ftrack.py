@@ -0,0 +1,203 @@
+'''
+A synthetic ftrack session for the calendar updater: generated projects with
+tasks, milestones, assignments and calendar events, answering just the
+queries the updater makes, and counting them.
+
+Lucid
+
+'''
+
+import collections
+import itertools
+import re
+import threading
+import uuid
+
+import arrow
+
+
+TASK_TYPE_ID = '11c137c0-ee7e-4f9c-91c5-8c77cec22b2c'
+MILESTONE_TYPE_ID = '01694d8a-8a4d-11e8-b7c3-5ce0c5c8e2e3'
+
+SCHEMAS = [
+    {'id': 'Context'},
+    {'id': 'TypedContext', 'alias_for': 'Task'},
+    {'id': 'Task', 'alias_for': {'id': 'Task', 'classifiers': {'object_typeid': TASK_TYPE_ID}}},
+    {'id': 'Milestone', 'alias_for': {'id': 'Task', 'classifiers': {'object_typeid': MILESTONE_TYPE_ID}}},
+    {'id': 'Project', 'alias_for': 'Show'},
+    {'id': 'CalendarEvent'},
+    {'id': 'User'},
+    {'id': 'Job'},
+]
+
+PROJECT_COLORS = ['#00BCD4', '#E91E63', '#8BC34A', '#FF9800', '#3F51B5']
+
+
+class FakeEntity(dict):
+    def __init__(self, entity_type, data):
+        super(FakeEntity, self).__init__(data)
+        self.entity_type = entity_type
+
+
+class FakeQuery(object):
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def all(self):
+        return list(self.results)
+
+    def first(self):
+        return self.results[0] if self.results else None
+
+    def one(self):
+        if len(self.results) != 1:
+            raise ValueError("Expected one result, got {}".format(len(self.results)))
+        return self.results[0]
+
+
+class FakeData(object):
+    '''
+    The generated studio: ``projects`` projects, each with ``tasks`` tasks (one
+    in every ``milestone_every`` of them a milestone) assigned to
+    ``assignees`` users, and ``calendar_events`` calendar events.
+
+    Shared by all the sessions of a pool, like the server is.
+    '''
+
+    def __init__(self, projects=1, tasks=100, calendar_events=10, users=20, assignees=2,
+                 milestone_every=10, seed_date='2017-10-02'):
+        self.lock = threading.Lock()
+        self.entities = collections.defaultdict(collections.OrderedDict)
+        start = arrow.get(seed_date)
+
+        users_list = [self.add('User', {
+            'email': 'user{}@example.com'.format(index),
+            'first_name': 'User{}'.format(index),
+        }) for index in range(users)]
+        cycle = itertools.cycle(users_list)
+
+        for project_index in range(projects):
+            project = self.add('Project', {
+                'full_name': 'Project {}'.format(project_index),
+                'color': PROJECT_COLORS[project_index % len(PROJECT_COLORS)],
+            })
+
+            for index in range(tasks):
+                milestone = milestone_every and index % milestone_every == milestone_every - 1
+                task_start = start.shift(days=index % 60)
+                task = self.add('Milestone' if milestone else 'Task', {
+                    'name': '{} {}'.format('Milestone' if milestone else 'Task', index),
+                    'description': 'generated',
+                    'project': project,
+                    'project_id': project['id'],
+                    'start_date': None if milestone else task_start,
+                    'end_date': task_start.shift(hours=+8),
+                    'object_type_id': MILESTONE_TYPE_ID if milestone else TASK_TYPE_ID,
+                })
+                task['assignments'] = [
+                    FakeEntity('Appointment', {'id': str(uuid.uuid4()), 'resource': next(cycle)})
+                    for _ in range(assignees)
+                ]
+
+            for index in range(calendar_events):
+                event_start = start.shift(days=index * 3)
+                event = self.add('CalendarEvent', {
+                    'name': 'Event {}'.format(index),
+                    'project': project,
+                    'project_id': project['id'],
+                    'start': event_start,
+                    'end': event_start.shift(days=+1),
+                    'leave': False,
+                })
+                event['calendar_event_resources'] = [
+                    FakeEntity('CalendarEventResource', {'id': str(uuid.uuid4()), 'resource': next(cycle)})
+                    for _ in range(assignees)
+                ]
+
+    def add(self, entity_type, data):
+        entity = FakeEntity(entity_type, dict(data, id=str(uuid.uuid4())))
+        self.entities[entity_type][entity['id']] = entity
+        return entity
+
+    def projects(self):
+        return list(self.entities['Project'].values())
+
+    def calendarable(self):
+        return sum(len(self.entities[entity_type]) for entity_type in ('Task', 'Milestone', 'CalendarEvent'))
+
+
+class FakeSession(object):
+    '''
+    Answers the queries the calendar updater makes from a FakeData, the way
+    ftrack_api.Session would
+    '''
+
+    SELECT = re.compile(r'^(?:select (?P<fields>.+?) from )?(?P<type>\w+)(?: where (?P<criteria>.*?))?'
+                        r'(?: order by (?P<order>\w+))?(?: offset (?P<offset>\d+))?(?: limit (?P<limit>\d+))?$')
+    IDS = re.compile(r'''id(?:=| is |\s*=\s*)['"]([^'"]+)['"]''')
+    ID_LIST = re.compile(r'''id in \(([^)]*)\)''')
+    SINCE = re.compile(r'''^(\w+) >= ['"]([^'"]+)['"]$''')
+
+    def __init__(self, data):
+        self.data = data
+        self.schemas = SCHEMAS
+        self.queries = collections.Counter()
+        self.resets = 0
+        self.auto_connect_event_hub = False
+
+    def query(self, expression, page_size=500):
+        match = self.SELECT.match(expression.strip())
+        if match is None:
+            raise ValueError("Can't fake query: {}".format(expression))
+
+        entity_type = match.group('type')
+        criteria = match.group('criteria') or ''
+        self.queries[entity_type] += 1
+
+        with self.data.lock:
+            entities = list(self.data.entities[entity_type].values())
+
+        if ' in (' in criteria:
+            ids = set(re.findall(r'''['"]([^'"]+)['"]''', self.ID_LIST.search(criteria).group(1)))
+            entities = [e for e in entities if e['id'] in ids]
+        elif self.SINCE.match(criteria):
+            field, date = self.SINCE.match(criteria).groups()
+            date = arrow.get(date)
+            entities = [e for e in entities if e.get(field) is not None and e[field] >= date]
+        elif criteria.startswith(('ancestors any', 'project has', 'link any')):
+            ids = set(self.IDS.findall(criteria))
+            entities = [e for e in entities if e.get('project_id') in ids]
+        elif criteria:
+            ids = set(self.IDS.findall(criteria))
+            entities = [e for e in entities if e['id'] in ids]
+
+        if match.group('order'):
+            entities.sort(key=lambda e: e[match.group('order')])
+        offset = int(match.group('offset') or 0)
+        if match.group('limit') is not None:
+            entities = entities[offset:offset + int(match.group('limit'))]
+        else:
+            entities = entities[offset:]
+
+        return FakeQuery(entities)
+
+    def get(self, entity_type, entity_id):
+        self.queries[entity_type] += 1
+        with self.data.lock:
+            return self.data.entities[entity_type].get(entity_id)
+
+    def create(self, entity_type, data):
+        with self.data.lock:
+            return self.data.add(entity_type, data)
+
+    def commit(self):
+        pass
+
+    def reset(self):
+        self.resets += 1
+
+    def close(self):
+        pass
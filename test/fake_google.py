@@ -0,0 +1,271 @@
+'''
+An in-process stand-in for the parts of the Google Calendar v3 api the
+calendar updater uses (calendarList, calendars, events, acl, colors and batch
+requests), with a configurable round-trip latency and per-second quota, that
+counts every call it's asked to make.
+
+Lucid
+
+'''
+
+import collections
+import copy
+import itertools
+import threading
+import time
+
+import httplib2
+import simplejson as json
+from apiclient import errors
+
+
+COLORS = {
+    'calendar': {},
+    'event': {
+        '1': {'background': '#a4bdfc', 'foreground': '#1d1d1d'},
+        '2': {'background': '#7ae7bf', 'foreground': '#1d1d1d'},
+        '3': {'background': '#dbadff', 'foreground': '#1d1d1d'},
+        '4': {'background': '#ff887c', 'foreground': '#1d1d1d'},
+        '5': {'background': '#fbd75b', 'foreground': '#1d1d1d'},
+        '6': {'background': '#ffb878', 'foreground': '#1d1d1d'},
+        '7': {'background': '#46d6db', 'foreground': '#1d1d1d'},
+        '8': {'background': '#e1e1e1', 'foreground': '#1d1d1d'},
+        '9': {'background': '#5484ed', 'foreground': '#1d1d1d'},
+        '10': {'background': '#51b749', 'foreground': '#1d1d1d'},
+        '11': {'background': '#dc2127', 'foreground': '#1d1d1d'},
+    },
+}
+
+
+def http_error(status, reason=None):
+    content = {'error': {'code': status, 'errors': [{'reason': reason}] if reason else []}}
+    return errors.HttpError(httplib2.Response({'status': status}), json.dumps(content).encode('utf-8'))
+
+
+class FakeRequest(object):
+    '''
+    a request that runs a call on the fake when executed, like apiclient's HttpRequest
+    '''
+
+    def __init__(self, service, method_id, call):
+        self.service = service
+        self.methodId = method_id
+        self.call = call
+
+    def execute(self, http=None, num_retries=0):
+        self.service.round_trip('request')
+        return self.service.call(self.methodId, self.call)
+
+
+class FakeBatch(object):
+    '''
+    a batch of requests, sent in one round trip, like apiclient's BatchHttpRequest
+    '''
+
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback, request_id))
+
+    def execute(self, http=None):
+        self.service.round_trip('batch')
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = self.service.call(request.methodId, request.call), None
+            except errors.HttpError as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class Resource(object):
+    def __init__(self, service, name, methods):
+        self.service = service
+        self.name = name
+        self.methods = methods
+
+    def __getattr__(self, method):
+        if method not in self.methods:
+            raise AttributeError(method)
+
+        def build(**kwargs):
+            handler = self.methods[method]
+            return FakeRequest(self.service, 'calendar.{}.{}'.format(self.name, method),
+                lambda: handler(**kwargs))
+        return build
+
+
+class FakeCalendarService(object):
+    '''
+    Keeps calendars, their events and acls in memory.
+
+    Every round trip sleeps for ``latency`` seconds, and each call (batched or
+    not) counts against a quota of ``rate_limit`` calls a second, past which it
+    fails with the 403 google sends when it wants us to slow down.
+    '''
+
+    def __init__(self, latency=0.0, rate_limit=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+
+        self.calls = collections.Counter()
+        self.round_trips = collections.Counter()
+
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._sequence = itertools.count(1)
+        self._window = collections.deque()
+        self.calendar_store = collections.OrderedDict()
+        self.listed_calendars = []
+        self.event_store = {}
+        self.acl_store = collections.defaultdict(list)
+
+    # counting and pacing
+
+    def round_trip(self, kind):
+        with self._lock:
+            self.round_trips[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def call(self, method_id, call):
+        with self._lock:
+            self.calls[method_id] += 1
+            if self.rate_limit is not None:
+                now = time.time()
+                while self._window and now - self._window[0] >= 1.0:
+                    self._window.popleft()
+                if len(self._window) >= self.rate_limit:
+                    self.calls['rate_limited'] += 1
+                    raise http_error(403, 'rateLimitExceeded')
+                self._window.append(now)
+            return copy.deepcopy(call())
+
+    def total_calls(self):
+        with self._lock:
+            return sum(count for method, count in self.calls.items() if method != 'rate_limited')
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.round_trips.clear()
+
+    # the resources
+
+    def new_batch_http_request(self):
+        return FakeBatch(self)
+
+    def calendarList(self):
+        return Resource(self, 'calendarList', {
+            'list': self._calendar_list,
+            'insert': self._calendar_list_insert,
+        })
+
+    def calendars(self):
+        return Resource(self, 'calendars', {'insert': self._calendar_insert})
+
+    def acl(self):
+        return Resource(self, 'acl', {'insert': self._acl_insert})
+
+    def colors(self):
+        return Resource(self, 'colors', {'get': lambda: COLORS})
+
+    def events(self):
+        return Resource(self, 'events', {
+            'list': self._events_list,
+            'insert': self._event_insert,
+            'update': self._event_update,
+            'delete': self._event_delete,
+        })
+
+    # calendars
+
+    def _calendar_list(self, pageToken=None, **kwargs):
+        return {'items': [self.calendar_store[calendar_id] for calendar_id in self.listed_calendars]}
+
+    def _calendar_list_insert(self, body):
+        if body['id'] not in self.calendar_store:
+            raise http_error(404, 'notFound')
+        self.listed_calendars.append(body['id'])
+        return self.calendar_store[body['id']]
+
+    def _calendar_insert(self, body):
+        calendar_id = 'cal{}@group.calendar.google.com'.format(next(self._ids))
+        self.calendar_store[calendar_id] = dict(body, id=calendar_id)
+        self.event_store[calendar_id] = collections.OrderedDict()
+        return self.calendar_store[calendar_id]
+
+    def _acl_insert(self, calendarId, body):
+        self._calendar(calendarId)
+        rule = dict(body, id='rule{}'.format(next(self._ids)))
+        self.acl_store[calendarId].append(rule)
+        return rule
+
+    def _calendar(self, calendar_id):
+        if calendar_id == 'primary':
+            return self.event_store.setdefault(calendar_id, collections.OrderedDict())
+        if calendar_id not in self.event_store:
+            raise http_error(404, 'notFound')
+        return self.event_store[calendar_id]
+
+    # events
+
+    def _events_list(self, calendarId, maxResults=250, pageToken=None, syncToken=None, fields=None, **kwargs):
+        events = self._calendar(calendarId)
+        since = int(syncToken) if syncToken else 0
+
+        matching = [
+            event for event in events.values()
+            if event['sequence_number'] > since and (syncToken or event['status'] != 'cancelled')
+        ]
+        offset = int(pageToken or 0)
+        page = matching[offset:offset + maxResults]
+
+        response = {'items': [self._public(event) for event in page]}
+        if offset + maxResults < len(matching):
+            response['nextPageToken'] = str(offset + maxResults)
+        else:
+            response['nextSyncToken'] = str(max([0] + [e['sequence_number'] for e in events.values()]))
+        return response
+
+    def _event_insert(self, calendarId, body, sendNotifications=None):
+        events = self._calendar(calendarId)
+        event_id = body.get('id') or 'ev{}'.format(next(self._ids))
+        if event_id in events:
+            raise http_error(409, 'duplicate')
+        events[event_id] = dict(copy.deepcopy(body), id=event_id, status='confirmed',
+            sequence_number=next(self._sequence))
+        return self._public(events[event_id])
+
+    def _event_update(self, calendarId, eventId, body, sendNotifications=None):
+        events = self._calendar(calendarId)
+        if eventId not in events:
+            raise http_error(404, 'notFound')
+        # like google, updating a deleted event brings it back
+        events[eventId] = dict(copy.deepcopy(body), id=eventId, status='confirmed',
+            sequence_number=next(self._sequence))
+        return self._public(events[eventId])
+
+    def _event_delete(self, calendarId, eventId, sendNotifications=None):
+        events = self._calendar(calendarId)
+        if eventId not in events:
+            raise http_error(404, 'notFound')
+        if events[eventId]['status'] == 'cancelled':
+            raise http_error(410, 'deleted')
+        events[eventId] = {'id': eventId, 'status': 'cancelled', 'sequence_number': next(self._sequence)}
+        return ''
+
+    def _public(self, event):
+        event = dict(event)
+        event.pop('sequence_number', None)
+        return event
+
+    def live_events(self, calendar_id):
+        '''
+        returns the events on the calendar that haven't been deleted
+        '''
+        with self._lock:
+            return [self._public(event) for event in self._calendar(calendar_id).values()
+                if event['status'] != 'cancelled']
@@ -1,5 +1,6 @@
 import ftrack_api
 import os, sys
+import signal
 import logging
 
 # import setup for non-heroku
@@ -16,6 +17,9 @@ def main():
     logger = logging.getLogger(__name__)
     logging.basicConfig(level=logging.INFO)
 
+    # exit cleanly on SIGTERM (as heroku sends), so plugins can flush their queues
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     session = ftrack_api.Session()
 
     session.event_hub.wait()
@@ -0,0 +1,47 @@
+'''
+tests for the offline benchmark, and so for a whole sync against the fakes
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+
+pytest.importorskip("ftrack_api")
+
+sys.path.append(os.path.dirname(__file__))
+import benchmark
+
+
+def test_benchmark_runs_every_scenario():
+    rows = dict((row['scenario'], row) for row in benchmark.run(benchmark.parse_args([
+        '--tasks', '30', '--calendar-events', '5', '--single-events', '3', '--page-size', '10'
+    ])))
+
+    # registering doesn't wait on the updater, which is made in the background
+    assert rows["plugin register"]['wall_seconds'] < rows["updater import"]['wall_seconds']
+    assert rows["plugin register"]['google_calls'] == 0
+
+    cold = rows["whole project, cold"]
+    assert cold['entities'] == 35
+    assert cold['google_calls'] >= 35
+
+    # nothing changed, so nothing is written
+    assert rows["whole project, unchanged"]['google_calls'] == 0
+
+    # only the renamed tasks are written again
+    assert rows["whole project, tasks renamed, parallel"]['google_calls'] == 27
+    assert rows["single entity updates"]['google_calls'] == 3
+
+    # two instances hearing the same updates still write each one once
+    assert rows["single entity updates, 2 instances"]['google_writes'] == 3
+
+    # one delete each, whether it was heard about or swept up
+    assert rows["removals and orphan sweep"]['google_calls'] == 3
+
+    # only the entities still to come are read again, and they're all unchanged, so
+    # the only calls are the new process finding its calendar, sharing it and its colours
+    restart = rows["restart, catch up"]
+    assert 0 < restart['entities'] < 35
+    assert restart['google_calls'] == 3
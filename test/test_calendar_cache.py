@@ -0,0 +1,63 @@
+'''
+tests for calendar_cache.py
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+import time
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from calendar_cache import CalendarRegistry, ColorPalette
+
+
+def test_registry_caches_and_shares():
+    registry = CalendarRegistry(ttl=60)
+    assert registry.get("ftrack") is None
+
+    registry.put("ftrack", "abc@group.calendar.google.com")
+    assert registry.get("ftrack") == "abc@group.calendar.google.com"
+    assert not registry.is_shared("ftrack")
+
+    registry.mark_shared("ftrack")
+    assert registry.is_shared("ftrack")
+
+
+def test_registry_expiry_and_invalidation():
+    registry = CalendarRegistry(ttl=0)
+    registry.put("ftrack", "abc")
+    time.sleep(0.01)
+    assert registry.get("ftrack") is None
+
+    registry = CalendarRegistry(ttl=60)
+    registry.put("ftrack", "abc", shared=True)
+    registry.invalidate(calendar_id="abc")
+    assert registry.get("ftrack") is None
+    assert not registry.is_shared("ftrack")
+
+
+def test_palette_loaded_once_and_memo_bounded():
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return {'event': {'1': {'background': '#a4bdfc'}}}
+
+    palette = ColorPalette(ttl=60, size=2)
+    assert palette.event_colors(fetch) == {'1': {'background': '#a4bdfc'}}
+    palette.event_colors(fetch)
+    assert len(fetches) == 1
+
+    palette.put('#000000', '1')
+    palette.put('#111111', '2')
+    assert palette.get('#000000') == '1'
+    palette.put('#222222', '3')
+    assert list(palette.memo().keys()) == ['#000000', '#222222']
+    assert palette.cache_info()['hits'] == 1
+
+    palette.clear()
+    assert palette.get('#000000') is None
+    palette.event_colors(fetch)
+    assert len(fetches) == 2
@@ -0,0 +1,353 @@
+'''
+tests for google_calendar_tools.py, against the fake ftrack and google services
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+import itertools
+import threading
+import time
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+sys.path.append(os.path.dirname(__file__))
+import benchmark
+from fake_ftrack import FakeData, FakeSession, TASK_TYPE_ID
+from fake_google import FakeCalendarService, http_error
+from metrics import MetricsRegistry
+
+
+def make_updater(tmpdir, service=None, data=None, **settings):
+    service = service if service is not None else FakeCalendarService()
+    data = data if data is not None else FakeData(tasks=10, calendar_events=0, users=4)
+    args = benchmark.parse_args([])
+    return benchmark.make_updater(service, data, args, str(tmpdir), **settings)
+
+
+@pytest.fixture
+def updater(tmpdir):
+    updater = make_updater(tmpdir)
+    yield updater
+    updater.shutdown()
+
+
+def change(entity_type, entity_id='e1', action='update', keys=None, **payload):
+    return dict(payload, entityType=entity_type, entityId=entity_id, action=action, keys=keys)
+
+
+def assignment(context_id, kind='assignment'):
+    return change('appointment', 'a1', 'add', changes={
+        'type': {'new': kind, 'old': None},
+        'context_id': {'new': context_id, 'old': None},
+    })
+
+
+@pytest.mark.parametrize('entities, expected', [
+    # a relevant key changed, or the event doesn't say which
+    ([change('task', keys=['name'])], [('task', 'e1', 'update')]),
+    ([change('task', keys=None)], [('task', 'e1', 'update')]),
+    ([change('task', keys=['statusid'])], []),
+    ([change('calendarevent', keys=['start'])], [('calendarevent', 'e1', 'update')]),
+    # moves
+    ([change('task', keys=['parent_id'])], [('task', 'e1', 'update')]),
+    ([change('typedcontext', keys=['parentid'])], []),
+    # the project, only for the keys that change its events
+    ([change('show', keys=['color'])], [('show', 'e1', 'update')]),
+    ([change('show', keys=['name'])], []),
+    # types we don't put on the calendar
+    ([change('asset', keys=['name'])], []),
+    # removals, only of the types that may be on the calendar
+    ([change('task', action='remove')], [('task', 'e1', 'remove')]),
+    ([change('typedcontext', action='remove')], [('typedcontext', 'e1', 'remove')]),
+    ([change('show', action='remove')], []),
+    # assignments update the assigned context, other appointments are ignored
+    ([assignment('t1')], [('typedcontext', 't1', 'update')]),
+    ([assignment('t1', kind='review')], []),
+    # several changes to one entity are synced once
+    ([change('task', keys=['name']), change('task', keys=['enddate']), change('task', 'e2')],
+        [('task', 'e1', 'update'), ('task', 'e2', 'update')]),
+    # even when they come through as different types
+    ([change('task', 't1', objectTypeId=TASK_TYPE_ID), assignment('t1')], [('task', 't1', 'update')]),
+    ([change('task', 't1', keys=['name']), change('typedcontext', 't1', 'remove')],
+        [('typedcontext', 't1', 'remove')]),
+])
+def test_filter_entities(updater, entities, expected):
+    filtered = updater.filter_entities({'data': {'entities': entities}})
+    assert [(e['entityType'], e['entityId'], e['action']) for e in filtered] == expected
+
+
+@pytest.mark.parametrize('window, together', [(0, True), (0, False), (0.05, False)])
+def test_a_task_and_its_assignment_make_one_event(tmpdir, window, together):
+    service = FakeCalendarService(latency=0.01)
+    data = FakeData(tasks=2, calendar_events=0, users=4)
+    updater = make_updater(tmpdir, service, data, COALESCE_WINDOW=window)
+    try:
+        calendar = updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+        task_id = next(iter(data.entities['Task']))
+
+        # the task's own update comes through as a task, its assignment as a typedcontext
+        entities = [change('task', task_id, 'add', keys=['name'], objectTypeId=TASK_TYPE_ID),
+            assignment(task_id)]
+        events = [entities] if together else [[e] for e in entities]
+        for event in events:
+            updater.handle_ftrack_event({'data': {'entities': event}})
+        time.sleep(window)
+        updater.update_queue.flush()
+        benchmark.wait_idle(updater.workers)
+
+        assert service.calls['calendar.events.insert'] == 1
+        assert len(service.live_events(calendar)) == 1
+        assert updater.event_index(calendar).lookup('Task', task_id) is not None
+    finally:
+        updater.shutdown()
+
+
+def test_failed_start_stops_what_had_started(tmpdir):
+    threads = set(threading.enumerate())
+    metrics = MetricsRegistry()
+    # the coordination database can't be made under a file, after the workers have started
+    tmpdir.join('file').write('')
+    with pytest.raises(OSError):
+        make_updater(tmpdir, metrics=metrics, COORDINATION=True,
+            COORDINATION_PATH=str(tmpdir.join('file', 'coordination.db')))
+
+    assert [thread.name for thread in set(threading.enumerate()) - threads] == []
+    assert metrics._collectors == []
+
+
+def test_concurrent_syncs_create_one_calendar(tmpdir):
+    service = FakeCalendarService(latency=0.02)
+    updater = make_updater(tmpdir, service)
+    try:
+        ids = []
+        threads = [threading.Thread(target=lambda: ids.append(updater.ensure_calendar('ftrack')))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert service.calls['calendar.calendars.insert'] == 1
+        assert len(set(ids)) == 1
+
+        # after a 404 it's looked up again rather than created again
+        updater.calendar_registry.invalidate(calendar_id=ids[0])
+        assert updater.ensure_calendar('ftrack') == ids[0]
+        assert service.calls['calendar.calendars.insert'] == 1
+    finally:
+        updater.shutdown()
+
+
+def test_reconcile_writes_only_the_difference(tmpdir):
+    service = FakeCalendarService()
+    data = FakeData(tasks=10, calendar_events=2, users=4)
+    updater = make_updater(tmpdir, service, data)
+    try:
+        project_id = data.projects()[0]['id']
+        calendar = updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+
+        # a dry run reports what it would do, without writing anything
+        assert updater.reconcile_contexts([project_id], [project_id], dry_run=True) == {'insert': 12}
+        assert service.live_events(calendar) == []
+        assert updater.reconcile_contexts([project_id], [project_id]) == {'insert': 12}
+        assert len(service.live_events(calendar)) == 12
+
+        tasks = list(data.entities['Task'].values())
+        tasks[0]['name'] = 'Renamed'
+        del data.entities['Task'][tasks[1]['id']]
+        service.reset_counts()
+
+        expected = {'unchanged': 10, 'update': 1, 'delete': 1}
+        assert updater.reconcile_contexts([project_id], [project_id], dry_run=True) == expected
+        assert service.calls['calendar.events.update'] == service.calls['calendar.events.delete'] == 0
+        assert updater.reconcile_contexts([project_id], [project_id]) == expected
+
+        events = service.live_events(calendar)
+        assert len(events) == 11
+        assert 'Renamed | Project 0' in [event['summary'] for event in events]
+        assert updater.reconcile_contexts([project_id], [project_id]) == {'unchanged': 11}
+    finally:
+        updater.shutdown()
+
+
+def test_delegated_assignees_arent_invited_to_the_team_event(tmpdir):
+    service = FakeCalendarService()
+    users = {}
+    data = FakeData(tasks=10, calendar_events=0, users=4)
+    updater = make_updater(tmpdir, service, data, DELEGATED_CALENDARS=True,
+        user_service_factory=lambda email: users.setdefault(email, FakeCalendarService()))
+    try:
+        calendar = updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+        updater.reconcile_contexts([data.projects()[0]['id']])
+
+        # they have their own copy instead
+        assert [event['attendees'] for event in service.live_events(calendar)] == [[]] * 10
+        assert sum(len(user.live_events('primary')) for user in users.values()) > 0
+    finally:
+        updater.shutdown()
+
+
+def test_inserts_that_went_through_arent_made_twice(tmpdir, monkeypatch):
+    service = FakeCalendarService()
+    data = FakeData(tasks=10, calendar_events=0, users=4)
+    updater = make_updater(tmpdir, service, data)
+    updater.google.base_delay = 0.001
+
+    # every other insert is made, but its response is lost to a server error
+    call = service.call
+    inserts = itertools.count()
+
+    def lossy(method_id, request):
+        response = call(method_id, request)
+        if method_id == 'calendar.events.insert' and next(inserts) % 2 == 0:
+            raise http_error(503)
+        return response
+    monkeypatch.setattr(service, 'call', lossy)
+
+    try:
+        project_id = data.projects()[0]['id']
+        calendar = updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+        tasks = list(data.entities['Task'])
+
+        # one at a time, and in batches
+        updater.sync_updates([change('task', task_id, 'add', objectTypeId=TASK_TYPE_ID)
+            for task_id in tasks[:2]])
+        assert service.calls['calendar.events.update'] == 1
+        updater.reconcile_contexts([project_id])
+
+        keys = [event['extendedProperties']['private']['ftrack_id'] for event in service.live_events(calendar)]
+        assert sorted(keys) == sorted(tasks + list(data.entities['Milestone']))
+        assert updater.reconcile_contexts([project_id], [project_id]) == {'unchanged': 10}
+    finally:
+        updater.shutdown()
+
+
+def synced_project(tmpdir, service):
+    data = FakeData(tasks=10, calendar_events=2, users=4)
+    updater = make_updater(tmpdir, service, data)
+    project_id = data.projects()[0]['id']
+    updater.reconcile_contexts([project_id])
+    return data, updater, updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+
+
+def test_removed_entities_are_deleted(tmpdir):
+    service = FakeCalendarService()
+    data, updater, calendar = synced_project(tmpdir, service)
+    try:
+        task, milestone = data.entities['Task'].popitem()[0], data.entities['Milestone'].popitem()[0]
+        calendar_event = data.entities['CalendarEvent'].popitem()[0]
+
+        # a milestone comes through as a typedcontext, and a never-synced entity is skipped
+        updater.sync_updates([
+            change('task', task, 'remove'),
+            change('typedcontext', milestone, 'remove'),
+            change('calendarevent', calendar_event, 'remove'),
+            change('task', 'never-synced', 'remove'),
+        ])
+        assert service.calls['calendar.events.delete'] == 3
+        keys = [event['extendedProperties']['private']['ftrack_id'] for event in service.live_events(calendar)]
+        assert len(keys) == 9
+        assert not set(keys) & set([task, milestone, calendar_event])
+    finally:
+        updater.shutdown()
+
+
+def test_a_deleted_calendar_is_forgotten(tmpdir):
+    service = FakeCalendarService()
+    data, updater, calendar = synced_project(tmpdir, service)
+    try:
+        assert updater.sync_state.load(calendar)[0] is not None
+
+        # someone deletes the calendar on google
+        del service.event_store[calendar]
+        del service.calendar_store[calendar]
+        service.listed_calendars.remove(calendar)
+
+        task_id = next(iter(data.entities['Task']))
+        data.entities['Task'][task_id]['name'] = 'Renamed'
+        updater.sync_updates([change('task', task_id, keys=['name'], objectTypeId=TASK_TYPE_ID)])
+
+        # the saved index isn't loaded again, and the task is on the new calendar
+        assert updater.sync_state.load(calendar) == (None, None, [])
+        new_calendar = updater.ensure_calendar(updater.TEAM_CALENDAR_NAME)
+        assert new_calendar != calendar
+        assert len(service.live_events(new_calendar)) == 1
+    finally:
+        updater.shutdown()
+
+
+def test_orphans_are_swept(tmpdir, monkeypatch):
+    service = FakeCalendarService()
+    data, updater, calendar = synced_project(tmpdir, service)
+    try:
+        # deleted while nobody was listening
+        for _ in range(2):
+            data.entities['Task'].popitem()
+
+        assert updater.sweep_orphans(dry_run=True) == {'checked': 12, 'delete': 2}
+        assert service.calls['calendar.events.delete'] == 0
+
+        # a lookup that fails deletes none of its batch
+        query = FakeSession.query
+        monkeypatch.setattr(FakeSession, 'query', lambda session, expression, **kwargs:
+            1 / 0 if ' from Task ' in expression else query(session, expression, **kwargs))
+        assert updater.sweep_orphans() == {'checked': 3, 'failed_queries': 1}
+        monkeypatch.undo()
+
+        assert updater.sweep_orphans() == {'checked': 12, 'delete': 2}
+        assert len(service.live_events(calendar)) == 10
+        assert updater.sweep_orphans() == {'checked': 10}
+    finally:
+        updater.shutdown()
+
+
+def test_instances_sync_only_their_own_share(tmpdir):
+    service = FakeCalendarService()
+    data = FakeData(tasks=20, calendar_events=0, users=4)
+    settings = dict(COORDINATION=True, COORDINATION_LEASE=0.3,
+        COORDINATION_PATH=str(tmpdir.join('coordination.db')))
+    first = make_updater(tmpdir, service, data, INSTANCE_ID='a', **settings)
+    time.sleep(0.1)
+    second = make_updater(tmpdir, service, data, INSTANCE_ID='b', **settings)
+
+    def settle():
+        # long enough for both to have taken their share, and any work handed to them
+        time.sleep(0.4)
+        for updater in (first, second):
+            benchmark.wait_idle(updater.project_workers)
+            benchmark.wait_idle(updater.workers)
+
+    try:
+        settle()
+        project = {'entityType': 'show', 'entityId': data.projects()[0]['id']}
+        calendar = first.ensure_calendar(first.TEAM_CALENDAR_NAME)
+
+        # the leader syncs its share of the project, and hands the rest to b
+        assert first.is_leader() and not second.is_leader()
+        first.sync_selection([project])
+        settle()
+        assert service.calls['calendar.events.insert'] == 20
+        assert len(service.live_events(calendar)) == 20
+
+        # new tasks are synced by their owners, while the other's index has yet to see them
+        template = dict(next(iter(data.entities['Task'].values())))
+        added = []
+        while len(set(first.owns(task['id']) for task in added)) < 2:
+            added.append(data.add('Task', dict(template, name='New task {}'.format(len(added)))))
+        event = {'data': {'entities': [change('task', task['id'], 'add') for task in added]}}
+        for updater in (first, second):
+            updater.handle_ftrack_event(event)
+        settle()
+
+        # so a second sync of the project, from either, doesn't write them again
+        second.sync_selection([project])
+        settle()
+        first.reconcile_contexts([project['entityId']], [project['entityId']])
+        settle()
+        assert service.calls['calendar.events.insert'] == 20 + len(added)
+        assert len(service.live_events(calendar)) == 20 + len(added)
+    finally:
+        second.shutdown()
+        first.shutdown()
@@ -0,0 +1,101 @@
+'''
+tests for coordination.py
+
+Lucid
+
+'''
+
+import sys, os
+import sqlite3
+import threading
+import time
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from coordination import ShardCoordinator
+
+
+def test_instances_share_out_keys_and_take_over(tmpdir):
+    path = str(tmpdir.join("state", "coordination.db"))
+    changes = []
+
+    first = ShardCoordinator(path, instance_id='a', lease_seconds=0.3,
+        on_change=lambda *change: changes.append(change))
+    time.sleep(0.2)
+    second = ShardCoordinator(path, instance_id='b', lease_seconds=0.3)
+    first.heartbeat()
+    assert changes == [(['b'], {})]
+
+    keys = ['entity{}'.format(index) for index in range(200)]
+    assert first.members == second.members == ['a', 'b']
+    assert first.is_leader and not second.is_leader
+
+    # b doesn't take its share until a has surely seen it
+    assert all(first.owns(key) and not second.owns(key) for key in keys)
+    time.sleep(0.2)
+    first.heartbeat()
+    second.heartbeat()
+
+    # every key has exactly one owner, and the work is split roughly evenly
+    owned = [key for key in keys if first.owns(key)]
+    assert sorted(owned + [key for key in keys if second.owns(key)]) == sorted(keys)
+    assert 50 < len(owned) < 150
+
+    # once b is gone, a owns its keys too, and hears when b last beat
+    second.release()
+    first.heartbeat()
+    assert first.members == ['a']
+    assert all(first.owns(key) for key in keys)
+    assert list(changes[-1][1]) == ['b']
+
+    # a lease that isn't renewed runs out
+    third = ShardCoordinator(path, instance_id='c', lease_seconds=0.05)
+    assert third.members == ['a', 'c']
+    time.sleep(0.1)
+    third.heartbeat()
+    assert third.members == ['c']
+    assert third.is_leader
+    first.release()
+    third.release()
+
+
+def test_work_is_handed_off_and_taken_over(tmpdir):
+    path = str(tmpdir.join("coordination.db"))
+    taken = dict((name, []) for name in 'abc')
+    first, second, third = [ShardCoordinator(path, instance_id=name, lease_seconds=5,
+        on_handoff=taken[name].append) for name in 'abc']
+    for coordinator in (first, second):
+        coordinator.heartbeat()
+
+    assert first.hand_off({'kind': 'sync', 'ids': [1]}) == ['b', 'c']
+    assert second.take_handoffs() == 1
+    assert second.take_handoffs() == 0
+    assert taken['b'] == [{'kind': 'sync', 'ids': [1]}]
+
+    # c leaves before taking its work, so it's handed to everyone left
+    third.release()
+    first.heartbeat()
+    assert first.take_handoffs() == second.take_handoffs() == 1
+    assert taken['a'] == [{'kind': 'sync', 'ids': [1]}]
+    assert taken['c'] == []
+    first.release()
+    second.release()
+
+
+def test_owning_doesnt_wait_on_the_database(tmpdir):
+    path = str(tmpdir.join("coordination.db"))
+    coordinator = ShardCoordinator(path, instance_id='a', lease_seconds=2)
+
+    # another instance holds a write transaction, which the heartbeat waits out
+    other = sqlite3.connect(path)
+    other.execute('begin exclusive')
+    heartbeat = threading.Thread(target=coordinator.heartbeat)
+    heartbeat.start()
+    time.sleep(0.1)
+
+    started = time.time()
+    assert coordinator.owns('entity') and coordinator.is_leader
+    assert time.time() - started < 0.5
+
+    other.rollback()
+    other.close()
+    heartbeat.join()
@@ -0,0 +1,108 @@
+'''
+tests for event_index.py
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from event_index import EventIndex, HASH_PROPERTY, PROJECT_PROPERTY, event_hash
+
+
+class ListRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class Events(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        return ListRequest(self.pages.pop(0))
+
+
+class Service(object):
+    def __init__(self, pages):
+        self._events = Events(pages)
+
+    def events(self):
+        return self._events
+
+
+def ftrack_event(event_id, ftrack_id, body_hash=None, project_id=None):
+    private = {'ftrack_id': ftrack_id, 'ftrack_type': 'Task'}
+    if body_hash is not None:
+        private[HASH_PROPERTY] = body_hash
+    if project_id is not None:
+        private[PROJECT_PROPERTY] = project_id
+    return {'id': event_id, 'status': 'confirmed', 'extendedProperties': {'private': private}}
+
+
+def test_index_builds_from_pages_then_syncs():
+    service = Service([
+        {'items': [ftrack_event('e1', 't1', 'h1'), {'id': 'other', 'status': 'confirmed'}],
+         'nextPageToken': 'p2'},
+        {'items': [ftrack_event('e2', 't2')], 'nextSyncToken': 's1'},
+        {'items': [{'id': 'e1', 'status': 'cancelled'}, ftrack_event('e3', 't3')],
+         'nextSyncToken': 's2'},
+    ])
+    index = EventIndex(service, 'cal')
+    index.build()
+
+    assert index.lookup('Task', 't1') == 'e1'
+    assert index.body_hash('e1') == 'h1'
+    assert index.lookup('Task', 't2') == 'e2'
+    assert len(index) == 2
+
+    index.sync()
+    assert service.events().calls[-1]['syncToken'] == 's1'
+    assert index.lookup('Task', 't1') is None
+    assert index.lookup('Task', 't3') == 'e3'
+    assert index.sync_token == 's2'
+
+
+def test_duplicate_events_raise():
+    service = Service([
+        {'items': [ftrack_event('e1', 't1'), ftrack_event('e2', 't1')], 'nextSyncToken': 's1'},
+    ])
+    index = EventIndex(service, 'cal')
+    index.build()
+
+    with pytest.raises(NotImplementedError):
+        index.lookup('Task', 't1')
+
+
+def test_entries_by_project():
+    service = Service([
+        {'items': [ftrack_event('e1', 't1', project_id='p1'), ftrack_event('e2', 't2', project_id='p2')],
+         'nextSyncToken': 's1'},
+    ])
+    index = EventIndex(service, 'cal')
+    index.build()
+    index.apply(ftrack_event('e3', 't3', 'h3', project_id='p1'))
+
+    assert sorted(index.entries(['p1'])) == [(('Task', 't1'), 'e1'), (('Task', 't3'), 'e3')]
+    assert len(index.entries()) == 3
+    assert index.body_hash('e3') == 'h3'
+
+    index.discard('e1')
+    assert index.entries(['p1']) == [(('Task', 't3'), 'e3')]
+
+
+def test_event_hash_ignores_the_hash_property():
+    event = ftrack_event('e1', 't1')
+    body_hash = event_hash(event)
+    event['extendedProperties']['private'][HASH_PROPERTY] = body_hash
+    assert event_hash(event) == body_hash
+
+    event['summary'] = 'changed'
+    assert event_hash(event) != body_hash
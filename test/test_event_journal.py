@@ -0,0 +1,61 @@
+'''
+tests for event_journal.py
+
+Lucid
+
+'''
+
+import sys, os
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from event_journal import EventJournal
+
+
+def update(entity_id, entity_type='task'):
+    return {'entityType': entity_type, 'entityId': entity_id, 'action': 'update'}
+
+
+def test_unfinished_updates_are_replayed(tmpdir):
+    path = str(tmpdir.join("state", "journal.jsonl"))
+    journal = EventJournal(path)
+    assert journal.checkpoint_time is None
+
+    first = journal.append(update('t1'), received_at=1.0)
+    second = journal.append(update('t2'), received_at=2.0)
+    third = journal.append(update('t1'), received_at=3.0)
+
+    # out of order, so the checkpoint can't pass the second yet -- and the later
+    # update to t1 covers the earlier one
+    journal.done(third)
+    assert journal.offset == first
+    assert len(journal) == 1
+    journal.close()
+
+    # the process stops with the second still in flight, and the last line cut short
+    with open(path, 'a') as f:
+        f.write('{"seq": 4, "at"')
+
+    journal = EventJournal(path)
+    assert journal.checkpoint_time is not None
+    assert journal.unprocessed() == [(second, 2.0, update('t2'))]
+
+    journal.done(second)
+    assert journal.offset == third
+    assert journal.append(update('t3')) == third + 1
+    journal.close()
+
+
+def test_done_entries_are_compacted(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    journal = EventJournal(path, compact_size=3)
+
+    seqs = [journal.append(update('t{}'.format(index))) for index in range(4)]
+    for seq in seqs[1:]:
+        journal.done(seq)
+
+    # three are done, but the first isn't, so it's all that's left
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+    journal.close()
+
+    assert [seq for seq, _, _ in EventJournal(path).unprocessed()] == seqs[:1]
@@ -0,0 +1,86 @@
+'''
+tests for event_queue.py
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+import time
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from event_queue import CoalescingQueue, KeyedWorkerPool, WorkGroup
+
+
+def test_updates_to_one_entity_are_coalesced():
+    handled = []
+    queue = CoalescingQueue(handled.extend, window=0.1)
+
+    for version in range(10):
+        queue.submit(('task', 'a'), ('a', version))
+    queue.submit(('task', 'b'), ('b', 0))
+
+    time.sleep(0.3)
+    assert handled == [('a', 9), ('b', 0)]
+    queue.close()
+
+
+def test_close_flushes_pending_updates():
+    handled = []
+    queue = CoalescingQueue(handled.extend, window=60)
+
+    queue.submit(('task', 'a'), 'a')
+    queue.close()
+    assert handled == ['a']
+
+    with pytest.raises(RuntimeError):
+        queue.submit(('task', 'b'), 'b')
+
+
+def test_pending_keys_are_bounded():
+    handled = []
+    queue = CoalescingQueue(handled.extend, window=60, max_pending=2)
+
+    for key in range(5):
+        queue.submit(key, key)
+        assert len(queue) <= 2
+
+    queue.close()
+    assert sorted(handled) == list(range(5))
+
+
+def test_worker_pool_keeps_order_per_key():
+    handled = []
+    pool = KeyedWorkerPool(size=3, queue_size=2)
+
+    for version in range(20):
+        pool.submit(('task', version % 2), handled.append, (version % 2, version))
+    pool.close()
+
+    for key in (0, 1):
+        versions = [version for k, version in handled if k == key]
+        assert versions == sorted(versions)
+
+    stats = pool.stats()
+    assert stats['completed'] == 20
+    assert stats['depth'] == 0
+
+
+def test_work_group_reports_once_everything_ran():
+    reports = []
+    pool = KeyedWorkerPool(size=3)
+    group = WorkGroup(['a', 'b', 'c'], reports.append)
+
+    def fail():
+        raise ValueError("nope")
+
+    pool.submit('a', group.run, 'a', lambda: 1)
+    pool.submit('b', group.run, 'b', fail)
+    pool.submit('c', group.run, 'c', lambda: 3)
+    pool.close()
+
+    assert len(reports) == 1
+    assert reports[0]['a'] == (1, None)
+    assert isinstance(reports[0]['b'][1], ValueError)
+    assert pool.stats()['failed'] == 1
@@ -0,0 +1,85 @@
+'''
+tests for google_batch.py
+
+Lucid
+
+'''
+
+import sys, os
+import collections
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+sys.path.append(os.path.dirname(__file__))
+from google_batch import BatchExecutor
+from google_client import RequestExecutor, TokenBucket
+from fake_google import FakeCalendarService, FakeRequest, http_error
+
+
+def make_batches(service, **kwargs):
+    executor = RequestExecutor(TokenBucket(1000, 1000), base_delay=0.001)
+    return executor, BatchExecutor(service, executor, **kwargs)
+
+
+def flaky_request(service, failures):
+    '''
+    a request that fails with each of the errors in turn, then succeeds
+    '''
+    failures = list(failures)
+
+    def call():
+        if failures:
+            raise failures.pop(0)
+        return {'ok': True}
+    return FakeRequest(service, 'calendar.events.update', call)
+
+
+def test_only_failed_items_are_retried():
+    service = FakeCalendarService()
+    executor, batches = make_batches(service)
+
+    # a full chunk: every 5th item is missing, and the one after it throttled once
+    requests = []
+    for index in range(50):
+        failures = {0: [http_error(404, 'notFound')], 1: [http_error(403, 'rateLimitExceeded')]}
+        requests.append((index, flaky_request(service, failures.get(index % 5, []))))
+
+    outcomes = collections.defaultdict(list)
+    results = batches.execute(requests, lambda key, response, exception: outcomes[key].append(exception))
+
+    # one batch with everything, then one with just the 10 throttled items
+    assert service.round_trips['batch'] == 2
+    assert service.calls['calendar.events.update'] == 60
+    assert executor.stats()['throttled'] == 10
+
+    # every item is called back exactly once, with its final outcome
+    assert sorted(outcomes) == list(range(50))
+    assert all(len(exceptions) == 1 for exceptions in outcomes.values())
+    missing = sorted(key for key, (exception,) in outcomes.items() if exception is not None)
+    assert missing == list(range(0, 50, 5))
+    assert all(outcomes[key][0].resp.status == 404 for key in missing)
+    assert sorted(results) == [key for key in range(50) if key % 5]
+
+
+def test_items_are_chunked_by_batch_size():
+    service = FakeCalendarService()
+    _, batches = make_batches(service, batch_size=500)
+    assert batches.batch_size == BatchExecutor.MAX_BATCH_SIZE
+
+    results = batches.execute((index, flaky_request(service, [])) for index in range(120))
+    assert len(results) == 120
+    assert service.round_trips['batch'] == 3
+
+
+def test_retries_give_up_after_max_retries():
+    service = FakeCalendarService()
+    _, batches = make_batches(service, max_retries=2)
+    throttled = [http_error(403, 'rateLimitExceeded') for _ in range(5)]
+
+    outcomes = []
+    results = batches.execute([('a', flaky_request(service, throttled))],
+        lambda key, response, exception: outcomes.append((key, exception)))
+
+    assert results == {}
+    assert service.calls['calendar.events.update'] == 3
+    (key, exception), = outcomes
+    assert key == 'a' and exception.resp.status == 403
@@ -0,0 +1,131 @@
+'''
+tests for google_calendar_hook.py
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+import threading
+
+pytest.importorskip("ftrack_api")
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "hook"))
+sys.path.append(os.path.dirname(__file__))
+import google_calendar_hook
+from benchmark import hub_session
+
+
+class Workers(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, key, fn, *args):
+        self.submitted.append((key, fn, args))
+
+
+class Updater(object):
+    CATCH_UP_MARGIN = 300
+
+    def __init__(self, leader=True):
+        self.leader = leader
+        self.events = []
+        self.project_workers = Workers()
+
+    def handle_ftrack_event(self, event):
+        self.events.append(event)
+
+    def catch_up(self, since):
+        pass
+
+    def is_leader(self):
+        return self.leader
+
+    def handle_whole_project(self, event):
+        self.events.append(event)
+        return {'success': True}
+
+    def shutdown(self):
+        pass
+
+
+def subscribed(session, topic):
+    return [callback for subscription, callback in session.event_hub.subscriptions if topic in subscription]
+
+
+def test_only_the_leader_offers_and_runs_actions():
+    updaters = [Updater(leader=True), Updater(leader=False)]
+    sessions = [hub_session() for _ in updaters]
+    lazy = [google_calendar_hook.register(session, updater_factory=lambda updater=updater: updater)
+        for session, updater in zip(sessions, updaters)]
+    for cal in lazy:
+        cal.get()
+
+    event = {'topic': 'ftrack.action.launch', 'data': {'selection': []}}
+    (leader_discover,), (other_discover,) = [subscribed(session, 'discover') for session in sessions]
+    assert len(leader_discover({'topic': 'ftrack.action.discover'})['items']) == 3
+    assert other_discover({'topic': 'ftrack.action.discover'}) is None
+
+    (leader_launch,), (other_launch,) = [subscribed(session, google_calendar_hook.ACTION_IDENTIFIER)
+        for session in sessions]
+    assert leader_launch(event) == {'success': True}
+    assert other_launch(event) is None
+    assert updaters[0].events == [event] and updaters[1].events == []
+
+
+def test_actions_are_offered_while_the_updater_starts():
+    updater = Updater()
+    building = threading.Event()
+
+    def factory():
+        building.wait()
+        return updater
+
+    session = hub_session()
+    cal = google_calendar_hook.register(session, updater_factory=factory)
+    (discover,), (launch,) = [subscribed(session, topic)
+        for topic in ('discover', google_calendar_hook.ACTION_IDENTIFIER)]
+
+    # it may not be coordinated with other instances, so we can't leave it to them
+    event = {'topic': 'ftrack.action.launch', 'data': {'selection': []}}
+    assert len(discover({'topic': 'ftrack.action.discover'})['items']) == 3
+    assert launch(event) is None
+
+    # the launch is held for the updater, which decides for itself
+    building.set()
+    assert cal.get(timeout=5) is updater
+    assert updater.events == [event]
+
+
+def test_updater_is_created_off_the_hub_and_gets_held_events():
+    updater = Updater()
+    building = threading.Event()
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise IOError("google is down")
+        building.wait()
+        return updater
+
+    cal = google_calendar_hook.LazyUpdater(factory)
+    cal.RETRY_DELAY = 0.01
+    cal.PENDING_LIMIT = 2
+    handle = cal.handler('handle_ftrack_event')
+
+    # the hub carries on while the updater is made, failing twice, in the background
+    events = [{'data': {'entities': [index]}} for index in range(4)]
+    for event in events:
+        assert handle(event) is None
+    assert cal.get(timeout=0.2) is None
+    assert len(attempts) == 3
+
+    # held events go first, and the ones dropped are caught up on
+    building.set()
+    assert cal.get(timeout=5) is updater
+    handle(events[0])
+    assert updater.events == events[:2] + events[:1]
+    (key, fn, args), = updater.project_workers.submitted
+    assert key == ('catch-up',) and fn == updater.catch_up
@@ -12,6 +12,7 @@ import sys, os
 import setup
 
 sys.path.append("plugin_root")
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
 from ftrack_google_calendar.resource.google_calendar_tools import CalendarUpdater
 
 def test_setup_calendar_and_share():
@@ -0,0 +1,119 @@
+'''
+tests for google_client.py
+
+Lucid
+
+'''
+
+import pytest
+import sys, os
+
+import httplib2
+import simplejson as json
+from apiclient import errors
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from google_client import RequestExecutor, TokenBucket, is_retryable_error, load_discovery_document
+
+
+def http_error(status, reason=None, retry_after=None):
+    headers = {'status': status}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode('utf-8')
+    return errors.HttpError(httplib2.Response(headers), content)
+
+
+class FlakyRequest(object):
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return {'ok': True}
+
+
+def test_retryable_errors():
+    assert is_retryable_error(http_error(403, 'userRateLimitExceeded'))
+    assert is_retryable_error(http_error(429))
+    assert is_retryable_error(http_error(503))
+    assert not is_retryable_error(http_error(403, 'forbidden'))
+    assert not is_retryable_error(http_error(404))
+
+
+def test_executor_retries_rate_limits_and_counts_them():
+    executor = RequestExecutor(TokenBucket(1000, 1000), base_delay=0.001)
+    request = FlakyRequest([http_error(403, 'rateLimitExceeded'), http_error(500)])
+
+    assert executor.execute(request) == {'ok': True}
+    assert request.calls == 3
+
+    stats = executor.stats()
+    assert stats['requests'] == 3
+    assert stats['retries'] == 2
+    assert stats['throttled'] == 1
+
+
+def test_executor_gives_up_on_other_errors():
+    executor = RequestExecutor(TokenBucket(1000, 1000), base_delay=0.001)
+    request = FlakyRequest([http_error(404)])
+
+    with pytest.raises(errors.HttpError):
+        executor.execute(request)
+    assert executor.stats()['failures'] == 1
+
+
+def test_executor_only_retries_refusals_of_requests_that_arent_idempotent():
+    executor = RequestExecutor(TokenBucket(1000, 1000), base_delay=0.001)
+    request = FlakyRequest([http_error(429), http_error(503)])
+
+    # the server error may have come after the request was carried out
+    with pytest.raises(errors.HttpError):
+        executor.execute(request, idempotent=False)
+    assert request.calls == 2
+
+
+def test_backoff_honours_retry_after():
+    executor = RequestExecutor(TokenBucket(1, 1), base_delay=1.0, max_delay=30)
+    assert executor.backoff_delay(0, http_error(429, retry_after=7)) == 7
+    assert 4 <= executor.backoff_delay(2) <= 5
+
+
+def test_token_bucket_waits_once_empty():
+    bucket = TokenBucket(rate=100, capacity=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+
+
+def test_token_bucket_charges_batches_bigger_than_it_holds():
+    bucket = TokenBucket(rate=100, capacity=10)
+    # a full bucket lets the batch through, but all 50 are paid back before the next
+    assert bucket.acquire(50) == 0
+    assert bucket.acquire() >= 0.35
+
+
+def test_discovery_document_is_read_from_the_cache(tmpdir):
+    tmpdir.join('calendar-v3.json').write('{"name": "calendar"}')
+    document = load_discovery_document('calendar', 'v3', str(tmpdir))
+    assert json.loads(document) == {'name': 'calendar'}
+
+
+def test_discovery_document_is_fetched_with_a_timeout(tmpdir, monkeypatch):
+    timeouts = []
+
+    class Http(object):
+        def __init__(self, timeout=None):
+            timeouts.append(timeout)
+
+        def request(self, url):
+            return httplib2.Response({'status': 200}), b'{"name": "calendar"}'
+
+    monkeypatch.setattr(httplib2, 'Http', Http)
+    document = load_discovery_document('calendar', 'v3', str(tmpdir), timeout=7)
+    assert json.loads(document) == {'name': 'calendar'}
+    assert timeouts == [7]
+    assert tmpdir.join('calendar-v3.json').check()
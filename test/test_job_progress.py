@@ -0,0 +1,74 @@
+'''
+tests for job_progress.py
+
+Lucid
+
+'''
+
+import sys, os
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from job_progress import JobProgress, format_duration
+
+
+class Query(object):
+    def __init__(self, job):
+        self.job = job
+
+    def one(self):
+        return self.job
+
+
+class Session(object):
+    def __init__(self):
+        self.job = None
+        self.commits = 0
+        self.closed = False
+
+    def create(self, entity_type, data):
+        self.job = dict(data, id='job-1')
+        return self.job
+
+    def query(self, expression):
+        return Query(self.job)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+def test_progress_updates_and_notices_cancellation():
+    sessions = []
+
+    def session_factory():
+        sessions.append(Session())
+        return sessions[-1]
+
+    job = JobProgress(session_factory, 'user-1', "Calendar sync", update_interval=0)
+    job.start()
+    job.start()
+    session, = sessions
+    assert session.commits == 1
+
+    job.add_total(100)
+    job.advance(25)
+    assert '25/100 entities' in session.job['data']
+    assert session.job['status'] == 'running'
+    assert not job.cancelled
+
+    session.job['status'] = 'killed'
+    job.advance(25)
+    assert job.cancelled
+
+    # every update went through the Job's one session, closed once it's finished
+    job.finish()
+    assert session.job['status'] == 'killed'
+    assert len(sessions) == 1 and session.closed
+
+
+def test_format_duration():
+    assert format_duration(12) == "12s"
+    assert format_duration(200) == "3m 20s"
+    assert format_duration(3840) == "1h 4m"
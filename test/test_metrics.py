@@ -0,0 +1,49 @@
+'''
+tests for metrics.py
+
+Lucid
+
+'''
+
+import sys, os
+
+from six.moves.urllib.request import urlopen
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from metrics import MetricsRegistry
+
+
+def test_renders_prometheus_text():
+    metrics = MetricsRegistry(prefix='test_')
+    metrics.describe('lookups_total', 'counter', "lookups")
+    metrics.inc('lookups_total', result='hit')
+    metrics.inc('lookups_total', 2, result='hit')
+    metrics.observe('query_seconds', 0.02, entity_type='Task')
+    metrics.observe('query_seconds', 7, entity_type='Task')
+    metrics.collect(lambda: [('queue_depth', 'gauge', {'pool': 'workers'}, 3)])
+
+    text = metrics.render()
+
+    assert '# HELP test_lookups_total lookups' in text
+    assert 'test_lookups_total{result="hit"} 3.0' in text
+    assert '# TYPE test_queue_depth gauge' in text
+    assert 'test_queue_depth{pool="workers"} 3.0' in text
+    assert 'test_query_seconds_bucket{entity_type="Task",le="0.025"} 1' in text
+    assert 'test_query_seconds_bucket{entity_type="Task",le="+Inf"} 2' in text
+    assert 'test_query_seconds_count{entity_type="Task"} 2' in text
+
+
+def test_serves_and_writes(tmpdir):
+    metrics = MetricsRegistry(prefix='test_')
+    metrics.inc('calls_total')
+
+    server = metrics.serve(0)
+    try:
+        body = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read()
+    finally:
+        server.shutdown()
+    assert b'test_calls_total 1.0' in body
+
+    path = str(tmpdir.join("metrics", "calendar.prom"))
+    metrics.write(path)
+    assert 'test_calls_total 1.0' in open(path).read()
@@ -0,0 +1,33 @@
+'''
+tests for schema_aliases.py
+
+Lucid
+
+'''
+
+import sys, os
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from schema_aliases import SchemaAliasIndex
+
+
+SCHEMAS = [
+    {'id': 'Context'},
+    {'id': 'Task', 'alias_for': {'id': 'Task', 'classifiers': {'object_typeid': 'task-type'}}},
+    {'id': 'Milestone', 'alias_for': {'id': 'Task', 'classifiers': {'object_typeid': 'milestone-type'}}},
+    {'id': 'TypedContext', 'alias_for': 'Task'},
+    {'id': 'Project', 'alias_for': 'Show'},
+    {'id': 'CalendarEvent'},
+]
+
+
+def test_resolves_in_scan_order():
+    aliases = SchemaAliasIndex(SCHEMAS)
+
+    assert aliases.resolve('task', 'milestone-type') == 'Milestone'
+    assert aliases.resolve('task', 'task-type') == 'Task'
+    # no object type that's aliased falls back to the name alias
+    assert aliases.resolve('task', 'shot-type') == 'TypedContext'
+    assert aliases.resolve('show') == 'Project'
+    assert aliases.resolve('calendarevent') == 'CalendarEvent'
+    assert aliases.resolve('unknown') is None
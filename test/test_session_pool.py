@@ -0,0 +1,117 @@
+'''
+tests for session_pool.py
+
+Lucid
+
+'''
+
+import sys, os
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+from session_pool import SessionPool, create_session
+
+
+class Session(object):
+    def __init__(self, number):
+        self.number = number
+        self.resets = 0
+        self.closed = False
+
+    def reset(self):
+        self.resets += 1
+
+    def close(self):
+        self.closed = True
+
+
+def counting_factory():
+    created = []
+
+    def factory():
+        created.append(Session(len(created)))
+        return created[-1]
+    return created, factory
+
+
+def test_sessions_are_reused_and_reset():
+    created, factory = counting_factory()
+    pool = SessionPool(size=2, factory=factory)
+
+    with pool.session() as first:
+        with pool.session() as second:
+            assert first is not second
+    # the last one handed back, whose connections are likeliest to still be open
+    with pool.session() as again:
+        assert again is first
+
+    assert len(created) == 2
+    assert (first.resets, second.resets) == (2, 1)
+
+    pool.close()
+    assert all(session.closed for session in created)
+
+
+def test_exhausted_pool_waits_for_a_session():
+    created, factory = counting_factory()
+    pool = SessionPool(size=1, factory=factory)
+    held = pool.acquire()
+    got = []
+
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    # nothing more is created past the size, it waits for the one in use
+    assert got == [] and len(created) == 1
+
+    pool.release(held)
+    waiter.join(1)
+    assert got == [held]
+
+
+def test_failed_create_frees_its_place():
+    def factory():
+        raise RuntimeError("no server")
+    pool = SessionPool(size=1, factory=factory)
+
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    pool.factory = lambda: Session(0)
+    assert pool.acquire().number == 0
+
+
+class SchemasLoaded(Exception):
+    pass
+
+
+def test_pooled_sessions_dont_register_plugins(tmpdir, monkeypatch):
+    ftrack_api = pytest.importorskip("ftrack_api")
+
+    # a plugin on the path, as the plugin host sets it, noting every register
+    registered = tmpdir.join("registered")
+    tmpdir.join("plugin.py").write(
+        "def register(session, **kw):\n"
+        "    open({!r}, 'a').write('x')\n".format(str(registered)))
+    monkeypatch.setenv('FTRACK_EVENT_PLUGIN_PATH', str(tmpdir))
+    monkeypatch.setenv('FTRACK_SERVER', 'https://example.ftrackapp.com')
+    monkeypatch.setenv('FTRACK_API_KEY', 'key')
+    monkeypatch.setenv('FTRACK_API_USER', 'user')
+
+    # no server: plugins are discovered after checking it, and before the schemas
+    # are fetched, so stop there
+    def load_schemas(session, schema_cache_path):
+        raise SchemasLoaded()
+    monkeypatch.setattr(ftrack_api.Session, '_fetch_server_information', lambda session: {})
+    monkeypatch.setattr(ftrack_api.Session, 'check_server_compatibility', lambda session: None)
+    monkeypatch.setattr(ftrack_api.Session, '_load_schemas', load_schemas)
+
+    with pytest.raises(SchemasLoaded):
+        ftrack_api.Session(auto_connect_event_hub=False)
+    assert registered.read() == 'x'
+
+    with pytest.raises(SchemasLoaded):
+        create_session()
+    assert registered.read() == 'x'
@@ -0,0 +1,56 @@
+'''
+tests for sync_state.py
+
+Lucid
+
+'''
+
+import sys, os
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+sys.path.append(os.path.dirname(__file__))
+from sync_state import SyncStateStore
+from event_index import EventIndex
+from test_event_index import Service, ftrack_event
+
+
+def test_store_writes_in_batches_and_replaces(tmpdir):
+    store = SyncStateStore(str(tmpdir.join("state", "sync.db")))
+    assert store.load('cal') == (None, None, [])
+
+    store.write('cal', {'e1': ('Task', 't1', 'p1', 'h1'), 'e2': ('Task', 't2', None, None)},
+        sync_token='s1', synced_at=10.0)
+    store.write('cal', {'e2': None})
+
+    token, synced_at, events = store.load('cal')
+    assert (token, synced_at) == ('s1', 10.0)
+    assert events == [('e1', 'Task', 't1', 'p1', 'h1')]
+
+    store.write('cal', {'e3': ('Task', 't3', None, None)}, sync_token='s2', replace=True)
+    assert [event[0] for event in store.load('cal')[2]] == ['e3']
+    store.close()
+
+
+def test_index_starts_warm_from_the_store(tmpdir):
+    path = str(tmpdir.join("sync.db"))
+
+    service = Service([
+        {'items': [ftrack_event('e1', 't1', 'h1'), ftrack_event('e2', 't2')], 'nextSyncToken': 's1'},
+    ])
+    index = EventIndex(service, 'cal', store=SyncStateStore(path))
+    index.ensure_current()
+    index.apply(ftrack_event('e3', 't3', 'h3'))
+    index.discard('e2')
+    index.flush()
+
+    # a new process, whose first catch-up only asks for what changed since s1
+    service = Service([{'items': [ftrack_event('e4', 't4')], 'nextSyncToken': 's2'}])
+    index = EventIndex(service, 'cal', refresh_interval=0, store=SyncStateStore(path))
+    index.ensure_current()
+
+    assert service.events().calls[0]['syncToken'] == 's1'
+    assert index.lookup('Task', 't1') == 'e1'
+    assert index.body_hash('e3') == 'h3'
+    assert index.lookup('Task', 't2') is None
+    assert index.lookup('Task', 't4') == 'e4'
+    assert index.sync_token == 's2'
@@ -0,0 +1,91 @@
+'''
+tests for user_calendars.py
+
+Lucid
+
+'''
+
+import sys, os
+import time
+
+sys.path.append(os.path.join("plugin_root", "ftrack_google_calendar", "resource"))
+sys.path.append(os.path.dirname(__file__))
+from user_calendars import UserCalendars, user_event_id
+from sync_state import SyncStateStore
+from google_client import RequestExecutor, TokenBucket
+from fake_google import FakeCalendarService
+
+
+def task_event(name, *emails):
+    return {
+        'summary': name,
+        'attendees': [{'email': email} for email in emails],
+        'extendedProperties': {'private': {'ftrack_id': 't1', 'ftrack_type': 'Task'}},
+    }
+
+
+def make_users(store=None, services=None, **kwargs):
+    services = services if services is not None else {}
+
+    def service_for(email):
+        return services.setdefault(email, FakeCalendarService())
+
+    executor = RequestExecutor(TokenBucket(1000, 1000), base_delay=0.001)
+    return services, UserCalendars(service_for, executor, store=store, **kwargs)
+
+
+def test_only_changed_assignments_are_written(tmpdir):
+    store = SyncStateStore(str(tmpdir.join("sync.db")))
+    services, users = make_users(store)
+    key = ('Task', 't1')
+
+    tally = users.sync([(key, task_event('Task 1', 'a@x.com', 'b@x.com'))])
+    assert tally == {'insert': 2}
+    event, = services['a@x.com'].live_events('primary')
+    assert event['id'] == user_event_id(*key)
+    assert 'attendees' not in event
+
+    # nothing changed, so nothing is sent
+    tally = users.sync([(key, task_event('Task 1', 'a@x.com', 'b@x.com'))])
+    assert tally == {'unchanged': 2}
+    assert services['a@x.com'].total_calls() == 1
+
+    # b is unassigned, c assigned -- a restart later still knows who has a copy
+    _, users = make_users(store, services)
+    tally = users.sync([(key, task_event('Task 1', 'a@x.com', 'c@x.com'))])
+    assert tally == {'unchanged': 1, 'insert': 1, 'delete': 1}
+    assert services['b@x.com'].live_events('primary') == []
+    assert len(services['c@x.com'].live_events('primary')) == 1
+
+    users.remove([key])
+    assert store.user_events(*key) == {}
+    assert all(service.live_events('primary') == [] for service in services.values())
+
+
+def test_out_of_date_record_is_corrected():
+    services, users = make_users()
+    key = ('Task', 't1')
+
+    # already on the calendar, though we have no record of it
+    users.sync([(key, task_event('Task 1', 'a@x.com'))])
+    users._ledger.clear()
+
+    tally = users.sync([(key, task_event('Task 1 renamed', 'a@x.com'))])
+    assert tally == {'update': 1}
+    event, = services['a@x.com'].live_events('primary')
+    assert event['summary'] == 'Task 1 renamed'
+
+
+def test_each_user_has_a_rate_limit_of_their_own():
+    buckets = {}
+    services, users = make_users(bucket_for=lambda email: buckets.setdefault(email, TokenBucket(1, 1)))
+    # the executor's own bucket would hold everyone up
+    users.executor.bucket = TokenBucket(0.001, 1)
+    users.executor.bucket.acquire()
+
+    started = time.time()
+    tally = users.sync([(('Task', 't1'), task_event('Task 1', 'a@x.com', 'b@x.com', 'c@x.com'))])
+    assert tally == {'insert': 3}
+    assert time.time() - started < 0.5
+    assert sorted(buckets) == ['a@x.com', 'b@x.com', 'c@x.com']
+    assert users.executor.stats()['requests'] == 3